@@ -7,6 +7,7 @@ Kozani (GR), and Zaragoza (ES).
 import geopandas as gpd
 import osmnx as ox
 import shapely
+import http_cache
 
 FOLDERPATH_IN = "./data/raw/city_boundaries/"
 FOLDERPATH_OUT = "./data/processed/1_cities_boundaries/"
@@ -35,19 +36,27 @@ COUNTRYNAMES = [
 # Kozani given by municipality
 # Zaragoza manually drawn within ring road
 
+
+def get_city_boundary(cityname):
+    """Get the boundary of a city and save it as a single polygon."""
+    if cityname == "Milan_metropolitan":
+        poly_city = gpd.read_file(FOLDERPATH_IN + "Milano.shp")
+        poly_all = gpd.read_file(FOLDERPATH_IN + "Milano_CMMI_province.shp")
+        poly = poly_all.difference(poly_city)
+    elif cityname == "Kozani":
+        poly = gpd.read_file(FOLDERPATH_IN + f"{cityname}.shp")
+        poly.geometry = [shapely.Polygon(poly.geometry[0].coords[:])]
+    elif cityname in ["Camden", "Lambeth", "Westminster"]:
+        poly = gpd.read_file(FOLDERPATH_IN + f"{cityname}.shp")
+    else:
+        http_cache.install()
+        countryname = COUNTRYNAMES[CITIES_RAW.index(cityname)]
+        poly = ox.geocode_to_gdf(f"{cityname}, {countryname}")
+    poly = poly.to_crs(epsg=4326)
+    poly = gpd.GeoDataFrame(geometry=[poly.union_all()], crs="epsg:4326")
+    poly.to_file(FOLDERPATH_OUT + cityname + ".gpkg")
+
+
 if __name__ == "__main__":
-    for idx, cityname in enumerate(CITIES_RAW):
-        if cityname == "Milan_metropolitan":
-           poly_city = gpd.read_file(FOLDERPATH_IN + "Milano.shp")
-           poly_all = gpd.read_file(FOLDERPATH_IN + "Milano_CMMI_province.shp")
-           poly = poly_all.difference(poly_city)
-        elif cityname == "Kozani":
-            poly = gpd.read_file(FOLDERPATH_IN + f"{cityname}.shp")
-            poly.geometry = [shapely.Polygon(poly.geometry[0].coords[:])]
-        elif cityname in ["Camden", "Lambeth", "Westminster"]:
-            poly = gpd.read_file(FOLDERPATH_IN + f"{cityname}.shp")
-        else:
-            poly = ox.geocode_to_gdf(f"{cityname}, {COUNTRYNAMES[idx]}")
-        poly = poly.to_crs(epsg=4326)
-        poly = gpd.GeoDataFrame(geometry=[poly.union_all()], crs="epsg:4326")
-        poly.to_file(FOLDERPATH_OUT + cityname + ".gpkg")
\ No newline at end of file
+    for cityname in CITIES_RAW:
+        get_city_boundary(cityname)
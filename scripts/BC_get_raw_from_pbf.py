@@ -0,0 +1,237 @@
+"""Get raw graphs and features for selected cities from local OpenStreetMap extracts.
+
+Offline alternative to B_get_graph_raw and C_get_features_raw: each .osm.pbf
+extract is streamed once for all the cities it covers, instead of sending two
+Overpass queries per city.
+"""
+
+import geopandas as gpd
+import osmium
+import osmnx as ox
+import tqdm
+from B_get_graph_raw import (
+    FOLDERPATH_POLY,
+    NETWORK_TYPE,
+    SAVE_ELEMENTS,
+    add_useful_tags,
+    process_graph_raw,
+    save_elements_raw,
+    save_graph_raw,
+)
+from C_get_features_raw import AMENITIES_DICT, save_features_raw
+from instrumentation import step, task
+from osm_elements import (
+    buffer_polygon,
+    features_from_elements,
+    get_network_conditions,
+    graph_from_elements,
+    match_tags,
+    match_way_filter,
+)
+
+FOLDERPATH_PBF = "./data/raw/osm/"
+PBF_EXTRACTS = {  # Extracts from Geofabrik and the cities they cover
+    "portugal-latest.osm.pbf": ["Braga"],
+    "greater-london-latest.osm.pbf": ["Camden", "Lambeth", "Westminster"],
+    "romania-latest.osm.pbf": ["Cugir"],
+    "greece-latest.osm.pbf": ["Kozani"],
+    "nord-ovest-latest.osm.pbf": ["Milan_metropolitan"],
+    "latvia-latest.osm.pbf": ["Riga"],
+    "aragon-latest.osm.pbf": ["Zaragoza"],
+}
+RELATION_TYPES = ["multipolygon", "boundary"]  # Relations that OSMnx turns into features
+MEMBER_TYPES = {"n": "node", "w": "way", "r": "relation"}
+
+
+def _intersecting(bounds, boxes):
+    """Get the names of the boxes intersecting the bounds."""
+    minx, miny, maxx, maxy = bounds
+    return [
+        name
+        for name, (bminx, bminy, bmaxx, bmaxy) in boxes.items()
+        if minx <= bmaxx and maxx >= bminx and miny <= bmaxy and maxy >= bminy
+    ]
+
+
+def read_extract(filepath, polygons):
+    """Read an extract once and get the OSM elements of the graph and features of each city.
+
+    Elements are in Overpass JSON format, covering the polygon of each city buffered
+    as OSMnx does, so that they can be turned into the same graph and features.
+    """
+    boxes = {name: buffer_polygon(poly).bounds for name, poly in polygons.items()}
+    conditions = get_network_conditions(NETWORK_TYPE)
+    useful_tags_node = set(ox.settings.useful_tags_node)
+    # Relations are read first, in a pass skipping nodes and ways, to know their ways
+    relations = {}
+    for obj in osmium.FileProcessor(filepath, osmium.osm.RELATION):
+        tags = dict(obj.tags)
+        if tags.get("type") in RELATION_TYPES and match_tags(tags, AMENITIES_DICT):
+            relations[obj.id] = {
+                "type": "relation",
+                "id": obj.id,
+                "tags": tags,
+                "members": [
+                    {"type": MEMBER_TYPES[m.type], "ref": m.ref, "role": m.role}
+                    for m in obj.members
+                ],
+            }
+    member_ways = {
+        m["ref"] for rel in relations.values() for m in rel["members"] if m["type"] == "way"
+    }
+    node_tags = {}  # Tags of the nodes having a tag kept by OSMnx
+    feature_nodes = {name: {} for name in polygons}
+    graph_ways = {name: {} for name in polygons}
+    feature_ways = {name: {} for name in polygons}
+    way_elements = {}  # Ways that are members of a relation
+    coords = {}  # Coordinates of the nodes of the kept ways
+    for obj in osmium.FileProcessor(
+        filepath, osmium.osm.NODE | osmium.osm.WAY
+    ).with_locations():
+        tags = dict(obj.tags)
+        if obj.is_node():
+            if not tags:
+                continue
+            names = _intersecting((obj.lon, obj.lat, obj.lon, obj.lat), boxes)
+            if not names:
+                continue
+            if useful_tags_node & tags.keys():
+                node_tags[obj.id] = tags
+            if match_tags(tags, AMENITIES_DICT):
+                element = {"type": "node", "id": obj.id, "lat": obj.lat, "lon": obj.lon}
+                for name in names:
+                    feature_nodes[name][obj.id] = dict(element, tags=tags)
+            continue
+        is_graph = "highway" in tags and match_way_filter(tags, conditions)
+        is_feature = match_tags(tags, AMENITIES_DICT)
+        if not (is_graph or is_feature or obj.id in member_ways):
+            continue
+        nodes = [(n.ref, n.lon, n.lat) for n in obj.nodes if n.location.valid()]
+        if not nodes:
+            continue
+        lons, lats = [n[1] for n in nodes], [n[2] for n in nodes]
+        names = _intersecting((min(lons), min(lats), max(lons), max(lats)), boxes)
+        if not names and obj.id not in member_ways:
+            continue
+        element = {
+            "type": "way",
+            "id": obj.id,
+            "nodes": [n.ref for n in obj.nodes],
+            "tags": tags,
+        }
+        for ref, lon, lat in nodes:
+            coords[ref] = (lon, lat)
+        for name in names:
+            if is_graph:
+                graph_ways[name][obj.id] = element
+            if is_feature:
+                feature_ways[name][obj.id] = element
+        if obj.id in member_ways:
+            way_elements[obj.id] = (element, names)
+    return {
+        name: {
+            "graph": _make_elements(graph_ways[name], {}, {}, coords, node_tags),
+            "features": _make_elements(
+                feature_ways[name],
+                feature_nodes[name],
+                {
+                    rel_id: rel
+                    for rel_id, rel in relations.items()
+                    if any(
+                        name in way_elements.get(m["ref"], (None, []))[1]
+                        for m in rel["members"]
+                    )
+                },
+                coords,
+                node_tags,
+                way_elements,
+            ),
+        }
+        for name in polygons
+    }
+
+
+def _make_elements(ways, nodes, relations, coords, node_tags, way_elements=None):
+    """Make the Overpass JSON elements of the ways, nodes and relations, with their members."""
+    ways = dict(ways)
+    for rel in relations.values():
+        for m in rel["members"]:
+            if m["type"] == "way" and m["ref"] in way_elements:
+                ways[m["ref"]] = way_elements[m["ref"]][0]
+    nodes = dict(nodes)
+    for way in ways.values():
+        for ref in way["nodes"]:
+            if ref not in nodes and ref in coords:
+                lon, lat = coords[ref]
+                nodes[ref] = {"type": "node", "id": ref, "lat": lat, "lon": lon}
+                if ref in node_tags:
+                    nodes[ref]["tags"] = node_tags[ref]
+    # Copy the elements as OSMnx modifies them, and sort them as Overpass does
+    elements = [dict(nodes[key]) for key in sorted(nodes)]
+    elements += [dict(ways[key]) for key in sorted(ways)]
+    elements += [
+        dict(relations[key], members=list(relations[key]["members"]))
+        for key in sorted(relations)
+    ]
+    for element in elements:
+        if "tags" in element:
+            element["tags"] = dict(element["tags"])
+    return [{"elements": elements}]
+
+
+def get_raw_from_pbf(filepath, cities, save_elements=SAVE_ELEMENTS):
+    """Get and save the raw graph and features of the cities covered by an extract.
+
+    Their elements are also saved if asked, for update_from_osc.
+    """
+    add_useful_tags()
+    polygons = {
+        cityname: gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg").geometry[0]
+        for cityname in cities
+    }
+    with step("read_extract"):
+        elements = read_extract(filepath, polygons)
+    # The extract is read once for all its cities, which are then tasks of their own
+    for cityname in cities:
+        poly = polygons[cityname]
+        with task("BC", cityname):
+            if save_elements:
+                with step("save_elements"):
+                    for kind in ["graph", "features"]:
+                        save_elements_raw(elements[cityname][kind], cityname, kind, poly)
+            with step("build_graph") as record:
+                G = graph_from_elements(
+                    elements[cityname]["graph"], poly, NETWORK_TYPE, retain_all=True
+                )
+                record["rows_out"] = G.number_of_edges()
+            with step("process", rows=G.number_of_edges()):
+                G = process_graph_raw(G)
+            with step("save_graph", rows=G.number_of_edges()):
+                save_graph_raw(G, cityname)
+            with step("build_features") as record:
+                gdf = features_from_elements(
+                    elements[cityname]["features"], poly, AMENITIES_DICT
+                )
+                record["rows_out"] = len(gdf)
+            with step("save_features", rows=len(gdf)):
+                save_features_raw(gdf, cityname)
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+
+    for filename, cities in tqdm.tqdm(PBF_EXTRACTS.items()):
+        cities = [
+            cityname
+            for cityname in cities
+            if stage_cache.is_stale("B", cityname) or stage_cache.is_stale("C", cityname)
+        ]
+        if cities:
+            print(filename, cities)
+            get_raw_from_pbf(FOLDERPATH_PBF + filename, cities)
+            # Outputs are the same as the ones of B and C from Overpass
+            for cityname in cities:
+                stage_cache.record("B", cityname)
+                stage_cache.record("C", cityname)
+    instrumentation.save_report(name="BC")
@@ -1,11 +1,27 @@
 """Get raw graphs from OpenStreetMap for selected cities."""
 
+import glob
+import json
 import geopandas as gpd
+import networkx as nx
+import numpy as np
 import osmnx as ox
+import pandas as pd
 import tqdm
 import os
+from osmnx.routing import _clean_maxspeed, _collapse_multiple_maxspeed_values
+from config import (
+    AMENITIES_DICT,
+    FOLDERPATH_CHANGES,
+    FOLDERPATH_CITIES,
+    FOLDERPATH_POLY,
+    CITIES,
+)
+from graph_io import save_graph
+from instrumentation import step
+from osm_elements import buffer_polygon, graph_from_elements, save_elements, select_nodes
+from tiled_download import download_graph_elements
 
-RECOMPUTE = False
 FALLBACK_SPEED = 50  # Speed by default if no other computation found
 BUFFER_NEARBY = 15  # Buffer in meter to know if a polygon amenity is near a road
 USEFUL_TAGS = [
@@ -14,93 +30,183 @@ USEFUL_TAGS = [
     "cycleway",
     "footway",
 ]  # Additional tags to extract for the road network
-FOLDERPATH_POLY = "./data/processed/1_cities_boundaries/"
-FOLDERPATH_CITIES = "./data/processed/"
-CITIES = [
-    "Braga",
-    "Camden",
-    "Cugir",
-    "Kozani",
-    "Lambeth",
-    "Milan_metropolitan",
-    "Riga",
-    "Westminster",
-    "Zaragoza",
-]
 NETWORK_TYPE = "all"
+EDGE_ATTRS_DIFFER = [  # Attributes of the edges keeping a node where their values differ
+    "highway",
+    "parking:left",
+    "parking:right",
+    "maxspeed",
+]
+FOOTWAY_VALUES = [  # Values of the highway tag simplified as footway
+    "corridor",
+    "bridleway",
+    "pedestrian",
+    "path",
+    "steps",
+]
+SAVE_ELEMENTS = False  # Also save the OSM elements of the raw data, to update it with update_from_osc
+
+
+def add_useful_tags():
+    """Add the USEFUL_TAGS to the tags of the ways kept by OSMnx."""
+    for tag in USEFUL_TAGS:
+        if tag not in ox.settings.useful_tags_way:
+            ox.settings.useful_tags_way.append(tag)
+
+
+def get_speeds(highway, maxspeed, fallback=FALLBACK_SPEED):
+    """Get the speeds of edges from their highway and maxspeed, rounded to tens.
+
+    As ox.add_edge_speeds: the maxspeed of an edge, else the mean maxspeed of its
+    highway type, else the fallback. Each distinct maxspeed value is parsed once.
+    """
+    highway = highway.map(lambda x: x[0] if isinstance(x, list) else x)
+    maxspeed = maxspeed.map(
+        lambda x: _collapse_multiple_maxspeed_values(x, agg=np.mean)
+        if isinstance(x, list)
+        else x
+    ).astype(str)
+    values = maxspeed.unique()
+    parsed = dict(zip(values, [_clean_maxspeed(value) for value in values]))
+    speeds = maxspeed.map(parsed).astype(float)
+    averages = pd.Series(dtype=float)
+    for hwy, group in speeds.groupby(highway):
+        averages.loc[hwy] = np.mean(group)
+    averages = averages.fillna(fallback).fillna(np.mean(averages))
+    speeds = speeds.fillna(highway.map(averages))
+    return np.round(speeds.values, -1).astype(int)
+
+
+def get_intersections(nodes, u, v):
+    """Get which nodes are intersections or dead-ends, from the end nodes u and v of the edges.
+
+    Other nodes are interstitial, as in the OSMnx simplification. Edges must be all
+    the edges of the nodes, edges of other nodes being ignored.
+    """
+    codes, uniques = pd.factorize(np.concatenate([nodes, u, v]))
+    n = len(uniques)
+    u, v = codes[len(nodes) : len(nodes) + len(u)], codes[len(nodes) + len(u) :]
+    out_degree = np.bincount(u, minlength=n)
+    in_degree = np.bincount(v, minlength=n)
+    degree = out_degree + in_degree
+    self_loop = np.bincount(u[u == v], minlength=n) > 0
+    # Count distinct neighbors, predecessors and successors together
+    pairs = np.unique(np.concatenate([u, v]) * n + np.concatenate([v, u]))
+    n_neighbors = np.bincount(pairs // n, minlength=n)
+    interstitial = (n_neighbors == 1) | (
+        (n_neighbors == 2) & ((degree == 2) | (degree == 4))
+    )
+    intersection = self_loop | (out_degree == 0) | (in_degree == 0) | ~interstitial
+    return intersection[codes[: len(nodes)]]
+
+
+def add_edge_attributes(edges):
+    """Add the simplified highway and the presence of cycling and pedestrian infrastructure."""
+    # Simplify footways' values in highway tag
+    edges["highway"] = edges["highway"].mask(
+        edges["highway"].isin(FOOTWAY_VALUES), "footway"
+    )
+    # Add presence of cycling infrastructure boolean
+    edges["cycling_infrastructure"] = (edges["highway"] == "cycleway") | (
+        edges["cycleway"].notna() & (edges["cycleway"] != "no")
+    )
+    # Add presence of pedestrian infrastructure boolean
+    edges["pedestrian_infrastructure"] = (edges["highway"] == "footway") | (
+        edges["footway"].notna() & (edges["footway"] != "no")
+    )
+    return edges
+
+
+def process_graph_raw(G):
+    """Simplify the unsimplified graph from OSM and add the attributes we need."""
+    # Simplify while discriminate for relevant attributes
+    G = ox.simplify_graph(G, edge_attrs_differ=EDGE_ATTRS_DIFFER)
+    edge_index = pd.MultiIndex.from_tuples(list(G.edges(keys=True)))
+    edges = pd.DataFrame(
+        {
+            attr: pd.Series(nx.get_edge_attributes(G, attr), dtype=object)
+            for attr in ["highway", "cycleway", "footway", "maxspeed"]
+        },
+        index=edge_index,
+    )
+    edges = add_edge_attributes(edges)
+    for attr in ["highway", "cycling_infrastructure", "pedestrian_infrastructure"]:
+        nx.set_edge_attributes(G, dict(zip(edge_index, edges[attr].tolist())), attr)
+    # Compute travel time to increase centrality of high speed roads
+    # For maxspeed, compute average of roads with same highway attribute, else use fallback
+    speeds = get_speeds(edges["highway"], edges["maxspeed"])
+    nx.set_edge_attributes(G, dict(zip(edge_index, speeds.tolist())), "speed_kph")
+    G = ox.add_edge_travel_times(G)
+    # Separate between intersections and other nodes, dead-ends and interstitial ones
+    # From OSMnx simplification function, with arrays of node positions of the edges
+    intersection = get_intersections(
+        np.array(G.nodes), edge_index.get_level_values(0), edge_index.get_level_values(1)
+    )
+    nx.set_node_attributes(G, dict(zip(G.nodes, intersection.tolist())), "intersection")
+    return G
+
+
+def save_graph_raw(G, cityname):
+    """Save the raw graph of a city."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    save_graph(G, outfolder + cityname + "_graph_0_raw")
+
+
+def get_change_files():
+    """Get the OSM change files, in the order they are applied."""
+    return sorted(glob.glob(FOLDERPATH_CHANGES + "**/*.osc*", recursive=True))
+
+
+def save_elements_raw(response_jsons, cityname, kind, polygon):
+    """Save the OSM elements the raw graph or features of a city are made of.
+
+    kind is "graph" or "features". Nodes are selected as from an extract, for the
+    elements to be the same whether downloaded or not. The elements are updated from
+    OSM change files by update_from_osc, the change files already there being taken
+    as applied.
+    """
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    response_jsons = select_nodes(
+        response_jsons,
+        buffer_polygon(polygon).bounds,
+        AMENITIES_DICT if kind == "features" else None,
+    )
+    save_elements(response_jsons, outfolder + cityname + "_osm_" + kind + ".json.gz")
+    with open(outfolder + cityname + "_osm_" + kind + "_changes.json", "w") as f:
+        json.dump(get_change_files(), f, indent=2)
+
+
+def get_graph_raw(cityname, save_elements=SAVE_ELEMENTS):
+    """Get the raw graph of a city from OpenStreetMap and save it, with its elements if asked."""
+    add_useful_tags()
+    poly = gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg")
+    # Download by tiles, as one query times out for large (Multi)Polygons
+    with step("download") as record:
+        response_jsons = download_graph_elements(poly.geometry[0], NETWORK_TYPE)
+        if save_elements:
+            save_elements_raw(response_jsons, cityname, "graph", poly.geometry[0])
+        G = graph_from_elements(
+            response_jsons, poly.geometry[0], NETWORK_TYPE, retain_all=True
+        )
+        record["rows_out"] = G.number_of_edges()
+    with step("process", rows=G.number_of_edges()):
+        G = process_graph_raw(G)
+    with step("save", rows=G.number_of_edges()):
+        save_graph_raw(G, cityname)
 
 
 if __name__ == "__main__":
-    ox.settings.useful_tags_way += USEFUL_TAGS
+    import instrumentation
+    import stage_cache
+
     for cityname in tqdm.tqdm(CITIES):
-        #TODO fix for Milan metropolitan because multipolygon and not polygon
-        outfolder = FOLDERPATH_CITIES + cityname + "/"
-        if (os.path.exists(outfolder + cityname + "_graph_0_raw.graphml") and RECOMPUTE) or (not os.path.exists(outfolder + cityname + "_graph_0_raw.graphml")):
+        if stage_cache.is_stale("B", cityname):
             print(cityname)
-            if not os.path.exists(outfolder):
-                os.makedirs(outfolder)
-            poly = gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg")
-            G = ox.graph_from_polygon(
-                poly.geometry[0], network_type=NETWORK_TYPE, simplify=False, retain_all=True,
-            )
-            # Simplify while discriminate for relevant attributes
-            G = ox.simplify_graph(
-                G, edge_attrs_differ=["highway", "parking:left", "parking:right", "maxspeed"]
-            )
-            # Simplify footways' values in highway tag
-            for e in G.edges:
-                if G.edges[e]["highway"] in [
-                    "corridor",
-                    "bridleway",
-                    "pedestrian",
-                    "path",
-                    "steps",
-                ]:
-                    G.edges[e]["highway"] = "footway"
-            # Add presence of cycling infrastructure boolean
-            for e in G.edges:
-                if G.edges[e]["highway"] == "cycleway":
-                    G.edges[e]["cycling_infrastructure"] = True
-                elif "cycleway" in G.edges[e]:
-                    if G.edges[e]["cycleway"] != "no":
-                        G.edges[e]["cycling_infrastructure"] = True
-                else:
-                    G.edges[e]["cycling_infrastructure"] = False
-            # Add presence of pedestrian infrastructure boolean
-            for e in G.edges:
-                if G.edges[e]["highway"] == "footway":
-                    G.edges[e]["pedestrian_infrastructure"] = True
-                elif "footway" in G.edges[e]:
-                    if G.edges[e]["footway"] != "no":
-                        G.edges[e]["pedestrian_infrastructure"] = True
-                else:
-                    G.edges[e]["pedestrian_infrastructure"] = False
-            # Compute travel time to increase centrality of high speed roads
-            # For maxspeed, compute average of roads with same highway attribute, else use fallback
-            G = ox.add_edge_speeds(G, fallback=FALLBACK_SPEED)
-            # Round estimated speed to have a realistic estimated speed
-            for e in G.edges:
-                G.edges[e]["speed_kph"] = int(round(G.edges[e]["speed_kph"], -1))
-            G = ox.add_edge_travel_times(G)
-            # Separate between intersections and other nodes, dead-ends and interstitial ones
-            # From OSMnx simplification function
-            for node in G.nodes:
-                neighbors = set(list(G.predecessors(node)) + list(G.successors(node)))
-                n = len(neighbors)
-                d = G.degree(node)
-                if node in neighbors:
-                    G.nodes[node]["intersection"] = True
-                    continue
-                if G.out_degree(node) == 0 or G.in_degree(node) == 0:
-                    G.nodes[node]["intersection"] = True
-                    continue
-                if not ((n == 2) and (d in {2, 4})):
-                    if n == 1:
-                        G.nodes[node]["intersection"] = False
-                    else:
-                        G.nodes[node]["intersection"] = True
-                    continue
-                G.nodes[node]["intersection"] = False
-            gdf_nodes, gdf_edges = ox.graph_to_gdfs(G, nodes=True, edges=True)
-            ox.save_graphml(G, outfolder + cityname + "_graph_0_raw.graphml")
-            ox.save_graph_geopackage(G, outfolder + cityname + "_graph_0_raw.gpkg")
\ No newline at end of file
+            with instrumentation.task("B", cityname):
+                get_graph_raw(cityname)
+            stage_cache.record("B", cityname)
+    instrumentation.save_report(name="B")
@@ -4,40 +4,46 @@ import geopandas as gpd
 import osmnx as ox
 import tqdm
 import os
-from B_get_graph_raw import FOLDERPATH_POLY, FOLDERPATH_CITIES, CITIES
-
-
-RECOMPUTE = True
-AMENITIES_DICT = {  # List of amenities from tags and values to extract
-    "public_transport": ["platform"],
-    "highway": [
-        "crossing",
-        "cyclist_waiting_aid",
-        "traffic_signals",
-        "street_lamp",
-        "traffic_mirror",
-        "bus_stop",
-    ],
-    "amenity": ["bicycle_parking", "parking", "marketplace"],
-    "building": ["parking"],
-    "place": ["square"],
-    "leisure": ["park", "garden"],
-    "shop": True,
-    "osmid": True,
-}
+from tiled_download import download_features_elements
+from instrumentation import step
+from osm_elements import features_from_elements
+from B_get_graph_raw import SAVE_ELEMENTS, save_elements_raw
+from config import FOLDERPATH_POLY, FOLDERPATH_CITIES, CITIES, AMENITIES_DICT
 
 
-if __name__ == "__main__":
+def save_features_raw(gdf, cityname):
+    """Save the raw features of a city."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    if "FIXME" in gdf.columns:
+        gdf = gdf.drop(columns="FIXME")
+    gdf.to_file(outfolder + cityname + "_features_0_raw.gpkg", index=True)
+
+
+def get_features_raw(cityname, save_elements=SAVE_ELEMENTS):
+    """Get the raw features of a city from OpenStreetMap and save them, and their elements if asked."""
     ox.settings.requests_timeout = 1200
+    poly = gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg")
+    with step("download") as record:
+        response_jsons = download_features_elements(poly.geometry[0], AMENITIES_DICT)
+        # Saved before OSMnx modifies the elements to build the features
+        if save_elements:
+            save_elements_raw(response_jsons, cityname, "features", poly.geometry[0])
+        gdf = features_from_elements(response_jsons, poly.geometry[0], AMENITIES_DICT)
+        record["rows_out"] = len(gdf)
+    with step("save", rows=len(gdf)):
+        save_features_raw(gdf, cityname)
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+
     for cityname in tqdm.tqdm(CITIES):
-        outfolder = FOLDERPATH_CITIES + cityname + "/"
-        if (os.path.exists(outfolder + cityname + "_features_0_raw.gpkg") and RECOMPUTE) or (not os.path.exists(outfolder + cityname + "_features_0_raw.gpkg")):
+        if stage_cache.is_stale("C", cityname):
             print(cityname)
-            poly = gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg")
-            gdf = ox.features_from_polygon(
-                poly.geometry[0],
-                tags=AMENITIES_DICT,
-            )
-            if "FIXME" in gdf.columns:
-                gdf = gdf.drop(columns="FIXME")
-            gdf.to_file(outfolder + cityname + "_features_0_raw.gpkg", index=True)
\ No newline at end of file
+            with instrumentation.task("C", cityname):
+                get_features_raw(cityname)
+            stage_cache.record("C", cityname)
+    instrumentation.save_report(name="C")
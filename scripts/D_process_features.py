@@ -1,129 +1,166 @@
 """Process features for selected cities."""
 
 
-import os
 import numpy as np
 import geopandas as gpd
 import shapely
 import tqdm
 import pandas as pd
-from B_get_graph_raw import FOLDERPATH_CITIES, CITIES
-
-
-def sort_values(row):
-    """Sort values from the AMENITIES_DICT to a list of types."""
-    val = []
-    x = row.copy()
-    for key in [
-        "public_transport",
-        "highway",
-        "leisure",
-        "amenity",
-        "place",
-        "shop",
-        "building",
-    ]:
-        if key not in x:
-            x[key] = np.nan
-    if x["public_transport"] == "platform" or x["highway"] == "bus_stop":
-        val += ["public_transport_platform"]
-    if x["leisure"] in ["park", "garden"] and x["amenity"] != "parking":
-        val += ["green_area"]
-    if (
-        (x["place"] == "square" or x["amenity"] == "marketplace")
-        and (x["leisure"] not in ["park", "garden"])
-        and (x["amenity"] != "parking")
-    ):
-        val += ["public_square"]
-    elif not pd.isna(x["shop"]):
-        val += ["shop"]
-    if (x["amenity"] == "parking" or x["building"] == "parking") and pd.isna(x["shop"]):
-        val += ["parking"]
-    if x["amenity"] == "bicycle_parking" and x["highway"] != "crossing":
-        val += ["bicycle_parking"]
-    if x["highway"] in [
-        "crossing",
-        "cyclist_waiting_aid",
-        "traffic_signals",
-        "street_lamp",
-        "traffic_mirror",
-    ]:
-        val += [x["highway"]]
-    if len(val) < 1:
-        val += [None]
-    return val
-
-RECOMPUTE = True
+from config import FOLDERPATH_CITIES, CITIES, FEATURE_RULES
+from instrumentation import step
+import geometry_dedup
+import spatial_index
+import tiling
+import table_cache
+
+
+def _tag_mask(gdf, tag, values):
+    """Get boolean mask of the rows where the tag has one of the values."""
+    if tag not in gdf:
+        return np.zeros(len(gdf), dtype=bool)
+    if values is True:
+        return gdf[tag].notna().values
+    return gdf[tag].isin(values).values
+
+
+def match_rules(gdf, rules=FEATURE_RULES):
+    """Get boolean matrix of the rows matching each rule of the rule table."""
+    matches = np.zeros((len(gdf), len(rules)), dtype=bool)
+    for col, (name, rule) in enumerate(rules):
+        mask = np.zeros(len(gdf), dtype=bool)
+        for tag, values in rule.get("any", {}).items():
+            mask |= _tag_mask(gdf, tag, values)
+        for tag, values in rule.get("none", {}).items():
+            mask &= ~_tag_mask(gdf, tag, values)
+        for previous in rule.get("unless", []):
+            mask &= ~matches[:, [r[0] for r in rules].index(previous)]
+        matches[:, col] = mask
+    return matches
+
+
+def classify_features(gdf, rules=FEATURE_RULES):
+    """Get the type of each amenity and the matrix of all the rules it matches."""
+    matches = match_rules(gdf, rules)
+    names = np.array([name for name, _ in rules] + [None], dtype=object)
+    # Index of first matching rule, or of the None type if no match
+    first = np.where(matches.any(axis=1), matches.argmax(axis=1), len(rules))
+    return pd.Series(names[first], index=gdf.index, name="type", dtype=object), matches
+
+
 BUFFER_DUPLICATE_LS = (
     8  # Buffer in meter to find duplicate amenities between points and linestrings
 )
 
 
+def find_duplicates(gdf, projected, rows=None):
+    """Get the labels of the linestrings near a point of the same type, duplicating it.
+
+    projected are the geometries of gdf in the projected CRS of the city. Only the
+    linestrings at the positions rows are checked, if given.
+    """
+    is_point = gdf.geometry.apply(
+        lambda x: True if isinstance(x, shapely.Point) else False
+    ).values
+    is_ls = gdf.geometry.apply(
+        lambda x: True if isinstance(x, shapely.LineString) else False
+    ).values
+    if rows is not None:
+        is_ls = is_ls & np.isin(np.arange(len(gdf)), rows)
+    ls_pos = np.flatnonzero(is_ls)
+    point_pos = np.flatnonzero(is_point)
+    ls_ind, point_ind = geometry_dedup.find_near_pairs(
+        projected[ls_pos], projected[point_pos], BUFFER_DUPLICATE_LS
+    )
+    ls_ind, point_ind = ls_pos[ls_ind], point_pos[point_ind]
+    types = gdf["type"].values
+    # Features without a type are duplicates of each other, as with a spatial join on type
+    duplicates = ls_ind[types[ls_ind] == types[point_ind]]
+    return gdf.index[np.unique(duplicates)].values
+
+
+def find_duplicates_tile(cityname, fids, bbox):
+    """Find the duplicated linestrings owned by a tile, reading only the features around."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    gdf = gpd.read_file(
+        outfolder + cityname + "_features_0_raw.gpkg", bbox=bbox, fid_as_index=True
+    )
+    rows = np.flatnonzero(gdf.index.isin(fids))
+    gdf = gdf.set_index("id")
+    gdf["type"], _ = classify_features(gdf)
+    projected = gdf.geometry.to_crs(spatial_index.get_city_crs(cityname)).values
+    return find_duplicates(gdf, projected, rows)
+
+
+def process_features(cityname):
+    """Classify and simplify the features of a city and save them."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    with step("load") as record:
+        gdf = table_cache.load(gpd.read_file, outfolder + cityname + "_features_0_raw.gpkg")
+        gdf = gdf.set_index("id")
+        record["rows_out"] = len(gdf)
+    # Simplify in single attribute the different kind of amenities
+    with step("classify", rows=len(gdf)):
+        gdf["type"], matches = classify_features(gdf)
+    # Check if an amenity has two type, which should not be the case here
+    errors = matches.sum(axis=1) > 1
+    if errors.any():
+        print("Some errors are found!")
+        for ind, row in zip(gdf.index[errors], matches[errors]):
+            print(ind, [name for (name, _), m in zip(FEATURE_RULES, row) if m])
+    with step("save_classified", rows=len(gdf)):
+        gdf.to_file(outfolder + cityname + "_features_1_classified.gpkg", index=True, overwrite=True)
+    gdf_cleaned = gdf.copy()
+    # Find linestrings near a point of the same type to remove duplicates
+    with step("find_duplicates", rows=len(gdf)) as record:
+        if cityname in tiling.TILED_CITIES:
+            tiles = tiling.get_tiles(
+                cityname,
+                outfolder + cityname + "_features_0_raw.gpkg",
+                BUFFER_DUPLICATE_LS,
+            )
+            duplicates = np.concatenate(
+                tiling.run_tiles(find_duplicates_tile, cityname, tiles)
+            )
+        else:
+            # Projected geometries are shared with the other stages
+            projected = spatial_index.get_layer(cityname, "features_raw", gdf)
+            duplicates = find_duplicates(gdf, projected.values)
+        record["rows_out"] = len(duplicates)
+    save_features_cleaned(cityname, gdf_cleaned, duplicates)
+
+
+def save_features_cleaned(cityname, gdf_cleaned, duplicates):
+    """Save the classified features without duplicates, as points, and their lighter version."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    gdf_cleaned = gdf_cleaned.drop(duplicates)
+    # For other linestrings, take middle point
+    gdf_cleaned.geometry = gdf_cleaned.geometry.apply(
+        lambda x: x.interpolate(0.5, normalized=True)
+        if isinstance(x, shapely.LineString)
+        else x
+    )
+    with step("save_classified_wols", rows=len(gdf_cleaned)):
+        gdf_cleaned.to_file(outfolder + cityname + "_features_2_classified_wols.gpkg", index=True, overwrite=True)
+    # Keep only important attributes to create lighter file
+    gdf_simple = gdf_cleaned[["element", "type", "geometry"]].copy()
+    # Simplify OSMID by putting first capitalized letter of type and numbers
+    gdf_simple.loc[:, "osmid"] = gdf_simple["element"].str[0].str.upper() + (
+        gdf_simple.index.astype(str)
+    )
+    gdf_simple = gdf_simple.set_index("osmid")
+    gdf_simple = gdf_simple.drop("element", axis=1)
+    with step("save_dense", rows=len(gdf_simple)):
+        gdf_simple.to_file(outfolder + cityname + "_features_3_dense.gpkg", index=True, overwrite=True)
+
+
 if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+
     for cityname in tqdm.tqdm(CITIES):
-        outfolder = FOLDERPATH_CITIES + cityname + "/"
-        if (os.path.exists(outfolder + cityname + "_features_3_dense.gpkg") and RECOMPUTE) or (not os.path.exists(outfolder + cityname + "_features_3_dense.gpkg")):
+        if stage_cache.is_stale("D", cityname):
             print(cityname)
-            gdf = gpd.read_file(outfolder + cityname + "_features_0_raw.gpkg")
-            gdf = gdf.set_index("id")
-            proj_crs = gdf.estimate_utm_crs()
-            # Simplify in single attribute the different kind of amenities
-            vals = []
-            for ind, row in gdf.iterrows():
-                vals.append(sort_values(row))
-            gdf["type"] = vals
-            # Check if an amenity has two type, which should not be the case here
-            errors = gdf[
-                gdf["type"].apply(lambda x: True if len(str(x).split(",")) > 1 else False)
-            ]
-            if len(errors) > 0:
-                print("Some errors are found!")
-                for i in range(len(errors)):
-                    print(
-                        errors.index[i],
-                        [
-                            val
-                            for val in errors.iloc[i].values
-                            if (
-                                isinstance(val, shapely.Geometry)
-                                or isinstance(val, list)
-                                or isinstance(val, str)
-                            )
-                        ],
-                    )
-            gdf["type"] = gdf["type"].apply(lambda x: x[0])
-            gdf.to_file(outfolder + cityname + "_features_1_classified.gpkg", index=True, overwrite=True)
-            gdf_cleaned = gdf.copy()
-            gdf_po = gdf[
-                gdf.geometry.apply(lambda x: True if isinstance(x, shapely.Point) else False)
-            ]
-            gdf_po = gdf_po.to_crs(proj_crs)
-            gdf_ls = gdf[
-                gdf.geometry.apply(
-                    lambda x: True if isinstance(x, shapely.LineString) else False
-                )
-            ]
-            gdf_ls = gdf_ls.to_crs(proj_crs)  # Project to use buffer
-            gdf_ls.geometry = gdf_ls.buffer(BUFFER_DUPLICATE_LS)
-            # Find linestrings near a point of the same type to remove duplicates
-            duplicates = gpd.sjoin(
-                gdf_ls, gdf_po, how="inner", predicate="intersects", on_attribute="type"
-            )
-            gdf_cleaned = gdf_cleaned.drop(duplicates.index.values)
-            # For other linestrings, take middle point
-            gdf_cleaned.geometry = gdf_cleaned.geometry.apply(
-                lambda x: x.interpolate(0.5, normalized=True)
-                if isinstance(x, shapely.LineString)
-                else x
-            )
-            gdf_cleaned.to_file(outfolder + cityname + "_features_2_classified_wols.gpkg", index=True, overwrite=True)
-            # Keep only important attributes to create lighter file
-            gdf_simple = gdf_cleaned[["element", "type", "geometry"]].copy()
-            vals = []
-            # Simplify OSMID by putting first capitalized letter of type and numbers
-            for ind, row in gdf_simple.iterrows():
-                vals.append(row.element[0].upper() + str(ind))
-            gdf_simple.loc[:, "osmid"] = vals
-            gdf_simple = gdf_simple.set_index("osmid")
-            gdf_simple = gdf_simple.drop("element", axis=1)
-            gdf_simple.to_file(outfolder + cityname + "_features_3_dense.gpkg", index=True, overwrite=True)
\ No newline at end of file
+            with instrumentation.task("D", cityname):
+                process_features(cityname)
+            stage_cache.record("D", cityname)
+    instrumentation.save_report(name="D")
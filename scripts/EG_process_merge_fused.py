@@ -0,0 +1,75 @@
+"""Process graphs and merge them with features for selected cities, in memory.
+
+Fused alternative to E_process_graph, F_compute_centrality_optional and
+G_merge_graph_features: the tables of nodes and edges are kept in memory from the
+feature join to the merge, so the intermediate graphs are neither written nor
+read back, unless asked for.
+"""
+
+import geopandas as gpd
+import tqdm
+from config import FOLDERPATH_CITIES, CITIES
+from E_process_graph import add_graph_attributes, drop_useless_attributes
+from F_compute_centrality_optional import add_centrality
+from G_merge_graph_features import merge_tables, write_merged
+from graph_io import load_graph_tables, save_graph_tables
+from instrumentation import step
+import table_cache
+
+WITH_CENTRALITY = True  # Add the centrality metrics of F
+SAVE_INTERMEDIATE = False  # Also save the graphs that E and F would save
+
+
+def process_merge_fused(
+    cityname, with_centrality=WITH_CENTRALITY, save_intermediate=SAVE_INTERMEDIATE
+):
+    """Process the graph of a city and merge it with the features into a single file."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    with step("load") as record:
+        gdf_nodes, gdf_edges = load_graph_tables(outfolder + cityname + "_graph_0_raw")
+        gdf_simple = table_cache.load(
+            gpd.read_file, outfolder + cityname + "_features_3_dense.gpkg"
+        )
+        record["rows_out"] = len(gdf_edges)
+    with step("attributes", rows=len(gdf_edges)):
+        gdf_nodes, gdf_edges = add_graph_attributes(
+            cityname, gdf_nodes, gdf_edges, gdf_simple
+        )
+    if save_intermediate:
+        save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_1_all")
+    gdf_nodes, gdf_edges = drop_useless_attributes(gdf_nodes, gdf_edges)
+    if save_intermediate:
+        save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_2_dense")
+    if with_centrality:
+        with step("betweenness", rows=len(gdf_edges)):
+            gdf_edges = add_centrality(gdf_nodes, gdf_edges)
+        if save_intermediate:
+            save_graph_tables(
+                gdf_nodes, gdf_edges, outfolder + cityname + "_graph_3_metrics"
+            )
+    # Each layer is saved once merged, so merging and saving are a single step
+    with step(
+        "merge_save", rows=len(gdf_nodes) + len(gdf_edges) + len(gdf_simple)
+    ) as record:
+        record["rows_out"] = write_merged(
+            merge_tables(
+                cityname,
+                lambda columns=None: [gdf_nodes],
+                lambda columns=None: [gdf_edges],
+                gdf_simple,
+            ),
+            outfolder + cityname + "_all.gpkg",
+        )
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+
+    for cityname in tqdm.tqdm(CITIES):
+        if stage_cache.is_stale("EG", cityname):
+            print(cityname)
+            with instrumentation.task("EG", cityname):
+                process_merge_fused(cityname)
+            stage_cache.record("EG", cityname)
+    instrumentation.save_report(name="EG")
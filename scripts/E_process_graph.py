@@ -1,14 +1,17 @@
 """Process graphs for selected cities."""
 
-import os
 import geopandas as gpd
-import osmnx as ox
+import numpy as np
 import tqdm
 import pandas as pd
-from B_get_graph_raw import FOLDERPATH_CITIES, CITIES
+from config import FOLDERPATH_CITIES, CITIES
+from graph_io import load_graph_tables, load_table, save_graph_tables
+from instrumentation import step
 import shapely
+import spatial_index
+import tiling
+import table_cache
 
-RECOMPUTE = False
 HIGHWAY_DICT = {  # Hierarchy in the road network
     "motorway": 1,
     "trunk": 2,
@@ -28,123 +31,203 @@ HIGHWAY_DICT = {  # Hierarchy in the road network
     "cycleway": 9,
     "footway": 10,
 }
-BUFFER_NEARBY = 15  # Buffer in meter to know if a polygon amenity is near a road
+BUFFER_NEARBY = 15  # Distance in meter to know if a polygon amenity is near a road
+NEAR_DISTANCES = {  # Distance in meter to count the amenities of each type near a road
+    "parking": BUFFER_NEARBY,
+    "green_area": BUFFER_NEARBY,
+    "public_square": BUFFER_NEARBY,
+}
+NEAR_COLUMNS = {  # Boolean attributes of the roads near a polygon amenity of a type
+    "parking": "near_parking",
+    "green_area": "near_park",
+    "public_square": "near_square",
+}
+NEAREST_MAX_DISTANCE = 1000  # Distance in meter up to which the nearest amenity is searched
+EDGE_COLS_TO_DROP = [  # Attributes of the roads not needed by the next stages
+    "lanes",
+    "junction",
+    "ref",
+    "bridge",
+    "tunnel",
+    "width",
+    "access",
+    "est_width",
+    "reversed",
+    "parking:right",
+    "parking:left",
+    "maxspeed",
+]
+NODE_COLS_TO_DROP = [  # Attributes of the nodes not needed by the next stages
+    "highway",
+    "ref",
+    "junction",
+    "railway",
+]
+SAVE_GRAPH_ALL = False  # Also save the graph with all attributes, as _graph_1_all
 
 
-if __name__ == "__main__":
-    for cityname in tqdm.tqdm(CITIES):
-        outfolder = FOLDERPATH_CITIES + cityname + "/"
-        if (os.path.exists(outfolder + cityname + "_graph_2_dense.graphml") and RECOMPUTE) or (not os.path.exists(outfolder + cityname + "_graph_2_dense.graphml")):
-            print(cityname)
-            G = ox.load_graphml(outfolder + cityname + "_graph_0_raw.graphml")
-            gdf_nodes, gdf_edges = ox.graph_to_gdfs(G, nodes=True, edges=True)
-            gdf_simple = gpd.read_file(outfolder + cityname + "_features_3_dense.gpkg")
-            proj_crs = gdf_simple.estimate_utm_crs()
-            gdf_simple_poly = gdf_simple[
-                gdf_simple.geometry.apply(
-                    lambda x: True
-                    if isinstance(x, shapely.MultiPolygon) or isinstance(x, shapely.Polygon)
-                    else False
-                )
-            ]
-            # Divide MultiPolygons into multiple Polygon entries
-            gdf_simple_poly_exploded = gdf_simple_poly.explode()
-            gdf_simple_poly_exploded = gdf_simple_poly_exploded.to_crs(
-                proj_crs
-            )  # Project to use buffer
-            gdf_simple_poly_exploded.geometry = gdf_simple_poly_exploded.buffer(BUFFER_NEARBY)
-            gdf_edges = gdf_edges.to_crs(proj_crs)
-            # Find roads nearby polygons
-            res = gpd.sjoin(
-                gdf_edges, gdf_simple_poly_exploded, how="left", predicate="intersects"
-            )
-            # Group the results to have a unique set of nearby amenities for each road
-            grouped_res = res.groupby(["u", "v", "key"])["type"].agg(set)
-            # Create boolean attribute to simplify search
-            gdf_edges["near_parking"] = [
-                True if "parking" in x else False for x in grouped_res.values
-            ]
-            gdf_edges["near_park"] = [
-                True if "green_area" in x else False for x in grouped_res.values
-            ]
-            gdf_edges["near_square"] = [
-                True if "public_square" in x else False for x in grouped_res.values
-            ]
-            # Merge left and right parking into a single street parking attribute
-            if "parking:left" in gdf_edges:
-                left_parking = [
-                    True if (not pd.isna(val) and val != "no") else False
-                    for val in gdf_edges["parking:left"].values
-                ]
-            else:
-                left_parking = [False] * len(gdf_edges)
-            if "parking:right" in gdf_edges:
-                right_parking = [
-                    True if (not pd.isna(val) and val != "no") else False
-                    for val in gdf_edges["parking:right"].values
-                ]
-            else:
-                right_parking = [False] * len(gdf_edges)
-            gdf_edges["street_parking"] = [
-                left or right for left, right in zip(left_parking, right_parking)
-            ]
-            # Simplify highway type into numbered hierarchy
-            gdf_edges["hierarchy"] = gdf_edges["highway"]
-            gdf_edges["hierarchy"] = gdf_edges["hierarchy"].apply(
-                lambda x: x.removesuffix("_link")
-            )
-            gdf_edges["hierarchy"] = gdf_edges["hierarchy"].apply(
-                lambda x: HIGHWAY_DICT[x] if x in HIGHWAY_DICT else 8
+def add_proximity(
+    gdf_edges, gdf_simple, edges_projected, projected, tree, distances=NEAR_DISTANCES
+):
+    """Add the amenities near each road, within a distance depending on their type.
+
+    For each type, count the amenities within the distance and get the distance to
+    the nearest one. Roads within the distance of a polygon of the type are flagged
+    in the near_* booleans. Geometries are given in the projected CRS of the city,
+    with the STRtree of the roads.
+    """
+    is_poly = gdf_simple.geometry.apply(
+        lambda x: True
+        if isinstance(x, shapely.MultiPolygon) or isinstance(x, shapely.Polygon)
+        else False
+    ).values
+    types = gdf_simple["type"].values
+    n_edges = len(gdf_edges)
+    for amenity, distance in distances.items():
+        pos = np.flatnonzero(types == amenity)
+        # Find roads within the distance, each pair of amenity and road once
+        amenity_ind, edge_ind = tree.query(
+            projected[pos], predicate="dwithin", distance=distance
+        )
+        gdf_edges["count_near_" + amenity] = np.bincount(edge_ind, minlength=n_edges)
+        if amenity in NEAR_COLUMNS:
+            # Create boolean attribute to simplify search, roads being found by position
+            near = np.zeros(n_edges, dtype=bool)
+            near[edge_ind[is_poly[pos][amenity_ind]]] = True
+            gdf_edges[NEAR_COLUMNS[amenity]] = near
+        nearest = np.full(n_edges, np.nan)
+        if len(pos):
+            (nearest_ind, _), dist = shapely.STRtree(projected[pos]).query_nearest(
+                edges_projected,
+                max_distance=NEAREST_MAX_DISTANCE,
+                return_distance=True,
+                all_matches=False,
             )
-            gdf_edges = gdf_edges.to_crs(epsg=4326)
-            # Some nodes from the road also have traffic signals or crossings
-            gdf_nodes["traffic_signals"] = [
-                True if (isinstance(val, str) and "traffic_signals" in val) else False
-                for val in gdf_nodes["highway"].values
-            ]
-            gdf_nodes["crossing"] = [
-                True if (isinstance(val, str) and "crossing" in val) else False
-                for val in gdf_nodes["highway"].values
-            ]
-            G = ox.graph_from_gdfs(
-                gdf_nodes=gdf_nodes, gdf_edges=gdf_edges, graph_attrs=G.graph
+            nearest[nearest_ind] = dist
+        gdf_edges["dist_nearest_" + amenity] = nearest
+    return gdf_edges
+
+
+def add_proximity_tile(cityname, keys, bbox):
+    """Get the amenities near the roads owned by a tile, reading only the data around."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    gdf_edges = load_table(
+        outfolder + cityname + "_graph_0_raw_edges.parquet", columns=[], bbox=bbox
+    )
+    gdf_edges = gdf_edges[gdf_edges.index.isin(keys)]
+    gdf_simple = gpd.read_file(outfolder + cityname + "_features_3_dense.gpkg", bbox=bbox)
+    crs = spatial_index.get_city_crs(cityname)
+    edges_projected = gdf_edges.geometry.to_crs(crs).values
+    gdf_edges = add_proximity(
+        gdf_edges,
+        gdf_simple,
+        edges_projected,
+        gdf_simple.geometry.to_crs(crs).values,
+        shapely.STRtree(edges_projected),
+    )
+    return gdf_edges.drop(columns="geometry")
+
+
+def add_graph_attributes(cityname, gdf_nodes, gdf_edges, gdf_simple):
+    """Add amenities and simplified attributes to the tables of nodes and edges of a graph."""
+    with step("proximity", rows=len(gdf_edges)):
+        if cityname in tiling.TILED_CITIES:
+            # Amenities are searched up to the largest distance around the roads of a tile
+            tiles = tiling.get_tiles(
+                cityname,
+                FOLDERPATH_CITIES + cityname + "/" + cityname + "_graph_0_raw_edges.parquet",
+                max([*NEAR_DISTANCES.values(), NEAREST_MAX_DISTANCE]),
             )
-            ox.save_graphml(G, outfolder + cityname + "_graph_1_all.graphml")
-            ox.save_graph_geopackage(G, outfolder + cityname + "_graph_1_all.gpkg")
-            # Remove useless attributes
-            for edge_col_to_drop in [
-                    "lanes",
-                    "junction",
-                    "ref",
-                    "bridge",
-                    "tunnel",
-                    "width",
-                    "access",
-                    "est_width",
-                    "reversed",
-                    "parking:right",
-                    "parking:left",
-                    "maxspeed",
-            ]:
-                if edge_col_to_drop in gdf_edges:
-                    gdf_edges = gdf_edges.drop(
-                        edge_col_to_drop,
-                        axis=1,
-                    )
-            for node_col_to_drop in [
-                "highway",
-                "ref",
-                "junction",
-                "railway",
-            ]:
-                if node_col_to_drop in gdf_nodes:
-                    gdf_nodes = gdf_nodes.drop(
-                        node_col_to_drop, axis=1
-                    )
-            G = ox.graph_from_gdfs(
-                gdf_nodes=gdf_nodes,
-                gdf_edges=gdf_edges,
-                graph_attrs=G.graph,
+            proximity = pd.concat(tiling.run_tiles(add_proximity_tile, cityname, tiles))
+            proximity = proximity.reindex(gdf_edges.index)
+            for col in proximity:
+                gdf_edges[col] = proximity[col].values
+        else:
+            # Projected geometries and the index of the roads are shared with the other stages
+            projected = spatial_index.get_layer(cityname, "features", gdf_simple)
+            tree, edges_projected = spatial_index.get_tree(cityname, "edges", gdf_edges)
+            gdf_edges = add_proximity(
+                gdf_edges, gdf_simple, edges_projected.values, projected.values, tree
             )
-            ox.save_graphml(G, outfolder + cityname + "_graph_2_dense.graphml")
-            ox.save_graph_geopackage(G, outfolder + cityname + "_graph_2_dense.gpkg")
+    return add_road_attributes(gdf_nodes, gdf_edges)
+
+
+def add_road_attributes(gdf_nodes, gdf_edges):
+    """Add the attributes of the roads and nodes depending only on their own tags."""
+    # Merge left and right parking into a single street parking attribute
+    if "parking:left" in gdf_edges:
+        left_parking = [
+            True if (not pd.isna(val) and val != "no") else False
+            for val in gdf_edges["parking:left"].values
+        ]
+    else:
+        left_parking = [False] * len(gdf_edges)
+    if "parking:right" in gdf_edges:
+        right_parking = [
+            True if (not pd.isna(val) and val != "no") else False
+            for val in gdf_edges["parking:right"].values
+        ]
+    else:
+        right_parking = [False] * len(gdf_edges)
+    gdf_edges["street_parking"] = [
+        left or right for left, right in zip(left_parking, right_parking)
+    ]
+    # Simplify highway type into numbered hierarchy
+    gdf_edges["hierarchy"] = gdf_edges["highway"]
+    gdf_edges["hierarchy"] = gdf_edges["hierarchy"].apply(
+        lambda x: x.removesuffix("_link")
+    )
+    gdf_edges["hierarchy"] = gdf_edges["hierarchy"].apply(
+        lambda x: HIGHWAY_DICT[x] if x in HIGHWAY_DICT else 8
+    )
+    # Some nodes from the road also have traffic signals or crossings
+    gdf_nodes["traffic_signals"] = [
+        True if (isinstance(val, str) and "traffic_signals" in val) else False
+        for val in gdf_nodes["highway"].values
+    ]
+    gdf_nodes["crossing"] = [
+        True if (isinstance(val, str) and "crossing" in val) else False
+        for val in gdf_nodes["highway"].values
+    ]
+    return gdf_nodes, gdf_edges
+
+
+def drop_useless_attributes(gdf_nodes, gdf_edges):
+    """Remove the attributes of the nodes and edges not needed by the next stages."""
+    gdf_nodes = gdf_nodes.drop(columns=[c for c in NODE_COLS_TO_DROP if c in gdf_nodes])
+    gdf_edges = gdf_edges.drop(columns=[c for c in EDGE_COLS_TO_DROP if c in gdf_edges])
+    return gdf_nodes, gdf_edges
+
+
+def process_graph(cityname, save_all=SAVE_GRAPH_ALL):
+    """Add amenities and simplified attributes to the graph of a city and save it."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    with step("load") as record:
+        gdf_nodes, gdf_edges = load_graph_tables(outfolder + cityname + "_graph_0_raw")
+        gdf_simple = table_cache.load(
+            gpd.read_file, outfolder + cityname + "_features_3_dense.gpkg"
+        )
+        record["rows_out"] = len(gdf_edges)
+    with step("attributes", rows=len(gdf_edges)):
+        gdf_nodes, gdf_edges = add_graph_attributes(
+            cityname, gdf_nodes, gdf_edges, gdf_simple
+        )
+    if save_all:
+        with step("save_all", rows=len(gdf_edges)):
+            save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_1_all")
+    gdf_nodes, gdf_edges = drop_useless_attributes(gdf_nodes, gdf_edges)
+    with step("save", rows=len(gdf_edges)):
+        save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_2_dense")
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+
+    for cityname in tqdm.tqdm(CITIES):
+        if stage_cache.is_stale("E", cityname):
+            print(cityname)
+            with instrumentation.task("E", cityname):
+                process_graph(cityname)
+            stage_cache.record("E", cityname)
+    instrumentation.save_report(name="E")
@@ -1,30 +1,117 @@
-"""Compute centrality metrics on the network for selected cities. Optional, as very slow."""
+"""Compute centrality metrics on the network for selected cities.
 
-import os
-import osmnx as ox
+Exact edge betweenness is very slow on large cities, so by default it is estimated
+from a sample of source nodes, with a sample size given or derived from an error
+bound. Estimates are scaled to the same normalisation as exact values. Local
+betweenness, with cutoffs, is always exact: igraph cannot combine cutoffs and
+sampled sources, and paths bounded by a cutoff are fast to compute.
+"""
+
+import math
 import tqdm
-import igraph as ig
 import numpy as np
-from B_get_graph_raw import FOLDERPATH_CITIES, CITIES
+from config import FOLDERPATH_CITIES, CITIES
+from betweenness import sharded_edge_betweenness
+from graph_io import get_edge_array, load_graph_tables, save_graph_tables
+from instrumentation import step
+
+APPROXIMATE = True  # Estimate betweenness from sampled source nodes instead of all nodes
+N_SAMPLES = None  # Number of sampled source nodes, if None derived from ERROR_BOUND
+# Maximal error, that holds for each edge with probability CONFIDENCE, on the fraction
+# of the shortest paths between ordered pairs of nodes going through the edge, which
+# is the betweenness divided by n_nodes * (n_nodes - 1). Saved values are divided by
+# n_edges * (n_edges - 1) as exact ones, so their error is at most ERROR_BOUND *
+# n_nodes * (n_nodes - 1) / (n_edges * (n_edges - 1)). Fractions of main roads are a
+# few percent, so 0.01, from about 15000 sources, is the coarsest useful bound
+ERROR_BOUND = 0.01
+CONFIDENCE = 0.9
+SEED = 0  # Seed of the sampling of source nodes, for reproducible estimates
+# Only consider paths shorter than a distance in meter or a time in second, for a local
+# betweenness, no cutoff if None
+CUTOFFS = {"length": None, "travel_time": None}
+# Processes computing betweenness, each on shards of source nodes, to raise when F runs
+# alone as the pipeline already runs one process per task
+N_WORKERS = 1
+
+
+def get_n_samples(n_nodes, error_bound=ERROR_BOUND, confidence=CONFIDENCE):
+    """Get the number of source nodes to sample for an error bound, from Hoeffding's inequality."""
+    n_samples = math.ceil(math.log(2 / (1 - confidence)) / (2 * error_bound**2))
+    return min(n_nodes, n_samples)
+
+
+def add_centrality(
+    gdf_nodes,
+    gdf_edges,
+    approximate=APPROXIMATE,
+    n_samples=N_SAMPLES,
+    cutoffs=CUTOFFS,
+    n_workers=N_WORKERS,
+    checkpoint_path=None,
+):
+    """Add edge betweenness centralities to the table of edges of a graph."""
+    # The graph is built from arrays in the order of the tables, so that metrics are
+    # columns of the table of edges as they are
+    n_nodes, n_edges = len(gdf_nodes), len(gdf_edges)
+    sources = None
+    local = any(cutoff is not None for cutoff in cutoffs.values())
+    if approximate and not local:
+        if n_samples is None:
+            n_samples = get_n_samples(n_nodes)
+        if n_samples < n_nodes:
+            rng = np.random.default_rng(SEED)
+            sources = np.sort(rng.choice(n_nodes, size=n_samples, replace=False)).tolist()
+    bet = sharded_edge_betweenness(
+        n_nodes,
+        get_edge_array(gdf_nodes, gdf_edges),
+        {
+            weight: gdf_edges[weight].to_numpy(dtype=np.float64)
+            for weight in ["length", "travel_time"]
+        },
+        sources=sources,
+        cutoffs=cutoffs,
+        n_workers=n_workers,
+        checkpoint_path=checkpoint_path,
+    )
+    # Each source contributes the same on average, scale the sums to all sources
+    scale = 1 if sources is None else n_nodes / len(sources)
+    gdf_edges["edge_betweenness_centrality_length"] = (
+        bet["length"] * scale / (n_edges * (n_edges - 1))
+    )
+    gdf_edges["edge_betweenness_centrality_time"] = (
+        bet["travel_time"] * scale / (n_edges * (n_edges - 1))
+    )
+    # Number of source nodes used, all of them for exact values
+    gdf_edges["edge_betweenness_n_sources"] = (
+        n_nodes if sources is None else len(sources)
+    )
+    return gdf_edges
+
+
+def compute_centrality(cityname):
+    """Compute edge betweenness centralities on the graph of a city and save it."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    with step("load") as record:
+        gdf_nodes, gdf_edges = load_graph_tables(outfolder + cityname + "_graph_2_dense")
+        record["rows_out"] = len(gdf_edges)
+    with step("betweenness", rows=len(gdf_edges)):
+        gdf_edges = add_centrality(
+            gdf_nodes,
+            gdf_edges,
+            checkpoint_path=outfolder + cityname + "_graph_3_metrics_checkpoint.npz",
+        )
+    with step("save", rows=len(gdf_edges)):
+        save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_3_metrics")
 
-RECOMPUTE = False
 
 if __name__ == "__main__":
-    #TODO add recompute
+    import instrumentation
+    import stage_cache
+
     for cityname in tqdm.tqdm(CITIES):
-        outfolder = FOLDERPATH_CITIES + cityname + "/"
-        if (os.path.exists(outfolder + cityname + "_graph_3_metrics.graphml") and RECOMPUTE) or (not os.path.exists(outfolder + cityname + "_graph_3_metrics.graphml")):
+        if stage_cache.is_stale("F", cityname):
             print(cityname)
-            G = ox.load_graphml(outfolder + cityname + "_graph_2_dense.graphml")
-            G_ig = ig.Graph.from_networkx(G)
-            bet_length = G_ig.edge_betweenness(directed=True, weights="length")
-            G_ig.es["edge_betweenness_centrality_length"] = np.array(bet_length) / (
-                len(G.edges) * (len(G.edges) - 1)
-            )
-            bet_time = G_ig.edge_betweenness(directed=True, weights="travel_time")
-            G_ig.es["edge_betweenness_centrality_time"] = np.array(bet_time) / (
-                len(G.edges) * (len(G.edges) - 1)
-            )
-            G = G_ig.to_networkx()
-            ox.save_graphml(G, outfolder + cityname + "_graph_3_metrics.graphml")
-            ox.save_graph_geopackage(G, outfolder + cityname + "_graph_3_metrics.gpkg")
\ No newline at end of file
+            with instrumentation.task("F", cityname):
+                compute_centrality(cityname)
+            stage_cache.record("F", cityname)
+    instrumentation.save_report(name="F")
@@ -1,76 +1,215 @@
 """Merge graphs and features for selected cities."""
 
+import functools
 import os
 import geopandas as gpd
-import osmnx as ox
+import numpy as np
+import pyarrow.parquet as pq
+import pyogrio
 import tqdm
 import pandas as pd
-from B_get_graph_raw import FOLDERPATH_CITIES, CITIES
+from config import FOLDERPATH_CITIES, CITIES
+from graph_io import iter_table, load_table
+from instrumentation import step
 import shapely
+import geometry_dedup
+import tiling
+import table_cache
 
 # Can be eitehr from script E (2_dense) or F (3_metrics)
-SUFFIX_GRAPH = "2_dense"
-RECOMPUTE = False
+SUFFIX_GRAPH = "3_metrics"
+HALO_NODES = 1  # Halo in meter of the tiles to find the nodes on feature points
+LAYERS_MERGED = ["features", "roads", "nodes"]  # Layers of the merged file, by origin
+CHUNK_SIZE = 100000  # Number of rows written at once in the merged file
+
+
+def find_node_features(gdf_simple, gdf_nodes):
+    """Get the osmid of the feature points on a node of the graph, at the same coordinates."""
+    is_point = gdf_simple.geometry.apply(
+        lambda x: True if isinstance(x, shapely.Point) else False
+    ).values
+    point_pos = np.flatnonzero(is_point)
+    point_ind = geometry_dedup.find_equal(
+        gdf_simple.geometry.values[point_pos], gdf_nodes.geometry.values
+    )
+    return gdf_simple["osmid"].values[point_pos[point_ind]]
+
+
+def find_node_features_tile(cityname, fids, bbox):
+    """Get the osmid of the feature points of a tile on a node, reading only the data around."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    gdf_simple = gpd.read_file(
+        outfolder + cityname + "_features_3_dense.gpkg", bbox=bbox, fid_as_index=True
+    )
+    gdf_simple = gdf_simple[gdf_simple.index.isin(fids)]
+    # Nodes keep the geometry of the raw graph in the next graphs
+    gdf_nodes = load_table(
+        outfolder + cityname + "_graph_0_raw_nodes.parquet", columns=[], bbox=bbox
+    )
+    return find_node_features(gdf_simple, gdf_nodes)
+
+
+def merge_tables(cityname, get_nodes, get_edges, gdf_simple):
+    """Merge the tables of nodes and edges of a graph and the features into a table per origin.
+
+    get_nodes and get_edges iterate over the tables of nodes and edges in batches of
+    rows, as graph_io.iter_table, with only some columns if given, nodes being iterated
+    over twice. Tables are yielded one batch after the other as (layer, table), so
+    that only the features and a batch of roads or nodes are in memory at once.
+    """
+    # Find nodes that are both in the amenities and the street network to remove them
+    if cityname in tiling.TILED_CITIES:
+        tiles = tiling.get_tiles(
+            cityname,
+            FOLDERPATH_CITIES + cityname + "/" + cityname + "_features_3_dense.gpkg",
+            HALO_NODES,
+        )
+        duplicates = tiling.run_tiles(find_node_features_tile, cityname, tiles)
+        node_index = [nodes.index for nodes in get_nodes(columns=[])]
+    else:
+        duplicates, node_index = [], []
+        for nodes in get_nodes(columns=[]):
+            duplicates.append(find_node_features(gdf_simple, nodes))
+            node_index.append(nodes.index)
+    duplicates = np.concatenate(duplicates)
+    node_osmids = pd.Index(["N" + str(x) for ind in node_index for x in ind], name="osmid")
+    duplicates = duplicates[pd.Index(duplicates).isin(node_osmids)]
+    del node_osmids
+    # Get origin for all kind of geodata to join them all
+    gdf_simple_curated = gdf_simple.set_index("osmid")
+    gdf_simple_curated["origin"] = "features"
+    # Features that are also nodes of the street network
+    gdf_simple_curated["on_node"] = gdf_simple_curated.index.isin(duplicates)
+    # Remove duplicate features having the same geometry and type
+    same = geometry_dedup.find_exact_duplicates(
+        gdf_simple_curated.geometry.values, gdf_simple_curated["type"].values
+    )
+    gdf_simple_curated = gdf_simple_curated.iloc[
+        np.setdiff1d(np.arange(len(gdf_simple_curated)), same)
+    ]
+    yield "features", _join_lists(gdf_simple_curated.reset_index())
+    del gdf_simple_curated
+    for hedges in get_edges():
+        gdf_edges_simplified = hedges.reset_index()
+        # Homogeneize osmid between amenities and roads, joining the ways of a road
+        gdf_edges_simplified["osmid"] = hedges["osmid"].apply(
+            lambda x: "W" + str(x)
+            if not isinstance(x, list)
+            else ";".join(["W" + str(val) for val in x])
+        ).values
+        gdf_edges_simplified["origin"] = "road"
+        yield "roads", _join_lists(gdf_edges_simplified)
+    for hnodes in get_nodes():
+        gdf_nodes_simplified = hnodes.set_axis(
+            pd.Index(["N" + str(x) for x in hnodes.index], name="osmid")
+        )
+        gdf_nodes_simplified["origin"] = "node"
+        gdf_nodes_simplified_curated = gdf_nodes_simplified[
+            ~gdf_nodes_simplified.index.isin(duplicates)
+        ]
+        # Keep only nodes not already in amenities and that are intersections
+        gdf_nodes_simplified_curated = gdf_nodes_simplified_curated[
+            gdf_nodes_simplified_curated["intersection"].values.astype(bool)
+        ]
+        gdf_nodes_simplified_curated["type"] = "intersection"
+        yield "nodes", _join_lists(gdf_nodes_simplified_curated.reset_index())
+
+
+def _join_lists(gdf):
+    """Join the lists of the object columns into strings, GeoPackage having no list type."""
+    for col in gdf.columns:
+        if col == gdf.geometry.name or gdf[col].dtype != object:
+            continue
+        is_list = gdf[col].apply(lambda x: isinstance(x, list))
+        if is_list.any():
+            gdf[col] = gdf[col].where(
+                ~is_list, gdf[col][is_list].apply(lambda x: ";".join(map(str, x)))
+            )
+    return gdf
+
+
+def write_merged(layers, filepath, chunk_size=CHUNK_SIZE):
+    """Write each origin of the merged data as a layer of a GeoPackage, chunk by chunk.
+
+    layers are (layer, table) pairs, the tables of the same layer being appended to
+    it. Layers take any geometry type, their chunks having different ones. Returns
+    the number of rows written.
+    """
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    n_rows = 0
+    written = set()
+    for layer, gdf in layers:
+        if len(gdf) == 0 and layer in written:
+            continue
+        for start in range(0, max(len(gdf), 1), chunk_size):
+            pyogrio.write_dataframe(
+                gdf.iloc[start : start + chunk_size],
+                filepath,
+                layer=layer,
+                append=layer in written,
+                use_arrow=True,
+                geometry_type="Unknown",
+                promote_to_multi=False,
+            )
+            written.add(layer)
+        n_rows += len(gdf)
+    return n_rows
+
+
+def load_merged(filepath, single_table=False):
+    """Load the layers of the merged data, concatenated into a single table if asked."""
+    layers = {
+        layer: gpd.read_file(filepath, layer=layer) for layer in LAYERS_MERGED
+    }
+    if single_table:
+        return pd.concat(layers.values(), ignore_index=True)
+    return layers
+
+
+def merge_graph_features(cityname, chunk_size=CHUNK_SIZE):
+    """Merge the graph and the features of a city into a single file.
+
+    Roads and nodes are read in batches of chunk_size rows, only the features being
+    loaded whole.
+    """
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    filepath = outfolder + cityname + "_graph_" + SUFFIX_GRAPH
+    with step("load") as record:
+        gdf_simple = table_cache.load(
+            gpd.read_file, outfolder + cityname + "_features_3_dense.gpkg"
+        )
+        record["rows_out"] = len(gdf_simple)
+    n_rows = len(gdf_simple) + sum(
+        pq.read_metadata(filepath + suffix).num_rows
+        for suffix in ["_nodes.parquet", "_edges.parquet"]
+    )
+    # Roads and nodes are read, merged and saved batch by batch, so it is a single step
+    with step("merge_save", rows=n_rows) as record:
+        record["rows_out"] = write_merged(
+            merge_tables(
+                cityname,
+                functools.partial(
+                    iter_table, filepath + "_nodes.parquet", batch_size=chunk_size
+                ),
+                functools.partial(
+                    iter_table, filepath + "_edges.parquet", batch_size=chunk_size
+                ),
+                gdf_simple,
+            ),
+            outfolder + cityname + "_all.gpkg",
+            chunk_size,
+        )
 
 
 if __name__ == "__main__":
-    #TODO add recompute
+    import instrumentation
+    import stage_cache
+
     for cityname in tqdm.tqdm(CITIES):
-        outfolder = FOLDERPATH_CITIES + cityname + "/"
-        if (os.path.exists(outfolder + cityname + "_all.gpkg") and RECOMPUTE) or (not os.path.exists(outfolder + cityname + "_all.gpkg")):
+        if stage_cache.is_stale("G", cityname):
             print(cityname)
-            G = ox.load_graphml(outfolder + cityname + "_graph_" + SUFFIX_GRAPH + ".graphml")
-            gdf_nodes, gdf_edges = ox.graph_to_gdfs(G, nodes=True, edges=True)
-            gdf_simple = gpd.read_file(outfolder + cityname + "_features_3_dense.gpkg")
-            gdf_simple = gdf_simple.set_index("osmid")
-            hnodes, hedges = ox.graph_to_gdfs(G)
-            gdf_edges_simplified = hedges.copy()
-            # Homogeneize osmid between amenities and roads
-            gdf_edges_simplified["osmid"] = hedges["osmid"].apply(
-                lambda x: "W" + str(x)
-                if not isinstance(x, list)
-                else ["W" + str(val) for val in x]
-            )
-            gdf_edges_simplified = hedges.set_index(keys="osmid")
-            # gdf_edges_simplified = gdf_edges_simplified.drop("_igraph_index", axis=1)
-            gdf_nodes_simplified = hnodes.copy()
-            gdf_nodes_simplified.index = ["N" + str(x) for x in gdf_nodes_simplified.index]
-            # gdf_nodes_simplified = gdf_nodes_simplified.drop("_igraph_index", axis=1)
-            # Get origin for all kind of geodata to join them all
-            gdf_edges_simplified["origin"] = "road"
-            gdf_nodes_simplified["origin"] = "node"
-            gdf_simple["origin"] = "features"
-            # Find nodes that are both in the amenities and the street network to remove them
-            nf = gpd.sjoin(
-                gdf_simple[
-                    gdf_simple.geometry.apply(
-                        lambda x: True if isinstance(x, shapely.Point) else False
-                    )
-                ],
-                gdf_nodes_simplified,
-                how="left",
-                predicate="intersects",
-            )
-            duplicates = nf[pd.notna(nf["origin_right"])].index.values
-            indlist = list(gdf_nodes_simplified.index)
-            duplicates = [val for val in duplicates if val in indlist]
-            gdf_nodes_simplified_curated = gdf_nodes_simplified.drop(duplicates, axis=0)
-            # Keep only nodes not already in amenities and that are intersections
-            gdf_nodes_simplified_curated = gdf_nodes_simplified_curated[
-                [bool(val) for val in gdf_nodes_simplified_curated["intersection"].values]
-            ]
-            gdf_nodes_simplified_curated["type"] = "intersection"
-            gdf_simple_curated = gdf_simple.copy()
-            gdf_simple_curated["origin"] = [
-                [row["origin"], "node"] if ind in duplicates else row["origin"]
-                for ind, row in gdf_simple_curated.iterrows()
-            ]
-            # Remove duplicate features having the same geometry and type
-            gdf_simple_curated = gdf_simple_curated.drop_duplicates(
-                subset=["geometry", "type"], keep="first"
-            )
-            # Join roads, intersections, and amenities into a single file
-            joined = pd.concat(
-                [gdf_simple_curated, gdf_edges_simplified, gdf_nodes_simplified_curated]
-            )
-            joined.to_file(outfolder + cityname + "_all.gpkg")
+            with instrumentation.task("G", cityname):
+                merge_graph_features(cityname)
+            stage_cache.record("G", cityname)
+    instrumentation.save_report(name="G")
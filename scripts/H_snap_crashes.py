@@ -0,0 +1,198 @@
+"""Snap crash records to the street network for selected cities.
+
+Crash files, in CSV or Parquet, are read in chunks snapped in parallel workers
+that each build the spatial indexes of the city once: each crash gets its nearest
+road and intersection within a maximal distance, with the attributes of the road.
+Columns of the snapped road and intersection are prefixed with edge_ and node_,
+not to overlap the columns of the crash files. Snapped chunks are written as they
+come, and crashes are counted per road.
+"""
+
+import glob
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import tqdm
+from pyproj import Transformer
+from config import FOLDERPATH_CITIES, CITIES
+from graph_io import load_table
+from instrumentation import step
+import spatial_index
+
+FOLDERPATH_CRASHES = "./data/raw/crashes/"  # Crash files of a city in a folder named after it
+COORDINATE_COLUMNS = ["longitude", "latitude"]  # Columns of the coordinates of the crashes
+CRASHES_CRS = "EPSG:4326"  # CRS of the coordinates of the crashes
+CHUNK_SIZE = 200000  # Number of crashes snapped at once by a worker
+MAX_DISTANCE_EDGE = 30  # Distance in meter up to which a crash is snapped to a road
+MAX_DISTANCE_NODE = 30  # Distance in meter up to which a crash is snapped to an intersection
+EDGE_ATTRIBUTES = [  # Attributes of the roads given to the crashes snapped to them
+    "hierarchy",
+    "street_parking",
+    "near_parking",
+    "near_park",
+    "near_square",
+]
+N_WORKERS = os.cpu_count()
+
+_city = {}  # Tables and STRtrees of the city of a worker, loaded once for all its chunks
+
+
+def _init_worker(cityname):
+    """Load the roads and intersections of a city and their STRtrees in a worker."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    gdf_edges = load_table(
+        outfolder + cityname + "_graph_2_dense_edges.parquet", columns=EDGE_ATTRIBUTES
+    )
+    gdf_nodes = load_table(
+        outfolder + cityname + "_graph_2_dense_nodes.parquet", columns=["intersection"]
+    )
+    # Projected geometries and the index of the roads are shared with the other stages
+    edge_tree, _ = spatial_index.get_tree(cityname, "edges", gdf_edges)
+    nodes_projected = spatial_index.get_layer(cityname, "nodes", gdf_nodes)
+    is_intersection = gdf_nodes["intersection"].values.astype(bool)
+    _city.update(
+        # Nullable types, for the same types in every chunk when a road is missing
+        edges=gdf_edges.drop(columns="geometry")
+        .reset_index()
+        .convert_dtypes()
+        .add_prefix("edge_"),
+        edge_tree=edge_tree,
+        nodes=pd.Series(gdf_nodes.index.values[is_intersection], dtype="Int64"),
+        node_tree=shapely.STRtree(nodes_projected.values[is_intersection]),
+        transformer=Transformer.from_crs(
+            CRASHES_CRS, spatial_index.get_city_crs(cityname), always_xy=True
+        ),
+    )
+
+
+def snap_chunk(chunk):
+    """Snap a chunk of crashes to their nearest road and intersection.
+
+    Returns the chunk with the snapped road, its attributes and the distance to it,
+    the snapped intersection and the distance to it, and the positions of the roads.
+    """
+    x, y = _city["transformer"].transform(
+        chunk[COORDINATE_COLUMNS[0]].to_numpy(dtype=np.float64),
+        chunk[COORDINATE_COLUMNS[1]].to_numpy(dtype=np.float64),
+    )
+    points = shapely.points(x, y)
+    edge_pos = np.full(len(chunk), -1)
+    edge_dist = np.full(len(chunk), np.nan)
+    (ind, nearest), dist = _city["edge_tree"].query_nearest(
+        points, max_distance=MAX_DISTANCE_EDGE, return_distance=True, all_matches=False
+    )
+    edge_pos[ind], edge_dist[ind] = nearest, dist
+    node_pos = np.full(len(chunk), -1)
+    node_dist = np.full(len(chunk), np.nan)
+    (ind, nearest), dist = _city["node_tree"].query_nearest(
+        points, max_distance=MAX_DISTANCE_NODE, return_distance=True, all_matches=False
+    )
+    node_pos[ind], node_dist[ind] = nearest, dist
+    # Crashes too far from any road or intersection get missing values
+    snapped = np.flatnonzero(edge_pos >= 0)
+    edges = _city["edges"].iloc[edge_pos[snapped]].set_axis(snapped)
+    chunk = chunk.reset_index(drop=True).join(edges)
+    chunk["edge_distance"] = edge_dist
+    snapped = np.flatnonzero(node_pos >= 0)
+    chunk["node_osmid"] = _city["nodes"].iloc[node_pos[snapped]].set_axis(snapped)
+    chunk["node_distance"] = node_dist
+    return chunk, edge_pos
+
+
+def read_chunks(filepaths, chunk_size=CHUNK_SIZE):
+    """Read crash files in chunks of rows, CSV or Parquet.
+
+    Types of CSV columns are fixed before reading the chunks, all of them written
+    with the types of the first one: coordinates are floats and other columns text,
+    as a column empty in a chunk would otherwise be read as float.
+    """
+    for filepath in filepaths:
+        if filepath.endswith(".parquet"):
+            for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+        else:
+            columns = pd.read_csv(filepath, nrows=0).columns
+            dtype = {
+                col: "float64" if col in COORDINATE_COLUMNS else "string" for col in columns
+            }
+            yield from pd.read_csv(filepath, chunksize=chunk_size, dtype=dtype)
+
+
+def get_crash_files(cityname):
+    """Get the crash files of a city, e.g. one per year."""
+    return sorted(
+        glob.glob(FOLDERPATH_CRASHES + cityname + "/*.csv")
+        + glob.glob(FOLDERPATH_CRASHES + cityname + "/*.parquet")
+    )
+
+
+def snap_crashes(cityname, n_workers=N_WORKERS, chunk_size=CHUNK_SIZE):
+    """Snap the crashes of a city to its street network and count them per road."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    edge_index = load_table(
+        outfolder + cityname + "_graph_2_dense_edges.parquet", columns=[]
+    ).index
+    counts = np.zeros(len(edge_index), dtype=np.int64)
+    writer = None
+    n_rows = 0
+
+    def write(chunk, edge_pos):
+        nonlocal writer, n_rows
+        n_rows += len(chunk)
+        table = pa.Table.from_pandas(
+            chunk, schema=writer.schema if writer else None, preserve_index=False
+        )
+        if writer is None:
+            writer = pq.ParquetWriter(
+                outfolder + cityname + "_crashes_snapped.parquet", table.schema
+            )
+        writer.write_table(table)
+        counts[:] += np.bincount(edge_pos[edge_pos >= 0], minlength=len(counts))
+
+    chunks = read_chunks(get_crash_files(cityname), chunk_size)
+    # Reading, snapping and writing overlap, so they are a single step
+    with step("snap") as record:
+        if n_workers == 1:
+            _init_worker(cityname)
+            for chunk in chunks:
+                write(*snap_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(cityname,),
+            ) as executor:
+                # Bound the chunks in memory, written in the order they were read
+                pending = deque()
+                for chunk in chunks:
+                    if len(pending) == 2 * n_workers:
+                        write(*pending.popleft().result())
+                    pending.append(executor.submit(snap_chunk, chunk))
+                while pending:
+                    write(*pending.popleft().result())
+        if writer is not None:
+            writer.close()
+        record["rows"] = record["rows_out"] = n_rows
+    pd.DataFrame({"n_crashes": counts}, index=edge_index).to_parquet(
+        outfolder + cityname + "_crash_counts.parquet"
+    )
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+
+    for cityname in tqdm.tqdm(CITIES):
+        if get_crash_files(cityname) and stage_cache.is_stale("H", cityname):
+            print(cityname)
+            with instrumentation.task("H", cityname):
+                snap_crashes(cityname)
+            stage_cache.record("H", cityname)
+    instrumentation.save_report(name="H")
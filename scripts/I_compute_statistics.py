@@ -0,0 +1,212 @@
+"""Compute statistics of the streets and amenities of selected cities.
+
+Each city gets partial aggregates saved in its folder: the area of its boundary,
+and the length and number of roads and the number of amenities summed over the
+groups of values of some columns, like the length of roads by hierarchy. Only
+the columns a partial needs are read, and lengths are computed from coordinates
+projected as arrays, in the projected CRS of the city. A partial is computed
+again only if its source file, its columns or this code changed, so adding a
+partial does not read the data of the others. Cities are computed in parallel,
+then the general statistics of all cities are derived from their partials.
+"""
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+import tqdm
+from pyproj import Transformer
+from config import FOLDERPATH_CITIES, FOLDERPATH_POLY, CITIES
+from graph_io import load_table
+from instrumentation import step
+from stage_cache import hash_file
+import spatial_index
+
+PARTIALS = {  # Partial aggregates of each city, from a layer, summed by the groups of columns
+    "area": ("boundary", []),
+    "roads": ("edges", []),
+    "hierarchy": ("edges", ["hierarchy"]),
+    "infrastructure": ("edges", ["pedestrian_infrastructure", "cycling_infrastructure"]),
+    "street_parking": ("edges", ["street_parking"]),
+    "near": ("edges", ["near_parking", "near_park", "near_square"]),
+    "amenities": ("features", ["type"]),
+}
+LAYERS = {  # Source file of each layer, and its values summed in the partial aggregates
+    "boundary": (FOLDERPATH_POLY + "{city}.gpkg", ["area_km2"]),
+    "edges": (FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_edges.parquet", ["length_km", "n_edges"]),
+    "features": (FOLDERPATH_CITIES + "{city}/{city}_features_3_dense.gpkg", ["n_amenities"]),
+}
+GENERAL_STATISTICS = {  # Columns of the general statistics: partial, selected groups, value, decimals
+    "Area (km2)": ("area", {}, "area_km2", 1),
+    "Number of edges": ("roads", {}, "n_edges", 0),
+    "Total road length (km)": ("roads", {}, "length_km", 0),
+    "Pedestrian road length (km)": (
+        "infrastructure",
+        {"pedestrian_infrastructure": True},
+        "length_km",
+        0,
+    ),
+    "Cycling road length (km)": ("infrastructure", {"cycling_infrastructure": True}, "length_km", 0),
+    "Number of shops": ("amenities", {"type": "shop"}, "n_amenities", 0),
+    "Number of crossings": ("amenities", {"type": "crossing"}, "n_amenities", 0),
+    "Number of traffic signals": ("amenities", {"type": "traffic_signals"}, "n_amenities", 0),
+}
+FILEPATH_STATISTICS = FOLDERPATH_CITIES + "general_statistics.csv"
+FOLDERPATH_PARTIALS = FOLDERPATH_CITIES + "statistics/"  # Partials of all cities, one file per partial
+N_WORKERS = os.cpu_count()
+
+
+def _get_path(cityname):
+    """Get the path of the partial aggregates of a city."""
+    return FOLDERPATH_CITIES + cityname + "/" + cityname + "_statistics.json"
+
+
+def get_lengths(geometries, crs):
+    """Get the lengths of linestrings in the unit of a projected CRS.
+
+    Coordinates are projected as arrays and the lengths of the segments summed per
+    linestring, without projecting the geometries themselves.
+    """
+    coords, index = shapely.get_coordinates(geometries.values, return_index=True)
+    transformer = Transformer.from_crs(geometries.crs, crs, always_xy=True)
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    # Segments join consecutive coordinates of the same linestring
+    same = index[1:] == index[:-1]
+    segments = np.hypot(np.diff(x), np.diff(y))[same]
+    return np.bincount(index[1:][same], weights=segments, minlength=len(geometries))
+
+
+def load_values(cityname, layer, columns):
+    """Load the columns of a layer of a city with the values summed for its partials."""
+    filepath = LAYERS[layer][0].format(city=cityname)
+    if layer == "boundary":
+        gdf = gpd.read_file(filepath)
+        crs = spatial_index.get_city_crs(cityname)
+        transformer = Transformer.from_crs(gdf.crs, crs, always_xy=True)
+        projected = shapely.transform(
+            gdf.geometry.values,
+            lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1])),
+        )
+        return gdf[columns].assign(area_km2=shapely.area(projected) / 1e6)
+    if layer == "edges":
+        gdf = load_table(filepath, columns=columns)
+        lengths = get_lengths(gdf.geometry, spatial_index.get_city_crs(cityname))
+        return pd.DataFrame(gdf[columns]).assign(length_km=lengths / 1000, n_edges=1)
+    df = pyogrio.read_dataframe(filepath, columns=columns, read_geometry=False)
+    return df.assign(n_amenities=1)
+
+
+def aggregate(df, columns, values):
+    """Sum the values over the groups of values of the columns, missing ones included."""
+    if not columns:
+        return pd.DataFrame({value: [df[value].sum()] for value in values})
+    return df.groupby(columns, dropna=False)[values].sum().reset_index()
+
+
+def compute_statistics(cityname, partials=PARTIALS):
+    """Compute the outdated partial aggregates of a city and save them all."""
+    filepath = _get_path(cityname)
+    known = {}
+    if os.path.exists(filepath):
+        with open(filepath) as f:
+            known = json.load(f)
+    code = hash_file(__file__)[2]
+    sources = {
+        layer: hash_file(
+            LAYERS[layer][0].format(city=cityname), known.get("sources", {}).get(layer)
+        )
+        for layer in {layer for layer, _ in partials.values()}
+    }
+    keys = {
+        name: [sources[layer][2], columns, code] for name, (layer, columns) in partials.items()
+    }
+    results = {
+        name: known["partials"][name]
+        for name in partials
+        if known.get("partials", {}).get(name, {}).get("key") == keys[name]
+    }
+    # Each layer is read once, with the columns of all its outdated partials
+    for layer in sorted({partials[name][0] for name in partials if name not in results}):
+        names = [name for name in partials if name not in results and partials[name][0] == layer]
+        columns = sorted({col for name in names for col in partials[name][1]})
+        with step("aggregate_" + layer) as record:
+            df = load_values(cityname, layer, columns)
+            record["rows"] = len(df)
+            for name in names:
+                table = aggregate(df, partials[name][1], LAYERS[layer][1])
+                results[name] = {
+                    "key": keys[name],
+                    "table": json.loads(table.to_json(orient="split", index=False)),
+                }
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath + ".tmp", "w") as f:
+        json.dump({"sources": sources, "partials": results}, f)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def load_partials(cityname):
+    """Load the partial aggregates of a city as tables, by name."""
+    with open(_get_path(cityname)) as f:
+        partials = json.load(f)["partials"]
+    return {
+        name: pd.DataFrame(val["table"]["data"], columns=val["table"]["columns"])
+        for name, val in partials.items()
+    }
+
+
+def get_partial(name, cities=CITIES):
+    """Get a partial aggregate of the cities in a single table, with their names."""
+    return pd.concat(
+        [load_partials(cityname)[name].assign(Cityname=cityname) for cityname in cities],
+        ignore_index=True,
+    )
+
+
+def get_general_statistics(cities=CITIES, statistics=GENERAL_STATISTICS):
+    """Get the general statistics of the cities from their partial aggregates."""
+    rows = []
+    for cityname in cities:
+        partials = load_partials(cityname)
+        row = {"Cityname": cityname}
+        for col, (name, groups, value, decimals) in statistics.items():
+            table = partials[name]
+            mask = np.ones(len(table), dtype=bool)
+            for group_col, group_val in groups.items():
+                mask &= (table[group_col] == group_val).values
+            total = table.loc[mask, value].sum()
+            row[col] = round(total, decimals) if decimals else round(total)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def save_statistics(cities=CITIES):
+    """Save the general statistics of the cities, and each partial aggregate of all of them."""
+    get_general_statistics(cities).to_csv(FILEPATH_STATISTICS)
+    os.makedirs(FOLDERPATH_PARTIALS, exist_ok=True)
+    for name in PARTIALS:
+        get_partial(name, cities).to_csv(FOLDERPATH_PARTIALS + name + ".csv", index=False)
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+    from run_pipeline import run_task
+
+    cities = [cityname for cityname in CITIES if stage_cache.is_stale("I", cityname)]
+    records = []
+    with ProcessPoolExecutor(
+        max_workers=N_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        results = executor.map(run_task, ["I"] * len(cities), cities)
+        for cityname, (_, error, steps) in tqdm.tqdm(zip(cities, results), total=len(cities)):
+            print(cityname)
+            records.extend(steps)
+            if error:
+                print(error)
+    instrumentation.save_report(records, name="I")
+    save_statistics([cityname for cityname in CITIES if os.path.exists(_get_path(cityname))])
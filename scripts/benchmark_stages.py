@@ -0,0 +1,307 @@
+"""Benchmark the stages D to G on synthetic cities of several sizes, offline.
+
+A synthetic city is a jittered grid of streets, with some segments removed, whose
+nodes and edges have the attributes given by B, and amenities shaped like the raw
+features of C, saved as the files the stages read. Each stage runs in a fresh
+process so that its peak memory is its own. Time, throughput and peak memory are
+compared with saved baselines, and the run fails if a stage regressed.
+"""
+
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from config import FOLDERPATH_CITIES, FOLDERPATH_POLY
+from graph_io import save_graph_tables
+from spatial_index import FOLDERNAME_INDEX
+from stages import STAGES
+
+SCALES = [10000, 100000, 1000000]  # Approximate number of edges of the synthetic cities
+STAGES_BENCHMARKED = ["D", "E", "F", "G"]
+FOLDERPATH_BENCHMARK = "./data/benchmark/"  # Folder where the stages run on the synthetic cities
+FILEPATH_BASELINES = FOLDERPATH_BENCHMARK + "baselines.json"
+UPDATE_BASELINES = False  # Save the results as the new baselines instead of comparing them
+TOLERANCE_TIME = 1.25  # Ratio to the baseline time above which a stage regressed
+TOLERANCE_MEMORY = 1.15  # Ratio to the baseline peak memory above which a stage regressed
+SEED = 0
+ORIGIN = (24.1, 56.95)  # Lon/lat of the south-west corner of the synthetic cities
+SPACING = 100  # Distance in meter between two neighbouring nodes of the grid
+REMOVED_SEGMENTS = 0.1  # Fraction of the segments of the grid removed
+FEATURES_PER_EDGE = 0.05  # Number of amenities of the synthetic cities per edge
+HIGHWAY_WEIGHTS = {  # Highway values of the synthetic streets and their frequency
+    "primary": 0.05,
+    "secondary": 0.1,
+    "tertiary": 0.15,
+    "residential": 0.45,
+    "service": 0.1,
+    "cycleway": 0.05,
+    "footway": 0.1,
+}
+AMENITY_TAGS = {  # Tag and value of each kind of synthetic amenity, and its frequency
+    "shop": ("shop", "bakery", 0.2),
+    "bicycle_parking": ("amenity", "bicycle_parking", 0.15),
+    "bus_stop": ("highway", "bus_stop", 0.15),
+    "street_lamp": ("highway", "street_lamp", 0.2),
+    "parking": ("amenity", "parking", 0.15),
+    "park": ("leisure", "park", 0.1),
+    "square": ("place", "square", 0.05),
+}
+POLYGON_AMENITIES = ["parking", "park", "square"]
+DUPLICATED_POINTS = 0.2  # Fraction of the point amenities also mapped as a linestring
+
+
+def get_cityname(n_edges):
+    """Get the name of the synthetic city with a number of edges."""
+    return "synthetic_" + str(n_edges)
+
+
+def make_graph(n_edges, rng):
+    """Make the tables of nodes and edges of a grid of streets, as saved by B."""
+    side = int(np.ceil(np.sqrt(n_edges / (4 * (1 - REMOVED_SEGMENTS))))) + 1
+    row, col = np.divmod(np.arange(side * side), side)
+    dlat = SPACING / 111320
+    dlon = dlat / np.cos(np.radians(ORIGIN[1]))
+    x = ORIGIN[0] + (col + rng.uniform(-0.2, 0.2, side * side)) * dlon
+    y = ORIGIN[1] + (row + rng.uniform(-0.2, 0.2, side * side)) * dlat
+    # Segments between horizontal then vertical neighbours, each in both directions
+    ids = np.arange(side * side).reshape(side, side)
+    segments = np.concatenate(
+        [
+            np.column_stack([ids[:, :-1].ravel(), ids[:, 1:].ravel()]),
+            np.column_stack([ids[:-1, :].ravel(), ids[1:, :].ravel()]),
+        ]
+    )
+    segments = segments[rng.random(len(segments)) >= REMOVED_SEGMENTS]
+    street_count = np.bincount(segments.ravel(), minlength=side * side)
+    kept = street_count > 0
+    highway = rng.choice(
+        [None, "traffic_signals", "crossing"], size=side * side, p=[0.9, 0.05, 0.05]
+    )
+    gdf_nodes = gpd.GeoDataFrame(
+        {
+            "y": y,
+            "x": x,
+            "street_count": street_count,
+            "intersection": street_count >= 3,
+            "highway": highway,
+        },
+        geometry=gpd.points_from_xy(x, y),
+        index=pd.Index(np.arange(side * side), name="osmid"),
+        crs="EPSG:4326",
+    )[kept]
+    n_segments = len(segments)
+    seg_highway = rng.choice(
+        list(HIGHWAY_WEIGHTS), size=n_segments, p=list(HIGHWAY_WEIGHTS.values())
+    )
+    seg_cycleway = rng.choice([None, "lane", "no"], size=n_segments, p=[0.85, 0.1, 0.05])
+    seg_parking = rng.choice([None, "lane", "no"], size=(2, n_segments), p=[0.7, 0.2, 0.1])
+    seg_length = np.hypot(
+        (x[segments[:, 1]] - x[segments[:, 0]]) / dlon,
+        (y[segments[:, 1]] - y[segments[:, 0]]) / dlat,
+    ) * SPACING
+    speed = (
+        pd.Series(seg_highway)
+        .map({"primary": 50, "secondary": 50, "tertiary": 30, "residential": 30})
+        .fillna(20)
+        .to_numpy()
+        .astype(int)
+    )
+    # Edges in both directions have the attributes of their segment
+    u = np.concatenate([segments[:, 0], segments[:, 1]])
+    v = np.concatenate([segments[:, 1], segments[:, 0]])
+    length = np.tile(seg_length, 2)
+    speed_kph = np.tile(speed, 2)
+    highway = np.tile(seg_highway, 2)
+    cycleway = np.tile(seg_cycleway, 2)
+    gdf_edges = gpd.GeoDataFrame(
+        {
+            "osmid": np.tile(np.arange(n_segments), 2),
+            "highway": highway,
+            "cycleway": cycleway,
+            "oneway": False,
+            "reversed": np.repeat([False, True], n_segments),
+            "length": length,
+            "parking:left": np.concatenate([seg_parking[0], seg_parking[1]]),
+            "parking:right": np.concatenate([seg_parking[1], seg_parking[0]]),
+            "cycling_infrastructure": (highway == "cycleway")
+            | (pd.notna(cycleway) & (cycleway != "no")),
+            "pedestrian_infrastructure": highway == "footway",
+            "speed_kph": speed_kph,
+            "travel_time": length / (speed_kph / 3.6),
+            "maxspeed": None,
+        },
+        geometry=shapely.linestrings(
+            np.stack(
+                [np.column_stack([x[u], y[u]]), np.column_stack([x[v], y[v]])], axis=1
+            )
+        ),
+        index=pd.MultiIndex.from_arrays(
+            [u, v, np.zeros(len(u), dtype=int)], names=["u", "v", "key"]
+        ),
+        crs="EPSG:4326",
+    )
+    return gdf_nodes, gdf_edges
+
+
+def make_features(gdf_nodes, n_features, rng):
+    """Make raw amenities around the nodes of a graph, as saved by C.
+
+    Crossings and traffic signals are on the nodes tagged with them, other
+    amenities are points or polygons near random nodes, and some points are
+    duplicated as linestrings, as D expects from OpenStreetMap.
+    """
+    tagged = gdf_nodes[gdf_nodes["highway"].notna()]
+    kinds = rng.choice(
+        list(AMENITY_TAGS),
+        size=n_features,
+        p=[weight for _, _, weight in AMENITY_TAGS.values()],
+    )
+    near = gdf_nodes.iloc[rng.integers(0, len(gdf_nodes), n_features)]
+    offset = SPACING / 111320 * rng.uniform(0.1, 0.4, (2, n_features))
+    x, y = near["x"].values + offset[0], near["y"].values + offset[1]
+    size = SPACING / 111320 * 0.1
+    is_polygon = np.isin(kinds, POLYGON_AMENITIES)
+    geometry = np.where(
+        is_polygon,
+        shapely.box(x - size, y - size, x + size, y + size),
+        shapely.points(x, y),
+    )
+    duplicated = np.flatnonzero(~is_polygon & (rng.random(n_features) < DUPLICATED_POINTS))
+    lines = shapely.linestrings(
+        np.stack(
+            [
+                np.column_stack([x[duplicated], y[duplicated]]),
+                np.column_stack([x[duplicated] + size, y[duplicated] + size]),
+            ],
+            axis=1,
+        )
+    )
+    kinds = np.concatenate([tagged["highway"].values, kinds, kinds[duplicated]])
+    gdf = gpd.GeoDataFrame(
+        {
+            "element": np.concatenate(
+                [
+                    np.full(len(tagged), "node"),
+                    np.where(is_polygon, "way", "node"),
+                    np.full(len(duplicated), "way"),
+                ]
+            ),
+            "id": np.arange(len(kinds)),
+        },
+        geometry=np.concatenate([tagged.geometry.values, geometry, lines]),
+        crs="EPSG:4326",
+    )
+    for tag in sorted({tag for tag, _, _ in AMENITY_TAGS.values()}):
+        gdf[tag] = None
+    gdf.loc[: len(tagged) - 1, "highway"] = tagged["highway"].values
+    for kind, (tag, value, _) in AMENITY_TAGS.items():
+        gdf.loc[np.flatnonzero(kinds == kind), tag] = value
+    return gdf
+
+
+def make_city(n_edges, seed=SEED):
+    """Save the boundary, raw graph and raw features of a synthetic city, if not saved."""
+    cityname = get_cityname(n_edges)
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    if os.path.exists(outfolder + cityname + "_features_0_raw.gpkg"):
+        return cityname
+    rng = np.random.default_rng(seed)
+    gdf_nodes, gdf_edges = make_graph(n_edges, rng)
+    gdf = make_features(gdf_nodes, int(FEATURES_PER_EDGE * len(gdf_edges)), rng)
+    os.makedirs(FOLDERPATH_POLY, exist_ok=True)
+    gpd.GeoDataFrame(
+        geometry=[shapely.box(*gdf_edges.total_bounds)], crs="EPSG:4326"
+    ).to_file(FOLDERPATH_POLY + cityname + ".gpkg")
+    os.makedirs(outfolder, exist_ok=True)
+    save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_0_raw", formats=[])
+    # Features last, as the sign that the city is complete
+    gdf.to_file(outfolder + cityname + "_features_0_raw.gpkg", index=True)
+    return cityname
+
+
+def _run_stage(stage, cityname):
+    """Run a stage for a city in the benchmark folder, returning its time and peak memory."""
+    os.chdir(FOLDERPATH_BENCHMARK)
+    module = importlib.import_module(STAGES[stage]["module"])
+    start, start_cpu = time.perf_counter(), time.process_time()
+    getattr(module, STAGES[stage]["function"])(cityname)
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in KiB on Linux
+    return time.perf_counter() - start, time.process_time() - start_cpu, peak / 1024
+
+
+def benchmark(scales=SCALES, stages=STAGES_BENCHMARKED):
+    """Run the stages on the synthetic city of each scale, in order of the pipeline."""
+    results = {}
+    for n_edges in scales:
+        cwd = os.getcwd()
+        os.makedirs(FOLDERPATH_BENCHMARK, exist_ok=True)
+        os.chdir(FOLDERPATH_BENCHMARK)
+        try:
+            cityname = make_city(n_edges)
+            # Start from the raw files, as in a first run
+            shutil.rmtree(
+                FOLDERPATH_CITIES + cityname + "/" + FOLDERNAME_INDEX, ignore_errors=True
+            )
+        finally:
+            os.chdir(cwd)
+        for stage in stages:
+            # One process per stage, so that the peak memory of previous stages is not counted
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                wall, cpu, peak = executor.submit(_run_stage, stage, cityname).result()
+            results[stage + "_" + str(n_edges)] = {
+                "time": wall,
+                "cpu_time": cpu,
+                "edges_per_second": n_edges / wall,
+                "peak_memory_mb": peak,
+            }
+            print(stage, n_edges, round(wall, 2), "s", round(peak), "MB")
+    return results
+
+
+def find_regressions(results, baselines):
+    """Get the regressions of the results compared with the baselines."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baselines:
+            continue
+        baseline = baselines[name]
+        if result["time"] > TOLERANCE_TIME * baseline["time"]:
+            regressions.append(
+                f"{name}: {result['time']:.2f} s instead of {baseline['time']:.2f} s"
+            )
+        if result["peak_memory_mb"] > TOLERANCE_MEMORY * baseline["peak_memory_mb"]:
+            regressions.append(
+                f"{name}: {result['peak_memory_mb']:.0f} MB"
+                f" instead of {baseline['peak_memory_mb']:.0f} MB"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    results = benchmark()
+    print(pd.DataFrame(results).T)
+    if UPDATE_BASELINES or not os.path.exists(FILEPATH_BASELINES):
+        with open(FILEPATH_BASELINES, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(FILEPATH_BASELINES) as f:
+            regressions = find_regressions(results, json.load(f))
+        if regressions:
+            print("Regressions compared with the baselines:")
+            print("\n".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,172 @@
+"""Compute edge betweenness on a process pool, the source nodes being split in shards.
+
+Edge betweenness sums the contributions of the shortest paths starting at each
+source node, so shards of sources are computed independently, for all weights at
+once, and their partial sums added. The sums are checkpointed to disk, so that
+an interrupted run resumes from the shards already done instead of restarting.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import tqdm
+
+SHARD_SIZE = 100  # Number of source nodes computed by a task
+CHECKPOINT_INTERVAL = 300  # Time in second between two checkpoints of the partial sums
+
+_graph = None  # Graph of a worker, built once for all its tasks
+_cutoffs = None
+
+
+def _init_worker(n_nodes, edges, weights, cutoffs):
+    """Build the graph of a worker from its edges and their weights."""
+    # Imported here, as only the workers need igraph
+    import igraph as ig
+
+    global _graph, _cutoffs
+    _graph = ig.Graph(
+        n=n_nodes,
+        edges=edges,
+        directed=True,
+        edge_attrs=weights,
+    )
+    _cutoffs = cutoffs
+
+
+def _compute_shard(shard, sources):
+    """Compute the edge betweenness of the paths starting at the sources, for each weight."""
+    # All the nodes are given as no sources, as igraph cannot combine sources and cutoffs
+    if len(sources) == _graph.vcount():
+        sources = None
+    return shard, {
+        weight: np.array(
+            _graph.edge_betweenness(
+                directed=True, cutoff=cutoff, weights=weight, sources=sources
+            )
+        )
+        for weight, cutoff in _cutoffs.items()
+    }
+
+
+def get_checkpoint_key(n_nodes, edges, weights, shards, cutoffs):
+    """Hash everything the partial sums depend on, to only resume the same computation."""
+    sha = hashlib.sha256()
+    sha.update(np.int64(n_nodes).tobytes())
+    sha.update(np.ascontiguousarray(edges, dtype=np.int64).tobytes())
+    for weight in sorted(weights):
+        sha.update(weight.encode())
+        sha.update(np.ascontiguousarray(weights[weight], dtype=np.float64).tobytes())
+    for shard in shards:
+        sha.update(np.array(shard, dtype=np.int64).tobytes())
+    sha.update(json.dumps(cutoffs, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def load_checkpoint(filepath, key):
+    """Load the done shards and the partial sums of a checkpoint, if it is for the same key."""
+    if filepath is None or not os.path.exists(filepath):
+        return set(), {}
+    with np.load(filepath) as checkpoint:
+        if str(checkpoint["key"]) != key:
+            return set(), {}
+        sums = {
+            name.removeprefix("sum_"): checkpoint[name]
+            for name in checkpoint.files
+            if name.startswith("sum_")
+        }
+        return set(checkpoint["done"].tolist()), sums
+
+
+def save_checkpoint(filepath, key, done, sums):
+    """Save the done shards and the partial sums, replacing the previous checkpoint at once."""
+    with open(filepath + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            key=key,
+            done=np.array(sorted(done), dtype=np.int64),
+            **{"sum_" + weight: values for weight, values in sums.items()},
+        )
+    os.replace(filepath + ".tmp", filepath)
+
+
+def sharded_edge_betweenness(
+    n_nodes,
+    edges,
+    weights,
+    sources=None,
+    cutoffs=None,
+    n_workers=1,
+    shard_size=SHARD_SIZE,
+    checkpoint_path=None,
+):
+    """Compute the directed edge betweenness of a graph for each weight, shard by shard.
+
+    Edges is an array of (source, target) node indices and weights a dictionary
+    of arrays of edge weights. Betweenness only counts the paths starting at the
+    sources if given, otherwise it is exact, as igraph's edge_betweenness. Paths
+    longer than the cutoff of a weight, if any, are not counted: igraph cannot
+    combine cutoffs and sources, so betweenness with cutoffs is exact and computed
+    in a single shard.
+    """
+    cutoffs = {weight: (cutoffs or {}).get(weight) for weight in weights}
+    if any(cutoff is not None for cutoff in cutoffs.values()):
+        if sources is not None and len(set(sources)) < n_nodes:
+            raise ValueError(
+                "Betweenness with cutoffs must be exact, without sampled sources"
+            )
+        shard_size = max(n_nodes, 1)
+    sources = list(range(n_nodes)) if sources is None else list(sources)
+    shards = [sources[i : i + shard_size] for i in range(0, len(sources), shard_size)]
+    key = get_checkpoint_key(n_nodes, edges, weights, shards, cutoffs)
+    done, sums = load_checkpoint(checkpoint_path, key)
+    if not sums:
+        sums = {weight: np.zeros(len(edges)) for weight in weights}
+    todo = [shard for shard in range(len(shards)) if shard not in done]
+    last_checkpoint = time.time()
+
+    def add_shard(shard, partial):
+        nonlocal last_checkpoint
+        for weight in weights:
+            sums[weight] += partial[weight]
+        done.add(shard)
+        if checkpoint_path is not None and (
+            time.time() - last_checkpoint > CHECKPOINT_INTERVAL
+        ):
+            save_checkpoint(checkpoint_path, key, done, sums)
+            last_checkpoint = time.time()
+
+    progress = tqdm.tqdm(total=len(shards), initial=len(done), desc="betweenness")
+    try:
+        if n_workers == 1:
+            _init_worker(n_nodes, edges, weights, cutoffs)
+            for shard in todo:
+                add_shard(*_compute_shard(shard, shards[shard]))
+                progress.update()
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(n_nodes, edges, weights, cutoffs),
+            ) as executor:
+                futures = [
+                    executor.submit(_compute_shard, shard, shards[shard])
+                    for shard in todo
+                ]
+                for future in as_completed(futures):
+                    add_shard(*future.result())
+                    progress.update()
+    except BaseException:
+        # Keep the shards done before an error or an interruption
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, key, done, sums)
+        raise
+    finally:
+        progress.close()
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return sums
@@ -0,0 +1,72 @@
+"""Settings shared by the stages, kept apart so that importing them is fast.
+
+Stages import their inputs and outputs folders, the cities and the amenities from
+here instead of from B_get_graph_raw and C_get_features_raw, which import OSMnx.
+"""
+
+FOLDERPATH_POLY = "./data/processed/1_cities_boundaries/"
+FOLDERPATH_CITIES = "./data/processed/"
+FOLDERPATH_CHANGES = "./data/raw/osm/changes/"  # OSM change files (.osc, .osc.gz) to update the raw data with
+CITIES = [
+    "Braga",
+    "Camden",
+    "Cugir",
+    "Kozani",
+    "Lambeth",
+    "Milan_metropolitan",
+    "Riga",
+    "Westminster",
+    "Zaragoza",
+]
+AMENITIES_DICT = {  # List of amenities from tags and values to extract
+    "public_transport": ["platform"],
+    "highway": [
+        "crossing",
+        "cyclist_waiting_aid",
+        "traffic_signals",
+        "street_lamp",
+        "traffic_mirror",
+        "bus_stop",
+    ],
+    "amenity": ["bicycle_parking", "parking", "marketplace"],
+    "building": ["parking"],
+    "place": ["square"],
+    "leisure": ["park", "garden"],
+    "shop": True,
+    "osmid": True,
+}
+# Rules to classify the amenities into types, the first matching rule gives the type
+# "any": at least one tag has one of the values, True meaning any non-empty value
+# "none": no tag has one of the values, True meaning the tag is empty
+# "unless": none of the listed types was matched by the previous rules
+FEATURE_RULES = [
+    (
+        "public_transport_platform",
+        {"any": {"public_transport": ["platform"], "highway": ["bus_stop"]}},
+    ),
+    (
+        "green_area",
+        {"any": {"leisure": ["park", "garden"]}, "none": {"amenity": ["parking"]}},
+    ),
+    (
+        "public_square",
+        {
+            "any": {"place": ["square"], "amenity": ["marketplace"]},
+            "none": {"leisure": ["park", "garden"], "amenity": ["parking"]},
+        },
+    ),
+    ("shop", {"any": {"shop": True}, "unless": ["public_square"]}),
+    (
+        "parking",
+        {"any": {"amenity": ["parking"], "building": ["parking"]}, "none": {"shop": True}},
+    ),
+    (
+        "bicycle_parking",
+        {"any": {"amenity": ["bicycle_parking"]}, "none": {"highway": ["crossing"]}},
+    ),
+    ("crossing", {"any": {"highway": ["crossing"]}}),
+    ("cyclist_waiting_aid", {"any": {"highway": ["cyclist_waiting_aid"]}}),
+    ("traffic_signals", {"any": {"highway": ["traffic_signals"]}}),
+    ("street_lamp", {"any": {"highway": ["street_lamp"]}}),
+    ("traffic_mirror", {"any": {"highway": ["traffic_mirror"]}}),
+]
@@ -0,0 +1,125 @@
+"""Find duplicated geometries by hashing, in near-linear time.
+
+Exact duplicates are found by hashing the WKB of the geometries, optionally after
+snapping their coordinates to a grid so that geometries differing by rounding
+noise are the same. Near duplicates within a distance are found by hashing the
+cells of a grid: geometries are only compared with the geometries sharing a cell
+with their bounding box expanded by the distance, then the distance is checked
+exactly. Geometries covering many cells are queried in an STRtree instead. Functions return positions, so that callers index their own tables.
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+MAX_CELLS = 64  # Number of grid cells beyond which a geometry is queried in an STRtree
+
+
+def hash_geometries(geometries, grid_size=None):
+    """Get integer codes equal for equal geometries, snapped to a grid of a size if given."""
+    if grid_size is not None:
+        geometries = shapely.set_precision(geometries, grid_size)
+    codes, _ = pd.factorize(shapely.to_wkb(geometries))
+    return codes
+
+
+def find_exact_duplicates(geometries, keys=None, grid_size=None):
+    """Get the positions of the geometries equal to a previous one with the same key.
+
+    keys is an array of values, e.g. types, that duplicates must also share.
+    """
+    codes = {"geometry": hash_geometries(geometries, grid_size)}
+    if keys is not None:
+        codes["key"] = pd.factorize(keys)[0]
+    return np.flatnonzero(pd.DataFrame(codes).duplicated(keep="first").values)
+
+
+def find_equal(geometries, others, grid_size=None):
+    """Get the positions of the geometries equal to one of the others."""
+    codes = hash_geometries(np.concatenate([geometries, others]), grid_size)
+    return np.flatnonzero(
+        np.isin(codes[: len(geometries)], codes[len(geometries) :])
+    )
+
+
+def _count_cells(geometries, cell_size, tolerance=0):
+    """Get the number of grid cells the expanded bounds of the geometries cover, 0 if empty."""
+    bounds = shapely.bounds(geometries)
+    size = (
+        np.floor((bounds[:, 2:] + tolerance) / cell_size)
+        - np.floor((bounds[:, :2] - tolerance) / cell_size)
+        + 1
+    )
+    # Empty geometries have missing bounds
+    return np.nan_to_num(size.prod(axis=1))
+
+
+def _get_cells(geometries, cell_size, tolerance=0):
+    """Get the positions of the geometries and the grid cells their expanded bounds cover."""
+    bounds = shapely.bounds(geometries)
+    low = np.floor((bounds[:, :2] - tolerance) / cell_size).astype(np.int64)
+    high = np.floor((bounds[:, 2:] + tolerance) / cell_size).astype(np.int64)
+    nx, ny = high[:, 0] - low[:, 0] + 1, high[:, 1] - low[:, 1] + 1
+    positions = np.repeat(np.arange(len(geometries)), nx * ny)
+    # Rank of each cell within the cells of its geometry, row by row
+    rank = np.arange(len(positions)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+    cx = low[positions, 0] + rank % nx[positions]
+    cy = low[positions, 1] + rank // nx[positions]
+    return positions, cx, cy
+
+
+def _get_grid_pairs(geometries, others, tolerance, cell_size):
+    """Get the pairs of positions of the geometries and others sharing a cell of the grid."""
+    pos, cx, cy = _get_cells(geometries, cell_size, tolerance)
+    other_pos, other_cx, other_cy = _get_cells(others, cell_size)
+    # Join on the cells, numbered from the lowest, other geometries being sorted by cell
+    x0 = min(cx.min(initial=0), other_cx.min(initial=0))
+    y0 = min(cy.min(initial=0), other_cy.min(initial=0))
+    cells = (cx - x0) * 2**32 + cy - y0
+    other_cells = (other_cx - x0) * 2**32 + other_cy - y0
+    order = np.argsort(other_cells, kind="stable")
+    other_cells, other_pos = other_cells[order], other_pos[order]
+    start = np.searchsorted(other_cells, cells, side="left")
+    count = np.searchsorted(other_cells, cells, side="right") - start
+    left = np.repeat(pos, count)
+    right = other_pos[
+        np.repeat(start, count)
+        + np.arange(count.sum())
+        - np.repeat(np.cumsum(count) - count, count)
+    ]
+    # Geometries larger than a cell can share several cells with a geometry
+    return np.unique(np.column_stack([left, right]), axis=0)
+
+
+def find_near_pairs(geometries, others, tolerance, cell_size=None, max_cells=MAX_CELLS):
+    """Get the pairs of positions of the geometries and others within a distance.
+
+    Coordinates must be in a projected CRS. Cells are of the size of the distance
+    by default. Geometries whose expanded bounds cover more than max_cells cells,
+    like long roads, are queried in an STRtree instead, and empty geometries have
+    no pairs. Pairs are sorted by the positions of the geometries, then of others.
+    """
+    cell_size = cell_size or tolerance
+    n_cells = _count_cells(geometries, cell_size, tolerance)
+    other_n_cells = _count_cells(others, cell_size)
+    small = np.flatnonzero((n_cells > 0) & (n_cells <= max_cells))
+    other_small = np.flatnonzero((other_n_cells > 0) & (other_n_cells <= max_cells))
+    large = np.flatnonzero(n_cells > max_cells)
+    other_large = np.flatnonzero(other_n_cells > max_cells)
+    pairs = _get_grid_pairs(geometries[small], others[other_small], tolerance, cell_size)
+    pairs = np.column_stack([small[pairs[:, 0]], other_small[pairs[:, 1]]])
+    close = shapely.dwithin(geometries[pairs[:, 0]], others[pairs[:, 1]], tolerance)
+    pairs = [pairs[close]]
+    # Large geometries with all others, then the other geometries with large others
+    if len(large):
+        ind, other_ind = shapely.STRtree(others).query(
+            geometries[large], predicate="dwithin", distance=tolerance
+        )
+        pairs.append(np.column_stack([large[ind], other_ind]))
+    if len(other_large) and len(small):
+        ind, other_ind = shapely.STRtree(others[other_large]).query(
+            geometries[small], predicate="dwithin", distance=tolerance
+        )
+        pairs.append(np.column_stack([small[ind], other_large[other_ind]]))
+    pairs = np.unique(np.concatenate(pairs).reshape(-1, 2), axis=0)
+    return pairs[:, 0], pairs[:, 1]
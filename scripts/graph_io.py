@@ -0,0 +1,181 @@
+"""Save and load graphs as GeoParquet tables of nodes and edges.
+
+Nodes and edges are stored in typed columns, so that stages load only the columns
+they need instead of parsing a whole GraphML file where every attribute is a
+string. GraphML and GeoPackage are optional exports, off by default as they build
+a graph with OSMnx, imported when needed.
+"""
+
+import json
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import table_cache
+
+EXPORT_FORMATS = []  # Formats saved besides GeoParquet, among "graphml" and "gpkg"
+BATCH_SIZE = 100000  # Number of rows of the batches of a table read one after the other
+
+
+def _to_typed(gdf):
+    """Make the object columns of a table storable in typed Parquet columns.
+
+    Columns where some values are lists, like osmid after simplification, become
+    list columns with every value wrapped in a list, their names being kept in the
+    attrs saved with the table to unwrap them when loaded. Columns that still mix
+    types are stored as strings.
+    """
+    gdf = gdf.copy()
+    gdf.attrs["wrapped_columns"] = []
+    for col in gdf.columns:
+        if col == gdf.geometry.name or gdf[col].dtype != object:
+            continue
+        values = gdf[col]
+        is_list = values.apply(lambda x: isinstance(x, list))
+        if is_list.any() and not is_list[values.notna()].all():
+            gdf.attrs["wrapped_columns"].append(col)
+            values = values.apply(
+                lambda x: x if isinstance(x, list) else (None if pd.isna(x) else [x])
+            )
+        try:
+            pa.array(values, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            values = values.apply(
+                lambda x: [str(v) for v in x]
+                if isinstance(x, list)
+                else (None if pd.isna(x) else str(x))
+            )
+        gdf[col] = values
+    return gdf
+
+
+def _from_typed(gdf):
+    """Turn list columns back into lists, unwrapping the single values wrapped when saved."""
+    wrapped = gdf.attrs.pop("wrapped_columns", [])
+    for col in gdf.columns:
+        if gdf[col].dtype != object:
+            continue
+        mask = gdf[col].apply(lambda x: isinstance(x, np.ndarray))
+        if mask.any():
+            if col in wrapped:
+                gdf.loc[mask, col] = gdf.loc[mask, col].apply(
+                    lambda x: x.tolist()[0] if len(x) == 1 else x.tolist()
+                )
+            else:
+                gdf.loc[mask, col] = gdf.loc[mask, col].apply(lambda x: x.tolist())
+    return gdf
+
+
+def save_graph_tables(gdf_nodes, gdf_edges, filepath, formats=None):
+    """Save the tables of nodes and edges of a graph, filepath being without extension."""
+    formats = EXPORT_FORMATS if formats is None else formats
+    _to_typed(gdf_nodes).to_parquet(
+        filepath + "_nodes.parquet", index=True, write_covering_bbox=True
+    )
+    _to_typed(gdf_edges).to_parquet(
+        filepath + "_edges.parquet", index=True, write_covering_bbox=True
+    )
+    if formats:
+        import osmnx as ox
+
+        G = ox.graph_from_gdfs(gdf_nodes=gdf_nodes, gdf_edges=gdf_edges)
+        if "graphml" in formats:
+            ox.save_graphml(G, filepath + ".graphml")
+        if "gpkg" in formats:
+            ox.save_graph_geopackage(G, filepath + ".gpkg")
+
+
+def save_graph(G, filepath, formats=None):
+    """Save a graph as tables of nodes and edges, filepath being without extension."""
+    import osmnx as ox
+
+    formats = EXPORT_FORMATS if formats is None else formats
+    gdf_nodes, gdf_edges = ox.graph_to_gdfs(G, nodes=True, edges=True)
+    save_graph_tables(gdf_nodes, gdf_edges, filepath, formats=[])
+    if "graphml" in formats:
+        ox.save_graphml(G, filepath + ".graphml")
+    if "gpkg" in formats:
+        ox.save_graph_geopackage(G, filepath + ".gpkg")
+
+
+def get_edge_array(gdf_nodes, gdf_edges):
+    """Get the edges as an array of (u, v) positions in the table of nodes, as igraph takes them."""
+    return np.column_stack(
+        [
+            gdf_nodes.index.get_indexer(gdf_edges.index.get_level_values(level))
+            for level in ["u", "v"]
+        ]
+    )
+
+
+def _to_geodataframe(table):
+    """Convert an Arrow table read from a table of nodes or edges, with its metadata."""
+    metadata = table.schema.metadata
+    geo = json.loads(metadata[b"geo"])
+    geometry = geo["primary_column"]
+    df = table.to_pandas()
+    df[geometry] = shapely.from_wkb(df[geometry].values)
+    gdf = gpd.GeoDataFrame(
+        df, geometry=geometry, crs=geo["columns"][geometry].get("crs", "OGC:CRS84")
+    )
+    gdf.attrs = json.loads(metadata.get(b"PANDAS_ATTRS", b"{}"))
+    return _from_typed(gdf)
+
+
+def _read_table(filepath, columns=None, bbox=None):
+    """Read a table of nodes or edges from its file."""
+    gdf = gpd.read_parquet(filepath, columns=columns, bbox=bbox, memory_map=True)
+    return _from_typed(gdf)
+
+
+def load_table(filepath, columns=None, bbox=None):
+    """Load a table of nodes or edges, with only some columns if given."""
+    if columns is not None and "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+    return table_cache.load(_read_table, filepath, columns=columns, bbox=bbox)
+
+
+def iter_table(filepath, columns=None, batch_size=BATCH_SIZE):
+    """Iterate over a table of nodes or edges in batches of rows, as loaded by load_table.
+
+    Only a batch is in memory at once, and at least one batch, maybe empty, is yielded.
+    """
+    parquet = pq.ParquetFile(filepath)
+    metadata = parquet.schema_arrow.metadata
+    geo = json.loads(metadata[b"geo"])
+    geometry = geo["primary_column"]
+    # Index columns are read with the others, a range index being only in the metadata
+    index_columns = json.loads(metadata[b"pandas"])["index_columns"]
+    # The bounding boxes of the geometries are only used to filter the rows
+    covering = {
+        col for col, _ in geo["columns"][geometry].get("covering", {}).get("bbox", {}).values()
+    }
+    names = [
+        name
+        for name in parquet.schema_arrow.names
+        if name not in covering
+        and (columns is None or name in columns or name == geometry or name in index_columns)
+    ]
+    n_batches = 0
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=names):
+        n_batches += 1
+        yield _to_geodataframe(pa.Table.from_batches([batch]))
+    if not n_batches:
+        yield _to_geodataframe(parquet.schema_arrow.empty_table().select(names))
+
+
+def load_graph_tables(filepath, node_columns=None, edge_columns=None):
+    """Load the tables of nodes and edges of a graph, filepath being without extension."""
+    gdf_nodes = load_table(filepath + "_nodes.parquet", columns=node_columns)
+    gdf_edges = load_table(filepath + "_edges.parquet", columns=edge_columns)
+    return gdf_nodes, gdf_edges
+
+
+def load_graph(filepath):
+    """Load a graph from its tables of nodes and edges, filepath being without extension."""
+    import osmnx as ox
+
+    gdf_nodes, gdf_edges = load_graph_tables(filepath)
+    return ox.graph_from_gdfs(gdf_nodes=gdf_nodes, gdf_edges=gdf_edges)
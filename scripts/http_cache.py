@@ -0,0 +1,179 @@
+"""Persistent cache of the Overpass and Nominatim responses fetched through OSMnx.
+
+Responses are saved compressed, keyed by the hash of the full request, so that a
+rerun fetches nothing already fetched. Entries expire after a time to live, and
+the least recently used are evicted beyond a total size. Identical requests made
+at the same time, by threads or processes, are sent once: the first holds a lock
+on the key while the others wait and read its response. In cache-only mode, a
+request not in the cache fails instead of reaching the network, for offline runs.
+"""
+
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import osmnx as ox
+import requests
+from osmnx import _nominatim, _overpass
+
+FOLDERPATH_CACHE = "./data/raw/http_cache/"
+TTL_DAYS = 90  # Age in days after which a response is fetched again, None to keep it forever
+MAX_SIZE_GB = 5  # Total size of the cache beyond which least recently used responses are removed
+EVICT_TO = 0.9  # Fraction of MAX_SIZE_GB down to which responses are removed, to scan the cache rarely
+CACHE_ONLY = False  # Only use cached responses, failing on a request not in the cache
+
+
+class CacheMissError(Exception):
+    """A request is not in the cache while only the cache can be used."""
+
+
+_held = threading.local()  # Keys locked by the current thread, for retries of the same request
+_originals = {}  # Request functions of OSMnx replaced by their cached version
+_size = None  # Size in bytes of the cache, scanned once then counting the responses saved here
+
+
+def get_key(url, params):
+    """Get the key of a request, the hash of its URL with its parameters."""
+    prepared = requests.Request("GET", url, params=params).prepare().url
+    return hashlib.sha256(prepared.encode()).hexdigest()
+
+
+def _path(key, extension=".json.gz"):
+    """Get the path of the cached response of a key, or of its lock."""
+    return FOLDERPATH_CACHE + key[:2] + "/" + key + extension
+
+
+def load_response(key, ttl_days=TTL_DAYS):
+    """Load the cached response of a key, None if not cached or expired."""
+    filepath = _path(key)
+    try:
+        with gzip.open(filepath, "rt", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, EOFError, ValueError):
+        return None
+    # Other processes can remove the same response at the same time
+    if ttl_days is not None and time.time() - entry["saved"] > ttl_days * 86400:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filepath)
+        return None
+    # The modification time tracks the last use, for the eviction
+    with contextlib.suppress(FileNotFoundError):
+        os.utime(filepath)
+    return entry["response"]
+
+
+def save_response(key, url, response):
+    """Save a response, replacing the cached one at once for readers, and get its size."""
+    filepath = _path(key)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with gzip.open(filepath + ".tmp", "wt", encoding="utf-8") as f:
+        json.dump({"url": url, "saved": time.time(), "response": response}, f)
+    size = os.path.getsize(filepath + ".tmp")
+    os.replace(filepath + ".tmp", filepath)
+    return size
+
+
+def evict(max_size_gb=MAX_SIZE_GB, evict_to=EVICT_TO):
+    """Scan the cache and get its size, after removing the least recently used responses.
+
+    If the cache exceeds its maximal size, responses are removed until it fits in a
+    fraction of it, so that it is not scanned again at the next response saved.
+    """
+    entries = []
+    for folder, _, filenames in os.walk(FOLDERPATH_CACHE):
+        for filename in filenames:
+            if filename.endswith(".json.gz"):
+                # Other processes can remove the same response at the same time
+                with contextlib.suppress(FileNotFoundError):
+                    stat = os.stat(os.path.join(folder, filename))
+                    entries.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(folder, filename))
+                    )
+    total = sum(size for _, size, _ in entries)
+    if total <= max_size_gb * 1024**3:
+        return total
+    for _, size, filepath in sorted(entries):
+        if total <= evict_to * max_size_gb * 1024**3:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filepath)
+        total -= size
+    return total
+
+
+def add_size(size, max_size_gb=MAX_SIZE_GB):
+    """Count a saved response in the size of the cache, scanning it only if too large.
+
+    The cache is scanned at the first response saved, then only once the responses
+    saved since make it exceed its maximal size.
+    """
+    global _size
+    if _size is None:
+        _size = evict(max_size_gb)
+    else:
+        _size += size
+        if _size > max_size_gb * 1024**3:
+            _size = evict(max_size_gb)
+
+
+def _cached(request, url, params, response_type, *args, **kwargs):
+    """Get the response of a request from the cache, sending it once if not cached."""
+    key = get_key(url, params)
+    held = getattr(_held, "keys", set())
+    if key in held:
+        # Retry of the request by OSMnx within the request holding the lock
+        return _originals[request](*args, **kwargs)
+    response = load_response(key, TTL_DAYS)
+    if isinstance(response, response_type):
+        return response
+    if CACHE_ONLY:
+        raise CacheMissError(f"Not in the cache: {url} {params}")
+    os.makedirs(os.path.dirname(_path(key)), exist_ok=True)
+    with open(_path(key, ".lock"), "w") as lock:
+        # Wait for an identical request in flight, then use its response
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _held.keys = held | {key}
+        try:
+            response = load_response(key, TTL_DAYS)
+            if not isinstance(response, response_type):
+                response = _originals[request](*args, **kwargs)
+                # Incomplete responses are not cached, as OSMnx does
+                if not (isinstance(response, dict) and "remark" in response):
+                    add_size(save_response(key, url, response), MAX_SIZE_GB)
+        finally:
+            _held.keys = held
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return response
+
+
+def _overpass_request(data):
+    """Send an Overpass request through the cache."""
+    url = ox.settings.overpass_url.rstrip("/") + "/interpreter"
+    return _cached("overpass", url, data, dict, data)
+
+
+def _nominatim_request(params, request_type="search"):
+    """Send a Nominatim request through the cache."""
+    url = ox.settings.nominatim_url.rstrip("/") + "/" + request_type
+    return _cached("nominatim", url, params, list, params, request_type=request_type)
+
+
+def install(overpass_request=None):
+    """Send the Overpass and Nominatim requests of OSMnx through the cache.
+
+    Requests not in the cache are sent by OSMnx, or by overpass_request if given for
+    the Overpass ones.
+    """
+    if not _originals:
+        _originals["overpass"] = _overpass._overpass_request
+        _originals["nominatim"] = _nominatim._nominatim_request
+        _overpass._overpass_request = _overpass_request
+        _nominatim._nominatim_request = _nominatim_request
+        # Responses are only cached here, not also uncompressed by OSMnx
+        ox.settings.use_cache = False
+    if overpass_request is not None:
+        _originals["overpass"] = overpass_request
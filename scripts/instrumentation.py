@@ -0,0 +1,135 @@
+"""Record the time, memory and row counts of the steps of the stages in run reports.
+
+Stages wrap their named steps (load, classify, join, build graph, save...) in
+step, and a run wraps each (city, stage) task in task. Each step records its wall
+time, CPU time, peak resident memory and, if given, its number of rows. On Linux
+the peak memory of a step is its own, the peak of the process being reset at the
+start of each step. Records of a run are saved as a JSON report, and the tasks of
+PROFILED_TASKS are also profiled with cProfile or pyinstrument.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import resource
+import time
+
+FOLDERPATH_REPORTS = "./data/run_reports/"
+PROFILED_TASKS = []  # (stage, city) tasks to profile, e.g. [("E", "Riga")]
+PROFILER = "cProfile"  # Profiler of the profiled tasks, "cProfile" or "pyinstrument"
+
+_records = []  # Records of the steps run in this process, not yet saved
+_open = []  # Peak memory of the steps running, innermost last
+_task = {}  # Stage and city of the task running
+
+
+def _read_peak_rss():
+    """Get the peak resident memory in MB since the last reset, or of the process."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux, the peak of the whole process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of the process to its current one, if possible."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def step(name, rows=None):
+    """Record a named step of a stage, yielding its record to set its rows in and out.
+
+    rows is the number of rows the step works on, rows_out can be set on the
+    record once the step has produced its output.
+    """
+    # The peak so far belongs to the steps already running, before it is reset
+    peak = _read_peak_rss()
+    _open[:] = [max(other, peak) for other in _open]
+    _reset_peak_rss()
+    _open.append(_read_peak_rss())
+    record = {**_task, "step": name, "rows": rows, "rows_out": None}
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_time"] = time.perf_counter() - start
+        record["cpu_time"] = time.process_time() - start_cpu
+        record["peak_rss_mb"] = max(_open.pop(), _read_peak_rss())
+        if _open:
+            _open[-1] = max(_open[-1], record["peak_rss_mb"])
+        _records.append(record)
+
+
+@contextlib.contextmanager
+def task(stage, cityname):
+    """Record a (city, stage) task as a whole and its steps, profiling it if asked for."""
+    _task.update(stage=stage, city=cityname)
+    profiled = (stage, cityname) in PROFILED_TASKS
+    try:
+        with step("total"), (
+            _profile(stage, cityname) if profiled else contextlib.nullcontext()
+        ):
+            yield
+    finally:
+        _task.clear()
+
+
+@contextlib.contextmanager
+def _profile(stage, cityname):
+    """Profile a task, saving the profile in the folder of the reports."""
+    os.makedirs(FOLDERPATH_REPORTS, exist_ok=True)
+    filepath = FOLDERPATH_REPORTS + stage + "_" + cityname
+    if PROFILER == "pyinstrument":
+        # Optional dependency, only needed to profile with it
+        import pyinstrument
+
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(filepath + ".html", "w") as f:
+                f.write(profiler.output_html())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(filepath + ".prof")
+
+
+def pop_records():
+    """Get the records of this process not yet saved, and forget them."""
+    records = _records[:]
+    _records.clear()
+    return records
+
+
+def save_report(records=None, name="run"):
+    """Save records, by default those of this process, as a JSON run report."""
+    records = pop_records() if records is None else records
+    os.makedirs(FOLDERPATH_REPORTS, exist_ok=True)
+    now = datetime.datetime.now()
+    filepath = FOLDERPATH_REPORTS + name + "_" + now.strftime("%Y%m%d_%H%M%S") + ".json"
+    with open(filepath, "w") as f:
+        json.dump(
+            {"finished": now.isoformat(), "cpu_count": os.cpu_count(), "steps": records},
+            f,
+            indent=2,
+        )
+    return filepath
@@ -0,0 +1,294 @@
+"""Apply OSM change files (osmChange, .osc) to the OSM elements of a city.
+
+The raw graph and features of a city are made of OSM elements in Overpass JSON
+format, saved by B, C and BC. A change file creates, modifies and deletes the
+elements of a whole region: the elements of a city are updated with the ones the
+buffered bounds of its polygon select, as BC_get_raw_from_pbf selects them from
+an extract, and the keys of the elements whose tags or geometry changed are
+returned, for the raw data to be recomputed only there. Ways and members entering
+a city with nodes or ways that are not in the change file are completed from the
+extract of the city, if any.
+"""
+
+import osmium
+from BC_get_raw_from_pbf import MEMBER_TYPES, RELATION_TYPES
+from B_get_graph_raw import NETWORK_TYPE
+from config import AMENITIES_DICT
+from osm_elements import (
+    get_network_conditions,
+    match_tags,
+    match_way_filter,
+    node_element,
+)
+
+TYPE_RANKS = {"node": 0, "way": 1, "relation": 2}  # Order of the elements of each type
+
+
+class MissingElementsError(Exception):
+    """Elements needed to apply changes are neither in the city, the changes or an extract."""
+
+
+def _to_element(obj):
+    """Convert an OSM object read by osmium into an element in Overpass JSON format."""
+    tags = dict(obj.tags)
+    if obj.is_node():
+        element = {"type": "node", "id": obj.id, "lat": obj.lat, "lon": obj.lon}
+        if tags:
+            element["tags"] = tags
+        return element
+    if obj.is_way():
+        return {
+            "type": "way",
+            "id": obj.id,
+            "nodes": [n.ref for n in obj.nodes],
+            "tags": tags,
+        }
+    return {
+        "type": "relation",
+        "id": obj.id,
+        "tags": tags,
+        "members": [
+            {"type": MEMBER_TYPES[m.type], "ref": m.ref, "role": m.role}
+            for m in obj.members
+        ],
+    }
+
+
+def read_changes(filepath):
+    """Read a change file into its elements by (type, id) key, None for the deleted ones.
+
+    The last version of an element changed several times is kept.
+    """
+    changes = {}
+    for obj in osmium.FileProcessor(filepath):
+        key = (MEMBER_TYPES[obj.type_str()], obj.id)
+        changes[key] = None if obj.deleted else _to_element(obj)
+    return changes
+
+
+def lookup_elements(filepath, way_ids, node_ids):
+    """Get ways and nodes from an extract, with the nodes of the ways."""
+    found = {}
+    node_ids = set(node_ids)
+    if way_ids:
+        for obj in osmium.FileProcessor(filepath, osmium.osm.WAY).with_filter(
+            osmium.filter.IdFilter(way_ids)
+        ):
+            found[("way", obj.id)] = _to_element(obj)
+            node_ids.update(n.ref for n in obj.nodes)
+    if node_ids:
+        for obj in osmium.FileProcessor(filepath, osmium.osm.NODE).with_filter(
+            osmium.filter.IdFilter(node_ids)
+        ):
+            found[("node", obj.id)] = _to_element(obj)
+    return found
+
+
+def _in_bounds(way, get, bounds):
+    """Check if the nodes of a way with a location have bounds intersecting the bounds."""
+    nodes = [get(("node", ref)) for ref in way["nodes"]]
+    lons = [node["lon"] for node in nodes if node is not None]
+    lats = [node["lat"] for node in nodes if node is not None]
+    minx, miny, maxx, maxy = bounds
+    return bool(lons) and (
+        min(lons) <= maxx and max(lons) >= minx and min(lats) <= maxy and max(lats) >= miny
+    )
+
+
+def _complete(candidates, get, changes, filepath_extract):
+    """Find the ways and nodes the candidate ways and relations of the changes miss.
+
+    Returns the elements found in the extract, and the keys of the candidates
+    outside the city for sure, as none of their nodes or ways is known.
+    """
+    member_ways = {
+        (element["id"], m["ref"])
+        for element in candidates
+        if element["type"] == "relation"
+        for m in element["members"]
+        if m["type"] == "way"
+    }
+    # Deleted elements are missing for a reason
+    missing_ways = {
+        ref
+        for _, ref in member_ways
+        if get(("way", ref)) is None and ("way", ref) not in changes
+    }
+    ways = [element for element in candidates if element["type"] == "way"]
+    ways += [get(("way", ref)) for _, ref in member_ways if ref not in missing_ways]
+    missing_nodes = {
+        ref
+        for way in ways
+        if way is not None
+        for ref in way["nodes"]
+        if get(("node", ref)) is None and ("node", ref) not in changes
+    }
+    if filepath_extract is not None and (missing_ways or missing_nodes):
+        return lookup_elements(filepath_extract, missing_ways, missing_nodes), set()
+    outside = set()
+    for element in candidates:
+        if element["type"] == "way":
+            refs, missing = element["nodes"], missing_nodes
+        else:
+            refs = [ref for rel_id, ref in member_ways if rel_id == element["id"]]
+            missing = missing_ways
+            # Member ways partly unknown make the relation partly unknown
+            if any(
+                ref in missing_nodes
+                for way_ref in refs
+                if way_ref not in missing_ways and get(("way", way_ref)) is not None
+                for ref in get(("way", way_ref))["nodes"]
+            ):
+                refs, missing = refs + [None], {None}
+        n_missing = sum(ref in missing for ref in refs)
+        if n_missing == len(refs):
+            outside.add((element["type"], element["id"]))
+        elif n_missing:
+            raise MissingElementsError(
+                f"{element['type']} {element['id']} is partly unknown, "
+                "the raw data of the city must be rebuilt"
+            )
+    return {}, outside
+
+
+def apply_changes(elements, changes, bounds, kind, filepath_extract=None):
+    """Apply changes to the elements of the graph or features of a city, in place.
+
+    elements are by (type, id) key, kind is "graph" or "features", and bounds are
+    the ones of the buffered polygon of the city. Returns the keys of the elements
+    whose tags or geometry changed, added and removed ones included, with for the
+    features the ways of the nodes and the relations of the ways that changed.
+    """
+    conditions = get_network_conditions(NETWORK_TYPE)
+    was_sorted = list(elements) == sorted(elements, key=_sort_key)
+    old = {}  # Elements before the changes, None if added
+    found = {}
+
+    def get(key):
+        if key in changes:
+            return changes[key]
+        if key in elements:
+            return elements[key]
+        return found.get(key)
+
+    def qualifies(element):
+        tags = element.get("tags", {})
+        if kind == "graph":
+            return (
+                element["type"] == "way"
+                and "highway" in tags
+                and match_way_filter(tags, conditions)
+            )
+        if element["type"] == "relation":
+            return tags.get("type") in RELATION_TYPES and match_tags(tags, AMENITIES_DICT)
+        return match_tags(tags, AMENITIES_DICT)
+
+    def update(key, element):
+        if key not in old:
+            old[key] = elements.get(key)
+        if element is None:
+            elements.pop(key, None)
+        else:
+            elements[key] = element
+
+    candidates = [
+        element
+        for element in changes.values()
+        if element is not None and element["type"] != "node" and qualifies(element)
+    ]
+    found, outside = _complete(candidates, get, changes, filepath_extract)
+    # Relations, then ways, then nodes, as each needs the next to be selected
+    for key, element in changes.items():
+        if key[0] != "relation":
+            continue
+        keep = (
+            element is not None
+            and key not in outside
+            and qualifies(element)
+            and any(
+                m["type"] == "way"
+                and get(("way", m["ref"])) is not None
+                and _in_bounds(get(("way", m["ref"])), get, bounds)
+                for m in element["members"]
+            )
+        )
+        if keep or key in elements:
+            update(key, element if keep else None)
+    members = {
+        m["ref"]
+        for key, element in elements.items()
+        if key[0] == "relation"
+        for m in element["members"]
+        if m["type"] == "way"
+    }
+    ways = {key[1] for key in changes if key[0] == "way"}
+    ways |= {
+        m["ref"]
+        for key in old
+        for element in [old[key], elements.get(key)]
+        if element is not None
+        for m in element["members"]
+        if m["type"] == "way"
+    }
+    for ref in ways:
+        key = ("way", ref)
+        way = get(key)
+        keep = way is not None and (
+            ref in members
+            or (key not in outside and qualifies(way) and _in_bounds(way, get, bounds))
+        )
+        if keep and (key in changes or key not in elements):
+            update(key, way)
+        elif not keep and key in elements:
+            update(key, None)
+    # Nodes of the ways, feature nodes, and nodes no longer used
+    used = {ref for key, way in elements.items() if key[0] == "way" for ref in way["nodes"]}
+    nodes = {key[1] for key in changes if key[0] == "node"}
+    nodes |= {
+        ref
+        for key in list(old)
+        if key[0] == "way"
+        for way in [old[key], elements.get(key)]
+        if way is not None
+        for ref in way["nodes"]
+    }
+    for ref in nodes:
+        key = ("node", ref)
+        node = get(key)
+        if node is None:
+            if key in elements:
+                update(key, None)
+            continue
+        in_bounds = _in_bounds({"nodes": [ref]}, get, bounds)
+        is_feature = (
+            kind == "features" and in_bounds and match_tags(node.get("tags", {}), AMENITIES_DICT)
+        )
+        if not (ref in used or is_feature):
+            if key in elements:
+                update(key, None)
+        elif key in changes or key not in elements:
+            update(key, node_element(node, is_feature, in_bounds))
+    if was_sorted:
+        for key in sorted(elements, key=_sort_key):
+            elements[key] = elements.pop(key)
+    changed = {key for key, element in old.items() if element != elements.get(key)}
+    if kind == "features":
+        moved = {key[1] for key in changed if key[0] == "node"}
+        changed |= {
+            key
+            for key, way in elements.items()
+            if key[0] == "way" and not moved.isdisjoint(way["nodes"])
+        }
+        reshaped = {key[1] for key in changed if key[0] == "way"}
+        changed |= {
+            key
+            for key, rel in elements.items()
+            if key[0] == "relation"
+            and any(m["type"] == "way" and m["ref"] in reshaped for m in rel["members"])
+        }
+    return changed
+
+
+def _sort_key(key):
+    """Sort elements by type then id, as Overpass does."""
+    return TYPE_RANKS[key[0]], key[1]
@@ -0,0 +1,149 @@
+"""Build graphs and features from OpenStreetMap elements in Overpass JSON format.
+
+It gives the same results as `ox.graph_from_polygon` and `ox.features_from_polygon`
+for elements that were not downloaded by OSMnx itself, for instance read from a
+local extract or downloaded tile by tile.
+"""
+
+import gzip
+import json
+import os
+import re
+import networkx as nx
+import osmnx as ox
+from osmnx._overpass import _get_network_filter
+from osmnx.features import _create_gdf
+from osmnx.graph import _create_graph
+
+
+def save_elements(response_jsons, filepath):
+    """Save elements in Overpass JSON format as a single compressed response."""
+    elements = [
+        element for response_json in response_jsons for element in response_json["elements"]
+    ]
+    with gzip.open(filepath + ".tmp", "wt", encoding="utf-8") as f:
+        json.dump({"elements": elements}, f)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def load_elements(filepath):
+    """Load elements saved with save_elements, as a list of responses."""
+    with gzip.open(filepath, "rt", encoding="utf-8") as f:
+        return [json.load(f)]
+
+
+def node_element(node, is_feature, in_bounds):
+    """Get a node element with its tags only if it is a feature or if OSMnx keeps one.
+
+    As in BC_get_raw_from_pbf, tags of nodes out of the bounds are not kept.
+    """
+    element = {key: node[key] for key in ["type", "id", "lat", "lon"]}
+    tags = node.get("tags", {})
+    if tags and (
+        is_feature or (in_bounds and set(ox.settings.useful_tags_node) & tags.keys())
+    ):
+        element["tags"] = dict(tags)
+    return element
+
+
+def select_nodes(response_jsons, bounds, tags=None):
+    """Select the nodes of elements as BC_get_raw_from_pbf selects them from an extract.
+
+    Overpass also returns the nodes of the members of relations and all the tags of
+    the nodes of the ways: only the nodes of the ways are kept, and the features
+    within the bounds (minx, miny, maxx, maxy) if the tags of a features query are
+    given, with their tags only if node_element keeps them. Returns the elements as
+    a single response.
+    """
+    elements = [
+        element for response_json in response_jsons for element in response_json["elements"]
+    ]
+    used = {ref for element in elements if element["type"] == "way" for ref in element["nodes"]}
+    minx, miny, maxx, maxy = bounds
+    selected = []
+    for element in elements:
+        if element["type"] != "node":
+            selected.append(element)
+            continue
+        is_in_bounds = minx <= element["lon"] <= maxx and miny <= element["lat"] <= maxy
+        is_feature = (
+            tags is not None and is_in_bounds and match_tags(element.get("tags", {}), tags)
+        )
+        if element["id"] in used or is_feature:
+            selected.append(node_element(element, is_feature, is_in_bounds))
+    return [{"elements": selected}]
+
+
+def buffer_polygon(polygon, dist=500):
+    """Buffer a polygon by a distance in meter, as OSMnx does before getting a graph."""
+    poly_proj, crs_utm = ox.projection.project_geometry(polygon)
+    poly_buff, _ = ox.projection.project_geometry(
+        poly_proj.buffer(dist), crs=crs_utm, to_latlong=True
+    )
+    return poly_buff
+
+
+def parse_way_filter(way_filter):
+    """Parse an Overpass way filter into a list of (key, operator, regex) conditions."""
+    return [
+        (key, op, re.compile(regex) if op else None)
+        for key, op, regex in re.findall(r'\["([^"]+)"(?:(!?~)"([^"]*)")?\]', way_filter)
+    ]
+
+
+def get_network_conditions(network_type):
+    """Get the conditions on the tags of the ways of an OSMnx network type."""
+    return parse_way_filter(_get_network_filter(network_type))
+
+
+def match_way_filter(tags, conditions):
+    """Check if the tags of a way pass the conditions of an Overpass way filter."""
+    for key, op, regex in conditions:
+        value = tags.get(key)
+        if not op and value is None:
+            return False
+        if op == "~" and (value is None or not regex.search(value)):
+            return False
+        if op == "!~" and value is not None and regex.search(value):
+            return False
+    return True
+
+
+def match_tags(tags, query_tags):
+    """Check if the tags of an element match the tags of an OSMnx features query."""
+    for key, value in query_tags.items():
+        if key not in tags:
+            continue
+        if value is True:
+            return True
+        if tags[key] in ([value] if isinstance(value, str) else value):
+            return True
+    return False
+
+
+def graph_from_elements(
+    response_jsons, polygon, network_type, retain_all=True, truncate_by_edge=False
+):
+    """Create the graph of the elements within a polygon, as ox.graph_from_polygon."""
+    # Elements should cover the polygon buffered by 500m, see buffer_polygon
+    poly_buff = buffer_polygon(polygon)
+    bidirectional = network_type in ox.settings.bidirectional_network_types
+    G_buff = _create_graph(response_jsons, bidirectional)
+    G_buff = ox.truncate.truncate_graph_polygon(
+        G_buff, poly_buff, truncate_by_edge=truncate_by_edge
+    )
+    if not retain_all:
+        G_buff = ox.truncate.largest_component(G_buff, strongly=False)
+    G = ox.truncate.truncate_graph_polygon(
+        G_buff, polygon, truncate_by_edge=truncate_by_edge
+    )
+    if not retain_all:
+        G = ox.truncate.largest_component(G, strongly=False)
+    spn = ox.stats.count_streets_per_node(G_buff, nodes=G.nodes)
+    nx.set_node_attributes(G, values=spn, name="street_count")
+    return G
+
+
+def features_from_elements(response_jsons, polygon, tags):
+    """Create the features of the elements within a polygon, as ox.features_from_polygon."""
+    return _create_gdf(response_jsons, polygon, tags)
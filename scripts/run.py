@@ -0,0 +1,127 @@
+"""Run stages of the pipeline for selected cities from the command line.
+
+    python run.py --stages D,E,G --cities Riga,Braga
+
+By default the tasks run one after the other in this process, city by city: the
+libraries a stage needs are imported only when it runs, and the tables loaded by
+a stage are kept in table_cache for the next stages of the city. With --tiled, the
+spatial queries of D, E and G run by tiles for the given cities. With --workers,
+the tasks run in the process pool of run_pipeline instead.
+"""
+
+import argparse
+import instrumentation
+import table_cache
+from config import CITIES
+from run_pipeline import FORCE, STAGES_TO_RUN, get_tasks, print_status, run_pipeline, run_task
+from stages import STAGES
+
+TABLE_CACHE_SIZE = 8  # Number of tables kept in memory between the stages of a city
+
+
+def run_in_process(
+    stages, cities, force=FORCE, cache_size=TABLE_CACHE_SIZE, tiled=None, tile_size=None
+):
+    """Run the stages for the cities in this process, continuing after a failure.
+
+    tiled are the cities processed by tiles of tile_size, instead of the ones of tiling.
+    """
+    if tiled is not None or tile_size is not None:
+        import tiling
+
+        tiling.TILED_CITIES = tiling.TILED_CITIES if tiled is None else tiled
+        tiling.TILE_SIZE = tiling.TILE_SIZE if tile_size is None else tile_size
+    tasks = get_tasks(stages, cities, force=force)
+    # Stages of the registry come after the ones they require
+    order = sorted(tasks, key=lambda task: (cities.index(task[0]), list(STAGES).index(task[1])))
+    table_cache.MAX_TABLES = cache_size
+    status = {}
+    steps = []
+    for cityname, stage in order:
+        if any(status[req]["status"] != "done" for req in tasks[(cityname, stage)]):
+            status[(cityname, stage)] = {
+                "status": "skipped",
+                "duration": None,
+                "error": "required task failed",
+            }
+            continue
+        print(f"Started {stage} for {cityname}")
+        duration, error, records = run_task(stage, cityname)
+        steps.extend(records)
+        status[(cityname, stage)] = {
+            "status": "failed" if error else "done",
+            "duration": duration,
+            "error": error,
+        }
+        print(f"{'Failed' if error else 'Finished'} {stage} for {cityname}")
+    table_cache.clear()
+    instrumentation.save_report(steps)
+    return status
+
+
+def parse_args(args=None):
+    """Parse the stages, cities and options of the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES_TO_RUN),
+        help="comma-separated stages to run, among " + ", ".join(STAGES),
+    )
+    parser.add_argument(
+        "--cities", default=",".join(CITIES), help="comma-separated cities to run"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=FORCE,
+        help="recompute even the stages that are up to date",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="run the tasks in a pool of this many processes instead",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=TABLE_CACHE_SIZE,
+        help="number of tables kept in memory between stages, 0 to disable",
+    )
+    parser.add_argument(
+        "--tiled",
+        default=None,
+        help="comma-separated cities processed by tiles in D, E and G",
+    )
+    parser.add_argument(
+        "--tile-size", type=float, default=None, help="side of the tiles in meter"
+    )
+    parsed = parser.parse_args(args)
+    parsed.stages = parsed.stages.split(",")
+    parsed.cities = parsed.cities.split(",")
+    if parsed.tiled is not None:
+        parsed.tiled = [cityname for cityname in parsed.tiled.split(",") if cityname]
+    if parsed.workers and (parsed.tiled is not None or parsed.tile_size is not None):
+        parser.error("--tiled and --tile-size only apply without --workers")
+    unknown = [stage for stage in parsed.stages if stage not in STAGES]
+    if unknown:
+        parser.error("unknown stages " + ", ".join(unknown))
+    return parsed
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.workers:
+        status = run_pipeline(
+            args.stages, args.cities, n_workers=args.workers, force=args.force
+        )
+    else:
+        status = run_in_process(
+            args.stages,
+            args.cities,
+            force=args.force,
+            cache_size=args.cache_size,
+            tiled=args.tiled,
+            tile_size=args.tile_size,
+        )
+    print_status(status)
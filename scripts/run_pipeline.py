@@ -0,0 +1,133 @@
+"""Run the pipeline stages for selected cities in parallel, one process per (city, stage) task."""
+
+import importlib
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from config import CITIES
+from stages import STAGES
+import instrumentation
+import stage_cache
+
+FORCE = False  # Recompute even the stages whose inputs, parameters and code are unchanged
+STAGES_TO_RUN = ["B", "C", "D", "E", "F", "G"]  # EG replaces E to G
+N_WORKERS = os.cpu_count()
+MEMORY_LIMIT_GB = (
+    0.8 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+)  # Memory that the running tasks together are allowed to use
+DEFAULT_MEMORY_GB = 2  # Memory estimated for a task of a city not in CITY_MEMORY_GB
+CITY_MEMORY_GB = {  # Memory estimated for a task of a large city
+    "Milan_metropolitan": 16,
+    "Riga": 6,
+    "Zaragoza": 6,
+}
+
+
+def run_task(stage, cityname):
+    """Run a stage for a city, returning the error instead of raising it, and its steps."""
+    start = time.perf_counter()
+    try:
+        module = importlib.import_module(STAGES[stage]["module"])
+        with instrumentation.task(stage, cityname):
+            getattr(module, STAGES[stage]["function"])(cityname)
+        stage_cache.record(stage, cityname)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return time.perf_counter() - start, error, instrumentation.pop_records()
+
+
+def get_tasks(stages, cities, force=FORCE):
+    """Get the (city, stage) tasks to run, with the tasks they must wait for."""
+    tasks = {task: [] for task in stage_cache.get_stale_tasks(stages, cities, force=force)}
+    # Only wait for required stages that are run, otherwise their output is used
+    for cityname, stage in tasks:
+        tasks[(cityname, stage)] = [
+            (cityname, req) for req in STAGES[stage]["requires"] if (cityname, req) in tasks
+        ]
+    return tasks
+
+
+def run_pipeline(
+    stages=STAGES_TO_RUN,
+    cities=CITIES,
+    n_workers=N_WORKERS,
+    memory_limit=MEMORY_LIMIT_GB,
+    force=FORCE,
+):
+    """Run the stages for the cities in a process pool, continuing after a failure."""
+    tasks = get_tasks(stages, cities, force=force)
+    status = {}
+    steps = []
+    running = {}
+    memory_used = 0
+    # Each task gets a fresh process so that the memory of a large city is released
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        while len(status) < len(tasks):
+            # Skip tasks whose required task failed or was skipped
+            for task, reqs in tasks.items():
+                if task not in status and any(
+                    status.get(req, {}).get("status") in ["failed", "skipped"]
+                    for req in reqs
+                ):
+                    status[task] = {
+                        "status": "skipped",
+                        "duration": None,
+                        "error": "required task failed",
+                    }
+            ready = [
+                task
+                for task, reqs in tasks.items()
+                if task not in status
+                and task not in running.values()
+                and all(status.get(req, {}).get("status") == "done" for req in reqs)
+            ]
+            # Start the largest tasks first, as long as they fit in memory
+            ready.sort(key=lambda task: -CITY_MEMORY_GB.get(task[0], DEFAULT_MEMORY_GB))
+            for cityname, stage in ready:
+                memory = CITY_MEMORY_GB.get(cityname, DEFAULT_MEMORY_GB)
+                if len(running) >= n_workers:
+                    break
+                if running and memory_used + memory > memory_limit:
+                    continue
+                future = executor.submit(run_task, stage, cityname)
+                running[future] = (cityname, stage)
+                memory_used += memory
+                print(f"Started {stage} for {cityname}")
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                cityname, stage = running.pop(future)
+                memory_used -= CITY_MEMORY_GB.get(cityname, DEFAULT_MEMORY_GB)
+                try:
+                    duration, error, records = future.result()
+                except Exception:  # Worker crashed, for instance killed when out of memory
+                    duration, error, records = None, traceback.format_exc(), []
+                steps.extend(records)
+                status[(cityname, stage)] = {
+                    "status": "failed" if error else "done",
+                    "duration": duration,
+                    "error": error,
+                }
+                print(f"{'Failed' if error else 'Finished'} {stage} for {cityname}")
+    instrumentation.save_report(steps)
+    return status
+
+
+def print_status(status):
+    """Print the errors of the tasks not done and the number of tasks done."""
+    failed = {task: val for task, val in status.items() if val["status"] != "done"}
+    for (cityname, stage), val in failed.items():
+        print(f"{stage} {val['status']} for {cityname}:\n{val['error']}")
+    print(f"{len(status) - len(failed)}/{len(status)} tasks done")
+
+
+if __name__ == "__main__":
+    print_status(run_pipeline())
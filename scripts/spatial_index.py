@@ -0,0 +1,91 @@
+"""Per-city spatial indexes shared by the stages and by notebooks.
+
+The projected CRS of a city is estimated once, from its boundary. Geometries of
+features, edges and nodes are projected once and saved as GeoParquet in the
+spatial_index folder of the city, and reused as long as the file they come from
+is unchanged. STRtrees are built from the projected geometries once per process:
+building a tree is faster than unpickling a saved one.
+"""
+
+import functools
+import json
+import os
+import geopandas as gpd
+import shapely
+from config import FOLDERPATH_CITIES, FOLDERPATH_POLY
+from graph_io import load_table
+from stage_cache import hash_file
+
+FOLDERNAME_INDEX = "spatial_index/"
+LAYERS = {  # Files of the geometries of each layer, in the folder of the city
+    "features_raw": "{city}_features_0_raw.gpkg",
+    "features": "{city}_features_3_dense.gpkg",
+    "edges": "{city}_graph_0_raw_edges.parquet",
+    "nodes": "{city}_graph_0_raw_nodes.parquet",
+}
+
+_trees = {}  # STRtrees built in this process, by city, layer and hash of the source
+
+
+@functools.cache
+def get_city_crs(cityname):
+    """Get the projected CRS of a city, the UTM zone of its boundary."""
+    return gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg").estimate_utm_crs()
+
+
+def _get_paths(cityname, layer):
+    """Get the paths of the source file of a layer and of its projected geometries."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    filepath = outfolder + FOLDERNAME_INDEX + layer
+    return outfolder + LAYERS[layer].format(city=cityname), filepath
+
+
+def _load_layer(cityname, layer, gdf=None):
+    """Get the projected geometries of a layer and the hash of their source file."""
+    source, filepath = _get_paths(cityname, layer)
+    known = {}
+    if os.path.exists(filepath + ".json"):
+        with open(filepath + ".json") as f:
+            known = json.load(f)
+    fingerprint = hash_file(source, known.get("source"))
+    crs = get_city_crs(cityname)
+    if (
+        known.get("source") == fingerprint
+        and known.get("crs") == crs.to_string()
+        and os.path.exists(filepath + ".parquet")
+    ):
+        projected = gpd.read_parquet(filepath + ".parquet").geometry
+        if gdf is None or projected.index.equals(gdf.index):
+            return projected, fingerprint[2]
+    if gdf is None:
+        if source.endswith(".parquet"):
+            gdf = load_table(source, columns=[])
+        else:
+            gdf = gpd.read_file(source, columns=[])
+    projected = gdf.geometry.to_crs(crs)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    # Replace the files at once, for processes reading them at the same time
+    projected.to_frame().to_parquet(filepath + ".parquet.tmp", index=True)
+    os.replace(filepath + ".parquet.tmp", filepath + ".parquet")
+    with open(filepath + ".json.tmp", "w") as f:
+        json.dump({"source": fingerprint, "crs": projected.crs.to_string()}, f)
+    os.replace(filepath + ".json.tmp", filepath + ".json")
+    return projected, fingerprint[2]
+
+
+def get_layer(cityname, layer, gdf=None):
+    """Get the geometries of a layer of a city in the projected CRS of the city.
+
+    gdf is the layer already loaded from its source file, projected only if the
+    saved geometries are outdated, otherwise the source file is read if needed.
+    """
+    return _load_layer(cityname, layer, gdf)[0]
+
+
+def get_tree(cityname, layer, gdf=None):
+    """Get the STRtree over the projected geometries of a layer of a city, and the geometries."""
+    projected, sha = _load_layer(cityname, layer, gdf)
+    key = (cityname, layer, sha)
+    if key not in _trees or not _trees[key][1].index.equals(projected.index):
+        _trees[key] = (shapely.STRtree(projected.values), projected)
+    return _trees[key]
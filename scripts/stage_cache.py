@@ -0,0 +1,129 @@
+"""Manifest-based cache deciding which (city, stage) must be recomputed.
+
+A stage is up to date for a city if the fingerprint of its input files, its
+parameters and its code is the one recorded after its last successful run, and if
+its output files still exist.
+"""
+
+import glob
+import hashlib
+import importlib
+import json
+import os
+from config import FOLDERPATH_CITIES
+from stages import STAGES
+
+
+def _manifest_path(stage, cityname):
+    """Get the path of the manifest of a stage for a city."""
+    return FOLDERPATH_CITIES + cityname + "/manifest/" + stage + ".json"
+
+
+def load_manifest(stage, cityname):
+    """Load the manifest of the last successful run of a stage, empty if none."""
+    path = _manifest_path(stage, cityname)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def hash_file(path, known=None):
+    """Hash the content of a file, reusing a known hash if size and mtime are the same."""
+    stat = os.stat(path)
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+
+
+def get_params(stage):
+    """Get the values of the parameters of a stage from its module."""
+    module = importlib.import_module(STAGES[stage]["module"])
+    return {param: getattr(module, param) for param in STAGES[stage]["params"]}
+
+
+def get_paths(stage, cityname, kind):
+    """Get the input or output paths of a stage for a city.
+
+    Paths with a * are patterns, replaced by the files matching them.
+    """
+    params = get_params(stage)
+    paths = [path.format(city=cityname, **params) for path in STAGES[stage][kind]]
+    return [
+        match
+        for path in paths
+        for match in (sorted(glob.glob(path)) if "*" in path else [path])
+    ]
+
+
+def get_fingerprint(stage, cityname, manifest=None):
+    """Get the hashes of the inputs, parameters and code of a stage for a city."""
+    manifest = manifest if manifest is not None else load_manifest(stage, cityname)
+    known_inputs = manifest.get("inputs", {})
+    module = importlib.import_module(STAGES[stage]["module"])
+    code = [module.__file__] + [
+        importlib.import_module(name).__file__ for name in STAGES[stage].get("code", [])
+    ]
+    params = json.dumps(get_params(stage), sort_keys=True, default=str)
+    return {
+        "inputs": {
+            path: hash_file(path, known_inputs.get(path)) if os.path.exists(path) else None
+            for path in get_paths(stage, cityname, "inputs")
+        },
+        "params": hashlib.sha256(params.encode()).hexdigest(),
+        "code": {os.path.basename(path): hash_file(path)[2] for path in code},
+    }
+
+
+def _same(fingerprint, manifest):
+    """Check if a fingerprint is the one of the manifest, ignoring file mtimes."""
+    if not manifest:
+        return False
+    for key in ["params", "code"]:
+        if fingerprint[key] != manifest[key]:
+            return False
+    inputs, known = fingerprint["inputs"], manifest["inputs"]
+    return inputs.keys() == known.keys() and all(
+        inputs[path] is not None and known[path] is not None
+        and inputs[path][2] == known[path][2]
+        for path in inputs
+    )
+
+
+def is_stale(stage, cityname):
+    """Check if a stage must be recomputed for a city."""
+    manifest = load_manifest(stage, cityname)
+    if not all(os.path.exists(path) for path in get_paths(stage, cityname, "outputs")):
+        return True
+    return not _same(get_fingerprint(stage, cityname, manifest), manifest)
+
+
+def record(stage, cityname):
+    """Record the fingerprint of a successful run of a stage for a city."""
+    path = _manifest_path(stage, cityname)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Hash inputs from scratch, they could have been modified during the run
+    fingerprint = get_fingerprint(stage, cityname, manifest={})
+    with open(path, "w") as f:
+        json.dump(fingerprint, f, indent=2)
+
+
+def get_stale_tasks(stages, cities, force=False):
+    """Get the stale (city, stage) tasks, invalidating later stages transitively."""
+    stale = set()
+    # Stages are ordered so that required stages are checked first
+    for stage in [stage for stage in STAGES if stage in stages]:
+        for cityname in cities:
+            inputs = set(get_paths(stage, cityname, "inputs"))
+            upstream = any(
+                (cityname, req) in stale
+                and inputs & set(get_paths(req, cityname, "outputs"))
+                for req in STAGES[stage]["requires"]
+            )
+            if force or upstream or is_stale(stage, cityname):
+                stale.add((cityname, stage))
+    return stale
@@ -0,0 +1,171 @@
+"""Registry of the pipeline stages, with their inputs, outputs and parameters."""
+
+from config import FOLDERPATH_POLY, FOLDERPATH_CITIES
+
+# Paths are formatted with the city name and the parameters of the stage, code lists
+# the local modules used by the stage besides its own
+STAGES = {
+    "A": {
+        "module": "A_get_city_boundaries",
+        "function": "get_city_boundary",
+        "requires": [],
+        "inputs": [],
+        "outputs": [FOLDERPATH_POLY + "{city}.gpkg"],
+        "params": ["FOLDERPATH_IN"],
+    },
+    "B": {
+        "module": "B_get_graph_raw",
+        "function": "get_graph_raw",
+        "requires": ["A"],
+        "inputs": [FOLDERPATH_POLY + "{city}.gpkg"],
+        "outputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_0_raw_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_0_raw_edges.parquet",
+        ],
+        "params": ["FALLBACK_SPEED", "USEFUL_TAGS", "NETWORK_TYPE", "SAVE_ELEMENTS"],
+        "code": ["tiled_download", "osm_elements", "graph_io"],
+    },
+    "C": {
+        "module": "C_get_features_raw",
+        "function": "get_features_raw",
+        "requires": ["A"],
+        "inputs": [FOLDERPATH_POLY + "{city}.gpkg"],
+        "outputs": [FOLDERPATH_CITIES + "{city}/{city}_features_0_raw.gpkg"],
+        "params": ["AMENITIES_DICT", "SAVE_ELEMENTS"],
+        "code": ["tiled_download", "osm_elements"],
+    },
+    "D": {
+        "module": "D_process_features",
+        "function": "process_features",
+        "requires": ["C"],
+        "inputs": [FOLDERPATH_CITIES + "{city}/{city}_features_0_raw.gpkg"],
+        "outputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_features_1_classified.gpkg",
+            FOLDERPATH_CITIES + "{city}/{city}_features_2_classified_wols.gpkg",
+            FOLDERPATH_CITIES + "{city}/{city}_features_3_dense.gpkg",
+        ],
+        "params": ["FEATURE_RULES", "BUFFER_DUPLICATE_LS"],
+        "code": ["geometry_dedup", "spatial_index", "tiling"],
+    },
+    "E": {
+        "module": "E_process_graph",
+        "function": "process_graph",
+        "requires": ["B", "D"],
+        "inputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_0_raw_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_0_raw_edges.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_features_3_dense.gpkg",
+        ],
+        # _graph_1_all is only saved with SAVE_GRAPH_ALL
+        "outputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_edges.parquet",
+        ],
+        "params": [
+            "HIGHWAY_DICT",
+            "NEAR_DISTANCES",
+            "NEAR_COLUMNS",
+            "NEAREST_MAX_DISTANCE",
+            "SAVE_GRAPH_ALL",
+        ],
+        "code": ["graph_io", "spatial_index", "tiling"],
+    },
+    "F": {
+        "module": "F_compute_centrality_optional",
+        "function": "compute_centrality",
+        "requires": ["E"],
+        "inputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_edges.parquet",
+        ],
+        "outputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_3_metrics_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_3_metrics_edges.parquet",
+        ],
+        "params": [
+            "APPROXIMATE",
+            "N_SAMPLES",
+            "ERROR_BOUND",
+            "CONFIDENCE",
+            "SEED",
+            "CUTOFFS",
+        ],
+        "code": ["betweenness", "graph_io"],
+    },
+    "G": {
+        "module": "G_merge_graph_features",
+        "function": "merge_graph_features",
+        "requires": ["D", "E", "F"],
+        "inputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_{SUFFIX_GRAPH}_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_{SUFFIX_GRAPH}_edges.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_features_3_dense.gpkg",
+        ],
+        "outputs": [FOLDERPATH_CITIES + "{city}/{city}_all.gpkg"],
+        "params": ["SUFFIX_GRAPH"],
+        "code": ["geometry_dedup", "graph_io", "tiling"],
+    },
+    # Fused alternative to E, F and G, run instead of them
+    "EG": {
+        "module": "EG_process_merge_fused",
+        "function": "process_merge_fused",
+        "requires": ["B", "D"],
+        "inputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_0_raw_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_0_raw_edges.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_features_3_dense.gpkg",
+        ],
+        "outputs": [FOLDERPATH_CITIES + "{city}/{city}_all.gpkg"],
+        "params": ["WITH_CENTRALITY", "SAVE_INTERMEDIATE"],
+        # Parameters of E, F and G are in their code
+        "code": [
+            "E_process_graph",
+            "F_compute_centrality_optional",
+            "betweenness",
+            "G_merge_graph_features",
+            "geometry_dedup",
+            "graph_io",
+            "spatial_index",
+            "tiling",
+        ],
+    },
+    # Only run for the cities with crash files
+    "H": {
+        "module": "H_snap_crashes",
+        "function": "snap_crashes",
+        "requires": ["E"],
+        "inputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_nodes.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_edges.parquet",
+            "{FOLDERPATH_CRASHES}{city}/*.csv",
+            "{FOLDERPATH_CRASHES}{city}/*.parquet",
+        ],
+        "outputs": [
+            FOLDERPATH_CITIES + "{city}/{city}_crashes_snapped.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_crash_counts.parquet",
+        ],
+        "params": [
+            "FOLDERPATH_CRASHES",
+            "COORDINATE_COLUMNS",
+            "CRASHES_CRS",
+            "MAX_DISTANCE_EDGE",
+            "MAX_DISTANCE_NODE",
+            "EDGE_ATTRIBUTES",
+        ],
+        "code": ["graph_io", "spatial_index"],
+    },
+    # Partial aggregates of the statistics of a city, combined by I_compute_statistics
+    "I": {
+        "module": "I_compute_statistics",
+        "function": "compute_statistics",
+        "requires": ["A", "D", "E"],
+        "inputs": [
+            FOLDERPATH_POLY + "{city}.gpkg",
+            FOLDERPATH_CITIES + "{city}/{city}_graph_2_dense_edges.parquet",
+            FOLDERPATH_CITIES + "{city}/{city}_features_3_dense.gpkg",
+        ],
+        "outputs": [FOLDERPATH_CITIES + "{city}/{city}_statistics.json"],
+        "params": ["PARTIALS"],
+        "code": ["graph_io", "spatial_index"],
+    },
+}
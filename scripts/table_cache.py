@@ -0,0 +1,35 @@
+"""Bounded cache of the tables loaded by the stages run in the same process.
+
+When several stages run for a city in one process, the tables one stage saves
+and the next ones load, like the dense features loaded by E and G, are read from
+disk once. A table is reused as long as the size and modification time of its
+file are unchanged, and each load gets its own copy, as stages modify them. The
+cache is disabled by default, as the processes of run_pipeline run a single task.
+"""
+
+import collections
+import os
+
+MAX_TABLES = 0  # Number of tables kept in memory, the least recently used being removed
+
+_tables = collections.OrderedDict()  # Tables by loader and arguments, with their file stat
+
+
+def load(loader, filepath, **kwargs):
+    """Load a table from a file with a loader, or copy it if it was loaded before."""
+    if not MAX_TABLES:
+        return loader(filepath, **kwargs)
+    stat = os.stat(filepath)
+    fingerprint = (stat.st_size, stat.st_mtime_ns)
+    key = (loader.__module__, loader.__qualname__, filepath, repr(sorted(kwargs.items())))
+    if key not in _tables or _tables[key][0] != fingerprint:
+        _tables[key] = (fingerprint, loader(filepath, **kwargs))
+    _tables.move_to_end(key)
+    while len(_tables) > MAX_TABLES:
+        _tables.popitem(last=False)
+    return _tables[key][1].copy()
+
+
+def clear():
+    """Remove all the tables from the cache."""
+    _tables.clear()
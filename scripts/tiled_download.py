@@ -0,0 +1,148 @@
+"""Download graphs and features from Overpass in tiles fetched concurrently.
+
+Large boundaries, like Milan_metropolitan which is a MultiPolygon, are split into
+square tiles, every part of a MultiPolygon included. The tiles are fetched with
+bounded parallelism and retried with backoff, also when Overpass is busy (429 or
+504) where OSMnx would wait a fixed time, then stitched into one graph or
+GeoDataFrame, without duplicated nodes, ways or features.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import osmnx as ox
+import requests
+import shapely
+from osmnx import _http
+from osmnx._errors import InsufficientResponseError, ResponseStatusCodeError
+from osmnx._overpass import (
+    _download_overpass_features,
+    _download_overpass_network,
+    _get_overpass_pause,
+)
+from osmnx.projection import project_geometry
+import http_cache
+from osm_elements import buffer_polygon, features_from_elements, graph_from_elements
+
+TILE_SIZE = 10000  # Side of the square tiles in meter
+MAX_WORKERS = 2  # Number of tiles fetched at the same time, public Overpass has 2 slots
+MAX_RETRIES = 5  # Number of times a tile is fetched again after an error
+BACKOFF = 10  # Pause in second before fetching again, doubled after each error
+OVERPASS_URL = None  # Overpass server to use instead of OSMnx's, e.g. a local one
+
+
+def make_tiles(polygon, tile_size=TILE_SIZE):
+    """Split a Polygon or MultiPolygon into Polygons within square tiles."""
+    poly_proj, crs_proj = project_geometry(polygon)
+    minx, miny, maxx, maxy = poly_proj.bounds
+    xs = np.arange(minx, maxx, tile_size)
+    ys = np.arange(miny, maxy, tile_size)
+    boxes = shapely.box(
+        *np.meshgrid(xs, ys), *np.meshgrid(xs + tile_size, ys + tile_size)
+    ).ravel()
+    pieces = shapely.intersection(boxes, poly_proj)
+    tiles = []
+    for piece in pieces[~shapely.is_empty(pieces)]:
+        # Keep every polygon of the intersection, e.g. from each part of a MultiPolygon
+        for part in shapely.get_parts(piece):
+            if isinstance(part, shapely.Polygon) and part.area > 0:
+                tiles.append(project_geometry(part, crs=crs_proj, to_latlong=True)[0])
+    return tiles
+
+
+def _overpass_request(data):
+    """Send an Overpass request once, as OSMnx does, failing if Overpass is busy."""
+    url = ox.settings.overpass_url.rstrip("/") + "/interpreter"
+    _http._config_dns(ox.settings.overpass_url)
+    time.sleep(_get_overpass_pause(ox.settings.overpass_url))
+    response = requests.post(
+        url,
+        data=data,
+        timeout=ox.settings.requests_timeout,
+        headers=_http._get_http_headers(),
+        **ox.settings.requests_kwargs,
+    )
+    # The tile is fetched again with backoff, instead of OSMnx's fixed pause
+    if response.status_code in {429, 504}:
+        raise ResponseStatusCodeError(
+            f"{url} responded {response.status_code} {response.reason}"
+        )
+    response_json = _http._parse_response(response)
+    if not isinstance(response_json, dict):
+        raise InsufficientResponseError("Overpass API did not return a dict of results.")
+    return response_json
+
+
+def fetch_tile(download, tile, *args, max_retries=MAX_RETRIES, backoff=BACKOFF):
+    """Fetch the Overpass responses of a tile, retrying after a network error."""
+    for attempt in range(max_retries + 1):
+        try:
+            return list(download(tile, *args))
+        except (requests.exceptions.RequestException, ResponseStatusCodeError):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def fetch_tiles(download, tiles, *args, max_workers=MAX_WORKERS):
+    """Fetch the tiles concurrently and merge their responses into one."""
+    if OVERPASS_URL is not None:
+        ox.settings.overpass_url = OVERPASS_URL
+    http_cache.install(_overpass_request)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = executor.map(
+            lambda tile: fetch_tile(
+                download, tile, *args, max_retries=MAX_RETRIES, backoff=BACKOFF
+            ),
+            tiles,
+        )
+        return merge_responses(
+            [response for tile_responses in responses for response in tile_responses]
+        )
+
+
+def merge_responses(response_jsons):
+    """Merge Overpass responses into one, keeping a single copy of each element."""
+    elements = {}
+    for response_json in response_jsons:
+        for element in response_json["elements"]:
+            elements.setdefault((element["type"], element["id"]), element)
+    return [{"elements": list(elements.values())}]
+
+
+def download_graph_elements(
+    polygon, network_type, tile_size=TILE_SIZE, max_workers=MAX_WORKERS
+):
+    """Download by tiles the OSM elements of the graph within a polygon buffered as OSMnx does."""
+    tiles = make_tiles(buffer_polygon(polygon), tile_size)
+    return fetch_tiles(
+        _download_overpass_network, tiles, network_type, None, max_workers=max_workers
+    )
+
+
+def download_features_elements(
+    polygon, tags, tile_size=TILE_SIZE, max_workers=MAX_WORKERS
+):
+    """Download by tiles the OSM elements of the features within a polygon."""
+    tiles = make_tiles(polygon, tile_size)
+    return fetch_tiles(_download_overpass_features, tiles, tags, max_workers=max_workers)
+
+
+def graph_from_polygon_tiled(
+    polygon,
+    network_type,
+    tile_size=TILE_SIZE,
+    max_workers=MAX_WORKERS,
+    retain_all=True,
+):
+    """Get the unsimplified graph within a polygon, as ox.graph_from_polygon, by tiles."""
+    response_jsons = download_graph_elements(
+        polygon, network_type, tile_size, max_workers
+    )
+    return graph_from_elements(response_jsons, polygon, network_type, retain_all=retain_all)
+
+
+def features_from_polygon_tiled(polygon, tags, tile_size=TILE_SIZE, max_workers=MAX_WORKERS):
+    """Get the features within a polygon, as ox.features_from_polygon, by tiles."""
+    response_jsons = download_features_elements(polygon, tags, tile_size, max_workers)
+    return features_from_elements(response_jsons, polygon, tags)
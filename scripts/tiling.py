@@ -0,0 +1,93 @@
+"""Split the spatial queries of a city into tiles processed in parallel, with a halo.
+
+Each row of a file is owned by the tile containing the centre of its bounding
+box, so that it is processed once. A tile reads the rows of the files it needs
+within the bounds of its own rows expanded by a halo, so that every neighbour
+within the halo is seen as in an untiled run, and only the tile is in memory.
+Results are returned in the order of the tiles, for deterministic merges.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pyogrio
+from pyproj import Transformer
+from spatial_index import get_city_crs
+
+TILE_SIZE = 5000  # Side of the tiles in meter, read when the tiles are made
+N_WORKERS = os.cpu_count()  # Number of tiles processed at the same time
+TILED_CITIES = ["Milan_metropolitan"]  # Cities processed by tiles, too large for one go
+
+
+def read_bounds(filepath):
+    """Get the keys and lon/lat bounds of the rows of a GeoPackage or GeoParquet file.
+
+    Keys are the FIDs for a GeoPackage and the index for a GeoParquet file, as
+    given by gpd.read_file(fid_as_index=True) and gpd.read_parquet.
+    """
+    if not filepath.endswith(".parquet"):
+        fids, bounds = pyogrio.read_bounds(filepath)
+        return fids, bounds.T
+    index_columns = pq.read_schema(filepath).pandas_metadata["index_columns"]
+    table = pq.read_table(filepath, columns=index_columns + ["bbox"])
+    bbox = table.column("bbox").combine_chunks()
+    bounds = np.column_stack(
+        [bbox.field(name).to_numpy() for name in ["xmin", "ymin", "xmax", "ymax"]]
+    )
+    keys = pd.MultiIndex.from_arrays(
+        [table.column(name).to_numpy() for name in index_columns], names=index_columns
+    )
+    if len(index_columns) == 1:
+        keys = keys.get_level_values(0)
+    return keys, bounds
+
+
+def get_tiles(cityname, filepath, halo, tile_size=None):
+    """Get the keys of the rows owned by each tile and the lon/lat bounds it must read.
+
+    Tiles are of TILE_SIZE if tile_size is not given.
+    """
+    tile_size = TILE_SIZE if tile_size is None else tile_size
+    keys, bounds = read_bounds(filepath)
+    crs = get_city_crs(cityname)
+    to_proj = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    to_lonlat = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+    x, y = to_proj.transform(
+        (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2
+    )
+    cells = np.column_stack(
+        [np.floor((x - x.min()) / tile_size), np.floor((y - y.min()) / tile_size)]
+    ).astype(np.int64)
+    tiles = []
+    for cell in np.unique(cells, axis=0):
+        owned = np.flatnonzero((cells == cell).all(axis=1))
+        minx, miny, maxx, maxy = to_proj.transform_bounds(
+            bounds[owned, 0].min(),
+            bounds[owned, 1].min(),
+            bounds[owned, 2].max(),
+            bounds[owned, 3].max(),
+        )
+        bbox = to_lonlat.transform_bounds(
+            minx - halo, miny - halo, maxx + halo, maxy + halo
+        )
+        tiles.append((keys[owned], bbox))
+    return tiles
+
+
+def run_tiles(function, cityname, tiles, n_workers=N_WORKERS):
+    """Run a function on each tile, given the city, keys and bounds, in a process pool."""
+    with ProcessPoolExecutor(
+        max_workers=min(n_workers, len(tiles)) or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        return list(
+            executor.map(
+                function,
+                [cityname] * len(tiles),
+                [keys for keys, _ in tiles],
+                [bbox for _, bbox in tiles],
+            )
+        )
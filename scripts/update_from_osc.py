@@ -0,0 +1,582 @@
+"""Update the raw graphs and features of cities from OSM change files, then D and E.
+
+OSM change files (.osc, .osc.gz, e.g. the daily diffs of Geofabrik) put in
+FOLDERPATH_CHANGES are applied in order to the OSM elements saved by B, C and BC
+with SAVE_ELEMENTS. Only the part of the raw graph around the changed nodes and
+ways is rebuilt, simplified as OSMnx does it for the whole graph: an edge of the
+simplified graph only depends on the nodes it goes through and on their incident
+ways, so the edges not going through a changed node are the same. Only the
+changed features are rebuilt. D and E are then only recomputed for the changed
+features and edges and for the edges near the changed features, if they were up
+to date.
+"""
+
+import json
+import os
+from itertools import chain
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+import tqdm
+from osmnx._errors import InsufficientResponseError
+from osmnx.graph import _create_graph
+from osmnx.simplification import _build_path, _is_endpoint
+from B_get_graph_raw import (
+    EDGE_ATTRS_DIFFER,
+    NETWORK_TYPE,
+    add_edge_attributes,
+    add_useful_tags,
+    get_change_files,
+    get_intersections,
+    get_speeds,
+)
+from BC_get_raw_from_pbf import FOLDERPATH_PBF, PBF_EXTRACTS
+from C_get_features_raw import save_features_raw
+from config import AMENITIES_DICT, CITIES, FOLDERPATH_CITIES, FOLDERPATH_POLY
+from D_process_features import (
+    BUFFER_DUPLICATE_LS,
+    classify_features,
+    find_duplicates,
+    save_features_cleaned,
+)
+from E_process_graph import (
+    NEAR_DISTANCES,
+    NEAREST_MAX_DISTANCE,
+    add_proximity,
+    add_road_attributes,
+    drop_useless_attributes,
+)
+from graph_io import load_graph_tables, save_graph_tables
+from instrumentation import step
+from osm_changes import apply_changes, read_changes
+from osm_elements import buffer_polygon, features_from_elements, load_elements, save_elements
+import geometry_dedup
+import spatial_index
+
+
+def _get_paths(cityname, kind):
+    """Get the paths of the OSM elements of the graph or features of a city and of their state."""
+    filepath = FOLDERPATH_CITIES + cityname + "/" + cityname + "_osm_" + kind
+    return filepath + ".json.gz", filepath + "_changes.json"
+
+
+def get_pending_changes(cityname):
+    """Get the change files not yet applied to the elements of a city, None if not saved."""
+    applied = []
+    for kind in ["graph", "features"]:
+        filepath, filepath_state = _get_paths(cityname, kind)
+        if not (os.path.exists(filepath) and os.path.exists(filepath_state)):
+            return None
+        with open(filepath_state) as f:
+            applied.append(set(json.load(f)))
+    # Elements of the graph and features are updated together
+    return [path for path in get_change_files() if path not in applied[0] | applied[1]]
+
+
+def load_city_elements(cityname, kind):
+    """Load the elements of the graph or features of a city by (type, id) key."""
+    (response_json,) = load_elements(_get_paths(cityname, kind)[0])
+    return {(element["type"], element["id"]): element for element in response_json["elements"]}
+
+
+def save_city_elements(cityname, kind, elements, applied):
+    """Save the elements of the graph or features of a city with the change files applied."""
+    filepath, filepath_state = _get_paths(cityname, kind)
+    save_elements([{"elements": list(elements.values())}], filepath)
+    with open(filepath_state, "w") as f:
+        json.dump(sorted(applied), f, indent=2)
+
+
+def get_extract(cityname):
+    """Get the path of the extract covering a city, None if there is none."""
+    for filename, cities in PBF_EXTRACTS.items():
+        if cityname in cities and os.path.exists(FOLDERPATH_PBF + filename):
+            return FOLDERPATH_PBF + filename
+    return None
+
+
+def _ranges(starts, stops):
+    """Get the concatenated ranges of positions from starts to stops."""
+    counts = stops - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+
+def index_ways(elements):
+    """Index the ways of the elements by their nodes.
+
+    Returns the keys of the ways, and the sorted node ids of the ways with the
+    positions of their ways in the keys, each way once per node.
+    """
+    keys = [key for key in elements if key[0] == "way"]
+    lengths = [len(elements[key]["nodes"]) for key in keys]
+    refs = np.fromiter(
+        chain.from_iterable(elements[key]["nodes"] for key in keys),
+        dtype=np.int64,
+        count=sum(lengths),
+    )
+    owners = np.repeat(np.arange(len(keys), dtype=np.int64), lengths)
+    pairs = np.unique(refs * len(keys) + owners) if len(keys) else refs
+    return keys, pairs // max(len(keys), 1), pairs % max(len(keys), 1)
+
+
+def build_local_graph(elements, index, nodes, polygon, poly_buff):
+    """Build the graph of the ways through some nodes, as graph_from_elements.
+
+    Returns the graph truncated by the polygon and by the buffered polygon, and
+    the nodes whose ways are all in the graph, the ones that are as in the graph
+    of the whole city.
+    """
+    keys, refs, owners = index
+    nodes = np.fromiter(nodes, dtype=np.int64)
+    positions = np.unique(
+        owners[_ranges(np.searchsorted(refs, nodes), np.searchsorted(refs, nodes, "right"))]
+    )
+    G_empty = nx.MultiDiGraph(crs=ox.settings.default_crs)
+    if not len(positions):
+        return G_empty, G_empty, set()
+    # Ways in the order of the elements, for the same order of the edges of each node
+    ways = [elements[keys[position]] for position in positions]
+    refs_ways = sorted({ref for way in ways for ref in way["nodes"]})
+    response_json = {
+        "elements": [elements[("node", ref)] for ref in refs_ways if ("node", ref) in elements]
+        + ways
+    }
+    bidirectional = NETWORK_TYPE in ox.settings.bidirectional_network_types
+    G_buff = _create_graph([response_json], bidirectional)
+    try:
+        G_buff = ox.truncate.truncate_graph_polygon(G_buff, poly_buff)
+        G = ox.truncate.truncate_graph_polygon(G_buff, polygon)
+    except ValueError:
+        return G_empty, G_empty, set()
+    ids = np.fromiter(G.nodes, dtype=np.int64, count=len(G))
+    starts, stops = np.searchsorted(refs, ids), np.searchsorted(refs, ids, "right")
+    inside = np.isin(owners[_ranges(starts, stops)], positions)
+    n_inside = np.bincount(
+        np.repeat(np.arange(len(ids)), stops - starts)[inside], minlength=len(ids)
+    )
+    return G, G_buff, set(ids[n_inside == stops - starts].tolist())
+
+
+def get_region(elements, index, starts, polygon, poly_buff):
+    """Get the region of the simplified graph around nodes, in the graph of the ways through it.
+
+    The region is made of the interstitial nodes connected to the nodes through
+    interstitial nodes, the corridor, and of the endpoints around it, starting
+    nodes being passed through even if they are endpoints. Ways are added until
+    the incident ways of all these nodes are in the graph. Returns the graph,
+    truncated and buffered, with the endpoints and the corridor of the region.
+    """
+    needed = set(starts)
+    while True:
+        G, G_buff, complete = build_local_graph(elements, index, needed, polygon, poly_buff)
+        endpoints, corridor, visited, missing = set(), set(), set(), set()
+        stack = [n for n in starts if n in G]
+        while stack:
+            n = stack.pop()
+            if n in visited:
+                continue
+            visited.add(n)
+            if n not in complete:
+                missing.add(n)
+                continue
+            if _is_endpoint(G, n, None, EDGE_ATTRS_DIFFER):
+                endpoints.add(n)
+                if n not in starts:
+                    continue
+            else:
+                corridor.add(n)
+            stack.extend(nx.all_neighbors(G, n))
+        if not missing:
+            return G, G_buff, endpoints, corridor
+        needed |= missing
+
+
+def get_changed_pairs(G, endpoints, corridor, seeds):
+    """Get the (u, v) pairs of the edges of the simplified graph going through the seeds."""
+    pairs = set()
+    for u in endpoints:
+        for successor in G.successors(u):
+            if successor in corridor:
+                pairs.add((u, _build_path(G, u, successor, endpoints)[-1]))
+            elif successor in endpoints and (u in seeds or successor in seeds):
+                pairs.add((u, successor))
+    return pairs
+
+
+def _path_attributes(G, path):
+    """Get the attributes of the edge simplifying a path, as ox.simplify_graph."""
+    path_attributes = {}
+    for u, v in zip(path[:-1], path[1:]):
+        edge_data = next(iter(G.get_edge_data(u, v).values()))
+        for attr in edge_data:
+            path_attributes.setdefault(attr, []).append(edge_data[attr])
+    for attr, values in path_attributes.items():
+        if attr == "length":
+            path_attributes[attr] = sum(values)
+        elif len(set(values)) == 1:
+            path_attributes[attr] = values[0]
+        else:
+            path_attributes[attr] = list(set(values))
+    path_attributes["geometry"] = shapely.LineString(
+        [(G.nodes[n]["x"], G.nodes[n]["y"]) for n in path]
+    )
+    return path_attributes
+
+
+def get_edge_rows(G, endpoints, pairs):
+    """Get the edges of the simplified graph between the pairs of nodes, with their keys.
+
+    Edges between endpoints are kept, and each path from an endpoint gets the next
+    key between its ends, in the order of the successors of the endpoint.
+    """
+    rows = {}
+    for u in sorted({u for u, _ in pairs}):
+        if u not in endpoints:
+            continue
+        targets = {v for o, v in pairs if o == u}
+        for v in targets & endpoints:
+            for key, data in G.get_edge_data(u, v, default={}).items():
+                geometry = shapely.LineString(
+                    [(G.nodes[n]["x"], G.nodes[n]["y"]) for n in [u, v]]
+                )
+                rows[(u, v, key)] = {**data, "geometry": geometry}
+        ranks = {}
+        for successor in G.successors(u):
+            if successor in endpoints:
+                continue
+            path = _build_path(G, u, successor, endpoints)
+            v = path[-1]
+            ranks[v] = ranks.get(v, 0) + 1
+            if v in targets:
+                key = G.number_of_edges(u, v) + ranks[v] - 1
+                rows[(u, v, key)] = _path_attributes(G, path)
+    return rows
+
+
+def _to_frame(rows, names):
+    """Make a table of rows by index, named even if there is no row."""
+    frame = pd.DataFrame.from_dict(rows, orient="index")
+    if len(names) > 1:
+        frame.index = pd.MultiIndex.from_tuples(list(rows), names=names)
+    else:
+        frame.index = pd.Index(list(rows), dtype=np.int64, name=names[0])
+    return frame
+
+
+def update_graph_raw(cityname, old_elements, elements, changed, polygon):
+    """Update the raw graph of a city around the changed elements of its graph.
+
+    Returns the keys of the edges and the ids of the nodes whose rows changed.
+    """
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    poly_buff = buffer_polygon(polygon)
+    seeds = {key[1] for key in changed if key[0] == "node"}
+    for key in changed:
+        if key[0] == "way":
+            for element in [old_elements.get(key), elements.get(key)]:
+                if element is not None:
+                    seeds.update(element["nodes"])
+    with step("simplify_region", rows=len(seeds)) as record:
+        old_index, index = index_ways(old_elements), index_ways(elements)
+        G_old, _, endpoints_old, corridor_old = get_region(
+            old_elements, old_index, seeds, polygon, poly_buff
+        )
+        pairs = get_changed_pairs(G_old, endpoints_old, corridor_old, seeds)
+        G, _, endpoints, corridor = get_region(elements, index, seeds, polygon, poly_buff)
+        pairs |= get_changed_pairs(G, endpoints, corridor, seeds)
+        # All the edges between the pairs, for their keys
+        G, G_buff, endpoints, corridor = get_region(
+            elements, index, seeds | {u for u, _ in pairs}, polygon, poly_buff
+        )
+        rows = get_edge_rows(G, endpoints, pairs)
+        kept = endpoints | {v for _, v, _ in rows}
+        record["rows_out"] = len(rows)
+    with step("load"):
+        gdf_nodes, gdf_edges = load_graph_tables(outfolder + cityname + "_graph_0_raw")
+    with step("update", rows=len(rows)):
+        removed = gdf_edges.index.droplevel("key").isin(list(pairs))
+        new_edges = _to_frame(rows, ["u", "v", "key"])
+        new_edges = add_edge_attributes(
+            new_edges.reindex(
+                columns=list(new_edges.columns)
+                + [c for c in ["highway", "cycleway", "footway"] if c not in new_edges]
+            )
+        )
+        gdf_edges = pd.concat([gdf_edges[~removed], new_edges])
+        gdf_edges = gdf_edges.dropna(axis="columns", how="all")
+        gdf_edges = gpd.GeoDataFrame(gdf_edges, geometry="geometry", crs=ox.settings.default_crs)
+        # Speeds of the edges without maxspeed depend on all the edges of their highway
+        gdf_edges["speed_kph"] = get_speeds(gdf_edges["highway"], gdf_edges["maxspeed"])
+        gdf_edges["travel_time"] = (gdf_edges["length"] / 1000) / (
+            gdf_edges["speed_kph"] / (60 * 60)
+        )
+        # Nodes of the region, those left unchanged in the old region being kept
+        region = endpoints | corridor
+        dropped = (endpoints_old | corridor_old) & seeds - region
+        nodes = sorted(kept & set(G.nodes))
+        street_count = ox.stats.count_streets_per_node(G_buff, nodes=nodes)
+        new_nodes = _to_frame(
+            {
+                n: {
+                    **G.nodes[n],
+                    "street_count": street_count[n],
+                    "geometry": shapely.Point(G.nodes[n]["x"], G.nodes[n]["y"]),
+                }
+                for n in nodes
+            },
+            ["osmid"],
+        )
+        gdf_nodes = pd.concat(
+            [gdf_nodes[~gdf_nodes.index.isin(list(region | dropped))], new_nodes]
+        )
+        # Intersections depend on the edges of the nodes
+        touched = {n for pair in pairs for n in pair} | set(new_nodes.index)
+        touched = np.array(sorted(touched & set(gdf_nodes.index)), dtype=np.int64)
+        u = gdf_edges.index.get_level_values(0)
+        v = gdf_edges.index.get_level_values(1)
+        incident = np.isin(u, touched) | np.isin(v, touched)
+        intersection = gdf_nodes["intersection"].astype(object).copy()
+        intersection.loc[touched] = get_intersections(touched, u[incident], v[incident])
+        gdf_nodes["intersection"] = intersection.astype(bool)
+        gdf_nodes = gdf_nodes.dropna(axis="columns", how="all")
+        gdf_nodes = gpd.GeoDataFrame(gdf_nodes, geometry="geometry", crs=ox.settings.default_crs)
+    with step("save", rows=len(gdf_edges)):
+        save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_0_raw")
+    return set(new_edges.index), set(touched.tolist())
+
+
+def update_features_raw(cityname, elements, changed, polygon):
+    """Rebuild the changed features of a city in its raw features."""
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    # Changed elements and the elements they are made of
+    keys = {key for key in changed if key in elements}
+    for key in list(keys):
+        if key[0] == "relation":
+            keys.update(
+                ("way", m["ref"])
+                for m in elements[key]["members"]
+                if m["type"] == "way" and ("way", m["ref"]) in elements
+            )
+    for key in list(keys):
+        if key[0] == "way":
+            keys.update(
+                ("node", ref) for ref in elements[key]["nodes"] if ("node", ref) in elements
+            )
+    # Copied as OSMnx modifies the elements
+    subset = [json.loads(json.dumps(elements[key])) for key in elements if key in keys]
+    with step("build_features", rows=len(subset)) as record:
+        try:
+            new_rows = features_from_elements([{"elements": subset}], polygon, AMENITIES_DICT)
+        except InsufficientResponseError:
+            new_rows = gpd.GeoDataFrame(geometry=[], crs=ox.settings.default_crs)
+            new_rows.index = pd.MultiIndex.from_tuples([], names=["element", "id"])
+        new_rows = new_rows[new_rows.index.isin(list(changed))]
+        record["rows_out"] = len(new_rows)
+    with step("update", rows=len(new_rows)):
+        gdf = gpd.read_file(outfolder + cityname + "_features_0_raw.gpkg")
+        gdf = gdf.set_index(["element", "id"])
+        gdf = gdf[~gdf.index.isin(list(changed))]
+        gdf = pd.concat([gdf, new_rows.astype({c: object for c in new_rows if c != "geometry"})])
+        gdf = gpd.GeoDataFrame(gdf, geometry="geometry", crs=ox.settings.default_crs)
+        gdf = gdf.sort_index().dropna(axis="columns", how="all")
+    with step("save", rows=len(gdf)):
+        save_features_raw(gdf, cityname)
+
+
+def update_features(cityname, changed):
+    """Update the classified and cleaned features of a city for its changed features.
+
+    Returns the geometries of the dense features added, changed or removed, at their
+    old and new place.
+    """
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    with step("load") as record:
+        gdf = gpd.read_file(outfolder + cityname + "_features_0_raw.gpkg")
+        old = gpd.read_file(outfolder + cityname + "_features_1_classified.gpkg")
+        cleaned_ids = gpd.read_file(
+            outfolder + cityname + "_features_2_classified_wols.gpkg",
+            columns=["id"],
+            ignore_geometry=True,
+        )["id"]
+        old_dense = gpd.read_file(outfolder + cityname + "_features_3_dense.gpkg")
+        record["rows_out"] = len(gdf)
+    keys = pd.MultiIndex.from_frame(gdf[["element", "id"]])
+    old_keys = pd.MultiIndex.from_frame(old[["element", "id"]])
+    is_changed = keys.isin(list(changed))
+    with step("classify", rows=int(is_changed.sum())):
+        gdf = gdf.set_index("id")
+        types = pd.Series(old["type"].values, index=old_keys).reindex(keys).values
+        types[is_changed], _ = classify_features(gdf[is_changed])
+        # Features of no type are None, as classify_features makes them
+        types[pd.isna(types)] = None
+        gdf["type"] = pd.Series(types, index=gdf.index, dtype=object)
+    with step("save_classified", rows=len(gdf)):
+        gdf.to_file(outfolder + cityname + "_features_1_classified.gpkg", index=True, overwrite=True)
+    with step("find_duplicates", rows=int(is_changed.sum())) as record:
+        projected = spatial_index.get_layer(cityname, "features_raw", gdf)
+        # Linestrings changed or near a changed point, at its old or new place
+        is_ls = shapely.get_type_id(gdf.geometry.values) == 1
+        was_point = old_keys.isin(list(changed)) & (
+            shapely.get_type_id(old.geometry.values) == 0
+        )
+        points = np.concatenate(
+            [
+                projected.values[is_changed & (shapely.get_type_id(gdf.geometry.values) == 0)],
+                old.geometry[was_point].to_crs(projected.crs).values,
+            ]
+        )
+        ls_pos = np.flatnonzero(is_ls)
+        near, _ = geometry_dedup.find_near_pairs(
+            projected.values[ls_pos], points, BUFFER_DUPLICATE_LS
+        )
+        rows = np.union1d(np.flatnonzero(is_ls & is_changed), ls_pos[near])
+        # Duplicates are dropped by id, as in process_features
+        old_duplicates = set(old["id"].tolist()) - set(cleaned_ids.tolist())
+        duplicates = set(find_duplicates(gdf, projected.values, rows).tolist())
+        duplicates |= old_duplicates & (
+            set(gdf.index[is_ls].tolist()) - set(gdf.index[rows].tolist())
+        )
+        duplicates = np.array(sorted(duplicates), dtype=np.int64)
+        record["rows_out"] = len(duplicates)
+    save_features_cleaned(cityname, gdf.copy(), duplicates)
+    dense = gpd.read_file(outfolder + cityname + "_features_3_dense.gpkg")
+    return get_changed_dense(old_dense, dense)
+
+
+def get_changed_dense(old_dense, dense):
+    """Get the geometries of the dense features added, changed or removed, old and new."""
+    old_dense, dense = old_dense.set_index("osmid"), dense.set_index("osmid")
+    joined = old_dense.join(dense, how="outer", lsuffix="_old")
+    changed = (
+        joined["type_old"].isna()
+        | joined["type"].isna()
+        | (joined["type_old"] != joined["type"])
+        | (shapely.to_wkb(joined["geometry_old"].values) != shapely.to_wkb(joined["geometry"].values))
+    )
+    changed = joined.index[changed.values]
+    return pd.concat(
+        [
+            old_dense.geometry[old_dense.index.isin(changed)],
+            dense.geometry[dense.index.isin(changed)],
+        ]
+    )
+
+
+def update_graph(cityname, changed_edges, changed_nodes, changed_features):
+    """Update the dense graph of a city for its changed edges, nodes and features.
+
+    Edges whose row changed and edges near a changed feature, within the largest
+    distance at which amenities are searched, get their attributes recomputed,
+    the others keep the ones of the previous dense graph.
+    """
+    outfolder = FOLDERPATH_CITIES + cityname + "/"
+    with step("load") as record:
+        gdf_nodes, gdf_edges = load_graph_tables(outfolder + cityname + "_graph_0_raw")
+        old_nodes, old_edges = load_graph_tables(outfolder + cityname + "_graph_2_dense")
+        gdf_simple = gpd.read_file(outfolder + cityname + "_features_3_dense.gpkg")
+        record["rows_out"] = len(gdf_edges)
+    # Projected geometries and the index of the roads are shared with the other stages
+    projected = spatial_index.get_layer(cityname, "features", gdf_simple)
+    tree, edges_projected = spatial_index.get_tree(cityname, "edges", gdf_edges)
+    _, near = tree.query(
+        changed_features.to_crs(projected.crs).values,
+        predicate="dwithin",
+        distance=max([*NEAR_DISTANCES.values(), NEAREST_MAX_DISTANCE]),
+    )
+    is_affected = gdf_edges.index.isin(list(changed_edges)) | ~gdf_edges.index.isin(
+        old_edges.index
+    )
+    is_affected[near] = True
+    is_affected_node = gdf_nodes.index.isin(list(changed_nodes)) | ~gdf_nodes.index.isin(
+        old_nodes.index
+    )
+    with step("attributes", rows=int(is_affected.sum())):
+        edges = gdf_edges[is_affected].copy()
+        edges_subset = edges_projected.values[is_affected]
+        edges = add_proximity(
+            edges, gdf_simple, edges_subset, projected.values, shapely.STRtree(edges_subset)
+        )
+        nodes, edges = add_road_attributes(gdf_nodes[is_affected_node].copy(), edges)
+        # Attributes of the other edges and nodes are unchanged
+        for new, gdf, old, mask in [
+            (edges, gdf_edges, old_edges, is_affected),
+            (nodes, gdf_nodes, old_nodes, is_affected_node),
+        ]:
+            for col in [c for c in new.columns if c not in gdf.columns]:
+                values = np.empty(len(gdf), dtype=new[col].dtype)
+                values[mask] = new[col].values
+                values[~mask] = old[col].reindex(gdf.index[~mask]).values
+                gdf[col] = values
+    gdf_nodes, gdf_edges = drop_useless_attributes(gdf_nodes, gdf_edges)
+    with step("save", rows=len(gdf_edges)):
+        save_graph_tables(gdf_nodes, gdf_edges, outfolder + cityname + "_graph_2_dense")
+
+
+def update_city(cityname, filepaths, update_d=True, update_e=True):
+    """Apply change files to the raw graph and features of a city, then to D and E if asked."""
+    add_useful_tags()
+    polygon = gpd.read_file(FOLDERPATH_POLY + cityname + ".gpkg").geometry[0]
+    with step("read_changes") as record:
+        changes = {}
+        for filepath in filepaths:
+            changes.update(read_changes(filepath))
+        record["rows_out"] = len(changes)
+    stores, changed = {}, {}
+    with step("apply_changes", rows=len(changes)):
+        bounds = buffer_polygon(polygon).bounds
+        filepath_extract = get_extract(cityname)
+        for kind in ["graph", "features"]:
+            elements = load_city_elements(cityname, kind)
+            stores[kind] = (dict(elements), elements)
+            changed[kind] = apply_changes(
+                elements, changes, bounds, kind, filepath_extract
+            )
+    changed_edges, changed_nodes = set(), set()
+    if changed["graph"]:
+        changed_edges, changed_nodes = update_graph_raw(
+            cityname, *stores["graph"], changed["graph"], polygon
+        )
+    if changed["features"]:
+        update_features_raw(cityname, stores["features"][1], changed["features"], polygon)
+    if update_d and changed["features"]:
+        changed_features = update_features(cityname, changed["features"])
+    else:
+        changed_features = gpd.GeoSeries([], crs=ox.settings.default_crs)
+    if update_d and update_e and (changed["graph"] or len(changed_features)):
+        update_graph(cityname, changed_edges, changed_nodes, changed_features)
+    for kind in ["graph", "features"]:
+        with open(_get_paths(cityname, kind)[1]) as f:
+            applied = set(json.load(f)) | set(filepaths)
+        save_city_elements(cityname, kind, stores[kind][1], applied)
+
+
+if __name__ == "__main__":
+    import instrumentation
+    import stage_cache
+    from osm_changes import MissingElementsError
+
+    for cityname in tqdm.tqdm(CITIES):
+        filepaths = get_pending_changes(cityname)
+        if filepaths is None:
+            print(cityname, "has no saved elements, run B and C with SAVE_ELEMENTS")
+            continue
+        if not filepaths:
+            continue
+        print(cityname)
+        # D and E are updated if up to date, otherwise they are to be run in full
+        update_d = not stage_cache.is_stale("D", cityname)
+        update_e = update_d and not stage_cache.is_stale("E", cityname)
+        try:
+            with instrumentation.task("osc", cityname):
+                update_city(cityname, filepaths, update_d, update_e)
+        except MissingElementsError as e:
+            print(e)
+            continue
+        if update_d:
+            stage_cache.record("D", cityname)
+        if update_e:
+            stage_cache.record("E", cityname)
+    instrumentation.save_report(name="osc")
@@ -0,0 +1,27 @@
+"""Fixtures of the tests, which import the scripts and run in a temporary folder."""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run a test in an empty folder, the scripts using paths relative to it."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def city(workdir):
+    """Make a small synthetic city and run D and E on it, returning its name."""
+    import benchmark_stages
+    import D_process_features
+    import E_process_graph
+
+    cityname = benchmark_stages.make_city(1000)
+    D_process_features.process_features(cityname)
+    E_process_graph.process_graph(cityname)
+    return cityname
@@ -0,0 +1,29 @@
+import geopandas as gpd
+import shapely
+import D_process_features
+
+
+def _features(tags):
+    gdf = gpd.GeoDataFrame(
+        tags,
+        geometry=[shapely.Point(0, 0), shapely.LineString([(2, 0), (2, 10)])],
+        index=["node/1", "way/2"],
+    )
+    gdf["type"], _ = D_process_features.classify_features(gdf)
+    return gdf
+
+
+def test_duplicates_of_the_same_type():
+    gdf = _features({"amenity": ["bench", "bench"], "shop": ["bakery", "bakery"]})
+    duplicates = D_process_features.find_duplicates(gdf, gdf.geometry.values)
+    assert list(duplicates) == ["way/2"]
+
+
+def test_features_without_type_are_duplicates():
+    # As with gpd.sjoin(..., on_attribute="type") before, None matches None
+    gdf = _features({"amenity": ["bench", "bench"]})
+    assert gdf["type"].isna().all()
+    duplicates = D_process_features.find_duplicates(gdf, gdf.geometry.values)
+    assert list(duplicates) == ["way/2"]
+    gdf.loc["node/1", "type"] = "shop"
+    assert len(D_process_features.find_duplicates(gdf, gdf.geometry.values)) == 0
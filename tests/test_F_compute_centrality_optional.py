@@ -0,0 +1,31 @@
+import igraph as ig
+import numpy as np
+import benchmark_stages
+import F_compute_centrality_optional
+from graph_io import get_edge_array
+
+
+def test_cutoffs_with_default_sampling():
+    gdf_nodes, gdf_edges = benchmark_stages.make_graph(2000, np.random.default_rng(0))
+    n_edges = len(gdf_edges)
+    cutoffs = {"length": 500, "travel_time": None}
+    # Few samples, which would be used without cutoffs
+    gdf_edges = F_compute_centrality_optional.add_centrality(
+        gdf_nodes, gdf_edges, n_samples=10, cutoffs=cutoffs
+    )
+    g = ig.Graph(
+        n=len(gdf_nodes), edges=get_edge_array(gdf_nodes, gdf_edges), directed=True
+    )
+    expected = g.edge_betweenness(
+        directed=True, weights=gdf_edges["length"].to_numpy(), cutoff=500
+    )
+    assert np.allclose(
+        gdf_edges["edge_betweenness_centrality_length"],
+        np.array(expected) / (n_edges * (n_edges - 1)),
+    )
+    assert (gdf_edges["edge_betweenness_n_sources"] == len(gdf_nodes)).all()
+
+
+def test_n_samples():
+    assert F_compute_centrality_optional.get_n_samples(10**6) == 14979
+    assert F_compute_centrality_optional.get_n_samples(100) == 100
@@ -0,0 +1,63 @@
+import inspect
+import geopandas as gpd
+import pandas as pd
+import pyogrio
+import shapely
+import G_merge_graph_features
+from config import FOLDERPATH_CITIES
+
+
+def test_chunks_of_different_geometry_types(workdir):
+    gdf = gpd.GeoDataFrame(
+        {"type": ["a", "b", "c", "d"]},
+        geometry=[
+            shapely.Point(0, 0),
+            shapely.Point(1, 1),
+            shapely.box(0, 0, 1, 1),
+            shapely.MultiPolygon([shapely.box(0, 0, 1, 1), shapely.box(2, 2, 3, 3)]),
+        ],
+        crs="EPSG:4326",
+    )
+    n_rows = G_merge_graph_features.write_merged([("features", gdf)], "all.gpkg", chunk_size=2)
+    assert n_rows == 4
+    assert pyogrio.read_info("all.gpkg", layer="features")["geometry_type"] == "Unknown"
+    written = gpd.read_file("all.gpkg", layer="features")
+    assert list(written.geom_type) == ["Point", "Point", "Polygon", "MultiPolygon"]
+
+
+def test_merge_graph_features(city, monkeypatch):
+    monkeypatch.setattr(G_merge_graph_features, "SUFFIX_GRAPH", "2_dense")
+    G_merge_graph_features.merge_graph_features(city)
+    layers = G_merge_graph_features.load_merged(
+        FOLDERPATH_CITIES + city + "/" + city + "_all.gpkg"
+    )
+    assert list(layers) == G_merge_graph_features.LAYERS_MERGED
+    assert (layers["roads"]["origin"] == "road").all()
+    assert (layers["nodes"]["type"] == "intersection").all()
+    assert layers["roads"]["osmid"].str.startswith("W").all()
+
+
+def test_roads_and_nodes_read_in_batches(city, monkeypatch):
+    monkeypatch.setattr(G_merge_graph_features, "SUFFIX_GRAPH", "2_dense")
+    filepath = FOLDERPATH_CITIES + city + "/" + city + "_all.gpkg"
+    G_merge_graph_features.merge_graph_features(city)
+    expected = G_merge_graph_features.load_merged(filepath)
+    sizes = []
+    iter_table = G_merge_graph_features.iter_table
+
+    def iter_batches(*args, **kwargs):
+        for batch in iter_table(*args, **kwargs):
+            sizes.append(len(batch))
+            yield batch
+
+    monkeypatch.setattr(G_merge_graph_features, "iter_table", iter_batches)
+    G_merge_graph_features.merge_graph_features(city, chunk_size=100)
+    assert max(sizes) == 100
+    assert sum(sizes) > 2 * 100
+    layers = G_merge_graph_features.load_merged(filepath)
+    for layer in G_merge_graph_features.LAYERS_MERGED:
+        pd.testing.assert_frame_equal(layers[layer], expected[layer])
+
+
+def test_layers_made_one_after_the_other():
+    assert inspect.isgeneratorfunction(G_merge_graph_features.merge_tables)
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import H_snap_crashes
+from config import FOLDERPATH_CITIES
+from graph_io import load_table
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_column_empty_in_first_chunk(city, n_workers):
+    # Crashes on the nodes of the city, with a note only after the first chunk
+    nodes = load_table(FOLDERPATH_CITIES + city + "/" + city + "_graph_2_dense_nodes.parquet")
+    rng = np.random.default_rng(0)
+    pos = rng.integers(len(nodes), size=3000)
+    crashes = pd.DataFrame(
+        {
+            "longitude": nodes["x"].values[pos],
+            "latitude": nodes["y"].values[pos],
+            "note": [None] * 1000 + ["x"] * 2000,
+        }
+    )
+    folder = H_snap_crashes.FOLDERPATH_CRASHES + city + "/"
+    os.makedirs(folder)
+    crashes.to_csv(folder + "2024.csv", index=False)
+    H_snap_crashes.snap_crashes(city, n_workers=n_workers, chunk_size=1000)
+    snapped = pq.read_table(
+        FOLDERPATH_CITIES + city + "/" + city + "_crashes_snapped.parquet"
+    ).to_pandas()
+    assert len(snapped) == 3000
+    assert snapped["note"].isna().sum() == 1000
+    assert (snapped["note"].dropna() == "x").all()
+    assert snapped["edge_distance"].notna().all()
+    counts = pd.read_parquet(FOLDERPATH_CITIES + city + "/" + city + "_crash_counts.parquet")
+    assert counts["n_crashes"].sum() == 3000
+
+
+def test_columns_named_as_road_attributes(city):
+    nodes = load_table(FOLDERPATH_CITIES + city + "/" + city + "_graph_2_dense_nodes.parquet")
+    crashes = pd.DataFrame(
+        {
+            "longitude": nodes["x"].values[:10],
+            "latitude": nodes["y"].values[:10],
+            "key": [f"crash_{i}" for i in range(10)],
+            "hierarchy": ["fatal"] * 10,
+            "node": ["x"] * 10,
+        }
+    )
+    folder = H_snap_crashes.FOLDERPATH_CRASHES + city + "/"
+    os.makedirs(folder)
+    crashes.to_parquet(folder + "2024.parquet")
+    H_snap_crashes.snap_crashes(city, n_workers=1)
+    snapped = pd.read_parquet(
+        FOLDERPATH_CITIES + city + "/" + city + "_crashes_snapped.parquet"
+    )
+    assert snapped["key"].tolist() == crashes["key"].tolist()
+    assert (snapped["hierarchy"] == "fatal").all()
+    assert (snapped["node"] == "x").all()
+    assert snapped["edge_key"].notna().all()
+    assert snapped["edge_hierarchy"].notna().all()
+    assert snapped["node_osmid"].notna().sum() > 0
+    for col in ["u", "v"] + H_snap_crashes.EDGE_ATTRIBUTES:
+        assert "edge_" + col in snapped
@@ -0,0 +1,48 @@
+import igraph as ig
+import numpy as np
+import pytest
+from betweenness import sharded_edge_betweenness
+
+
+def make_graph(seed=0):
+    """Make a random directed graph with weights, as arrays and as an igraph graph."""
+    g = ig.Graph.Erdos_Renyi(n=60, m=240, directed=True)
+    rng = np.random.default_rng(seed)
+    edges = np.array(g.get_edgelist())
+    weights = {
+        "length": rng.uniform(1, 100, len(edges)),
+        "travel_time": rng.uniform(1, 10, len(edges)),
+    }
+    for weight, values in weights.items():
+        g.es[weight] = values
+    return g, edges, weights
+
+
+def test_exact_in_shards():
+    g, edges, weights = make_graph()
+    bet = sharded_edge_betweenness(g.vcount(), edges, weights, shard_size=7)
+    for weight in weights:
+        expected = g.edge_betweenness(directed=True, weights=weight)
+        assert np.allclose(bet[weight], expected)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_cutoffs(n_workers):
+    g, edges, weights = make_graph()
+    cutoffs = {"length": 150, "travel_time": None}
+    bet = sharded_edge_betweenness(
+        g.vcount(), edges, weights, cutoffs=cutoffs, n_workers=n_workers, shard_size=7
+    )
+    for weight, cutoff in cutoffs.items():
+        expected = g.edge_betweenness(directed=True, weights=weight, cutoff=cutoff)
+        assert np.allclose(bet[weight], expected)
+    # The cutoff leaves out some paths
+    assert not np.allclose(bet["length"], g.edge_betweenness(directed=True, weights="length"))
+
+
+def test_cutoffs_with_sources():
+    g, edges, weights = make_graph()
+    with pytest.raises(ValueError):
+        sharded_edge_betweenness(
+            g.vcount(), edges, weights, sources=[0, 1], cutoffs={"length": 150}
+        )
@@ -0,0 +1,50 @@
+import warnings
+import numpy as np
+import shapely
+import geometry_dedup
+
+
+def _brute_force(geometries, others, tolerance):
+    pairs = [
+        (i, j)
+        for i, geom in enumerate(geometries)
+        for j, other in enumerate(others)
+        if shapely.dwithin(geom, other, tolerance)
+    ]
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def test_near_pairs_of_small_large_and_empty_geometries():
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(0, 3000, size=(200, 2))
+    ends = starts + rng.normal(0, 20, size=(200, 2))
+    # Long diagonals and empty geometries among short linestrings
+    ends[:5] = starts[:5] + 3000
+    geometries = shapely.linestrings(np.stack([starts, ends], axis=1))
+    geometries[5:8] = shapely.from_wkt(["LINESTRING EMPTY", "POINT EMPTY", "POLYGON EMPTY"])
+    others = shapely.points(rng.uniform(0, 3000, size=(2000, 2)))
+    others[:3] = [shapely.LineString([(0, 1500), (3000, 1500)]), shapely.Point(), None]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ind, other_ind = geometry_dedup.find_near_pairs(geometries, others, 8)
+    expected = _brute_force(geometries, others, 8)
+    assert len(expected) > 0
+    assert np.array_equal(np.column_stack([ind, other_ind]), expected)
+
+
+def test_long_geometries_are_not_split_in_cells(monkeypatch):
+    n_cells = []
+    get_cells = geometry_dedup._get_cells
+
+    def counted(geometries, *args):
+        positions, cx, cy = get_cells(geometries, *args)
+        n_cells.append(len(positions))
+        return positions, cx, cy
+
+    monkeypatch.setattr(geometry_dedup, "_get_cells", counted)
+    line = shapely.LineString([(0, 0), (3000, 3000)])
+    ind, other_ind = geometry_dedup.find_near_pairs(
+        np.array([line]), shapely.points([(1500, 1505), (0, 100)]), 8
+    )
+    assert list(ind) == [0] and list(other_ind) == [0]
+    assert sum(n_cells) <= 2 * geometry_dedup.MAX_CELLS
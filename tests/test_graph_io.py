@@ -0,0 +1,47 @@
+import os
+import geopandas as gpd
+import osmnx as ox
+import pandas as pd
+import shapely
+import graph_io
+
+
+def _roundtrip(columns):
+    gdf = gpd.GeoDataFrame(
+        columns, geometry=[shapely.Point(i, i) for i in range(3)], crs="EPSG:4326"
+    )
+    graph_io.save_graph_tables(gdf, gdf, "graph")
+    return graph_io.load_table("graph_nodes.parquet")
+
+
+def test_wrapped_values_are_unwrapped(workdir):
+    gdf = _roundtrip({"osmid": [[1, 2], 3, None], "name": [["a", "b"], 1, "c"]})
+    assert gdf["osmid"].tolist() == [[1, 2], 3, None]
+    assert gdf["name"].tolist() == [["a", "b"], "1", "c"]
+    assert gdf.attrs == {}
+
+
+def test_lists_are_kept(workdir):
+    gdf = _roundtrip({"ref": [[1], [2, 3], []], "lanes": [["1"], ["2"], None]})
+    assert gdf["ref"].tolist() == [[1], [2, 3], []]
+    assert gdf["lanes"].tolist() == [["1"], ["2"], None]
+
+
+def test_exports_are_optional(workdir, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("graph built")
+
+    monkeypatch.setattr(ox, "graph_from_gdfs", fail)
+    _roundtrip({"osmid": [1, 2, 3]})
+    assert sorted(os.listdir()) == ["graph_edges.parquet", "graph_nodes.parquet"]
+
+
+def test_table_read_in_batches(workdir):
+    columns = {"osmid": [[1, 2], 3, None], "ref": [[1], [2, 3], []]}
+    table = _roundtrip(columns)
+    batches = list(graph_io.iter_table("graph_nodes.parquet", batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    pd.testing.assert_frame_equal(pd.concat(batches), table)
+    batches = list(graph_io.iter_table("graph_nodes.parquet", columns=["ref"]))
+    assert list(batches[0].columns) == ["ref", "geometry"]
+    assert batches[0].crs == table.crs
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import osmnx as ox
+import pytest
+from osmnx import _overpass
+import http_cache
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.server.requests.append(body)
+        content = json.dumps({"elements": [], "query": body, "padding": "x" * 1000}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(workdir, monkeypatch):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(ox.settings, "overpass_url", f"http://127.0.0.1:{httpd.server_port}/api")
+    monkeypatch.setattr(ox.settings, "overpass_rate_limit", False)
+    monkeypatch.setattr(ox.settings, "use_cache", False)
+    monkeypatch.setattr(http_cache, "_size", None)
+    http_cache.install()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _entries():
+    return sorted(
+        filename
+        for _, _, filenames in os.walk(http_cache.FOLDERPATH_CACHE)
+        for filename in filenames
+        if filename.endswith(".json.gz")
+    )
+
+
+def test_miss_then_hit(server):
+    response = _overpass._overpass_request({"data": "a"})
+    assert response["query"] == "data=a"
+    assert len(server.requests) == 1
+    assert _overpass._overpass_request({"data": "a"}) == response
+    assert len(server.requests) == 1
+    _overpass._overpass_request({"data": "b"})
+    assert len(server.requests) == 2
+
+
+def test_expired_response_is_fetched_again(server, monkeypatch):
+    _overpass._overpass_request({"data": "a"})
+    monkeypatch.setattr(http_cache, "TTL_DAYS", 1)
+    _overpass._overpass_request({"data": "a"})
+    assert len(server.requests) == 1
+    monkeypatch.setattr(time, "time", lambda: os.path.getmtime(".") + 2 * 86400)
+    _overpass._overpass_request({"data": "a"})
+    assert len(server.requests) == 2
+
+
+def test_least_recently_used_are_evicted(server, monkeypatch):
+    _overpass._overpass_request({"data": "a"})
+    size = os.path.getsize(http_cache._path(http_cache.get_key(
+        ox.settings.overpass_url + "/interpreter", {"data": "a"}
+    )))
+    # The cache holds three responses, and is brought down to 90% of it when exceeded
+    monkeypatch.setattr(http_cache, "MAX_SIZE_GB", 3.5 * size / 1024**3)
+    for data in "bc":
+        time.sleep(0.01)
+        _overpass._overpass_request({"data": data})
+    time.sleep(0.01)
+    # Using a response makes it the most recently used
+    _overpass._overpass_request({"data": "a"})
+    assert len(_entries()) == 3
+    assert len(server.requests) == 3
+    time.sleep(0.01)
+    _overpass._overpass_request({"data": "d"})
+    assert len(_entries()) == 3
+    for data in "acd":
+        _overpass._overpass_request({"data": data})
+    assert len(server.requests) == 4
+    _overpass._overpass_request({"data": "b"})
+    assert len(server.requests) == 5
+
+
+def test_cache_only_miss_fails(server, monkeypatch):
+    _overpass._overpass_request({"data": "a"})
+    monkeypatch.setattr(http_cache, "CACHE_ONLY", True)
+    assert _overpass._overpass_request({"data": "a"})["query"] == "data=a"
+    with pytest.raises(http_cache.CacheMissError):
+        _overpass._overpass_request({"data": "b"})
+    assert len(server.requests) == 1
+
+
+def test_response_removed_by_another_process(server, monkeypatch):
+    _overpass._overpass_request({"data": "a"})
+    monkeypatch.setattr(os, "utime", lambda path: (_ for _ in ()).throw(FileNotFoundError(path)))
+    assert _overpass._overpass_request({"data": "a"})["query"] == "data=a"
+    assert len(server.requests) == 1
+
+
+def test_cache_is_scanned_once(server, monkeypatch):
+    scans = []
+    evict = http_cache.evict
+    monkeypatch.setattr(http_cache, "evict", lambda *args: scans.append(args) or evict(*args))
+    for data in "abcdef":
+        _overpass._overpass_request({"data": data})
+    assert len(server.requests) == 6
+    assert len(scans) == 1
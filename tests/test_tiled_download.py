@@ -0,0 +1,168 @@
+import json
+import re
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import osmnx as ox
+import pytest
+import shapely
+import tiled_download
+from osm_elements import graph_from_elements
+
+PARTS = [(9.0, 45.0), (9.1, 45.05)]  # South-west corners of the parts of the city
+SPACING = 0.002  # Spacing in degree of the grid of nodes of each part
+N_GRID = 8  # Number of nodes on each side of the grid of each part
+
+
+def _make_elements():
+    """Make a grid of residential streets in each part, as Overpass elements."""
+    nodes, ways = {}, []
+    for part, (lon0, lat0) in enumerate(PARTS):
+        ids = {}
+        for i in range(N_GRID):
+            for j in range(N_GRID):
+                ids[i, j] = 1000 * (part + 1) + N_GRID * i + j
+                nodes[ids[i, j]] = {
+                    "type": "node",
+                    "id": ids[i, j],
+                    "lon": lon0 + i * SPACING,
+                    "lat": lat0 + j * SPACING,
+                }
+        for k in range(N_GRID):
+            for axis, way_nodes in enumerate(
+                [[ids[k, j] for j in range(N_GRID)], [ids[i, k] for i in range(N_GRID)]]
+            ):
+                ways.append(
+                    {
+                        "type": "way",
+                        "id": 100 * (part + 1) + 2 * k + axis,
+                        "nodes": way_nodes,
+                        "tags": {"highway": "residential"},
+                    }
+                )
+    return nodes, ways
+
+
+class _Overpass(BaseHTTPRequestHandler):
+    """Stand-in Overpass server returning the ways with a node in the polygon of a query."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        query = parse_qs(body)["data"][0]
+        self.server.queries.append(query)
+        if self.server.failures:
+            self.send_response(self.server.failures.pop(0))
+            self.end_headers()
+            return
+        coords = [float(x) for x in re.search(r"poly:'([^']+)'", query).group(1).split()]
+        polygon = shapely.Polygon(list(zip(coords[1::2], coords[::2])))
+        nodes, ways = self.server.elements
+        inside = {
+            node_id
+            for node_id, node in nodes.items()
+            if polygon.covers(shapely.Point(node["lon"], node["lat"]))
+        }
+        selected = [way for way in ways if inside.intersection(way["nodes"])]
+        node_ids = sorted({node_id for way in selected for node_id in way["nodes"]})
+        content = json.dumps(
+            {"elements": [nodes[node_id] for node_id in node_ids] + selected}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def overpass(workdir, monkeypatch):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Overpass)
+    httpd.queries, httpd.failures = [], []
+    httpd.elements = _make_elements()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(ox.settings, "overpass_url", f"http://127.0.0.1:{httpd.server_port}/api")
+    monkeypatch.setattr(ox.settings, "overpass_rate_limit", False)
+    sleeps = []
+    monkeypatch.setattr(tiled_download, "time", types.SimpleNamespace(sleep=sleeps.append))
+    httpd.sleeps = sleeps
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _city():
+    """Get the boundary of the city, a MultiPolygon within the grids of its parts."""
+    margin = 2 * SPACING
+    size = (N_GRID - 1) * SPACING - 2 * margin
+    return shapely.MultiPolygon(
+        [
+            shapely.box(lon + margin, lat + margin, lon + margin + size, lat + margin + size)
+            for lon, lat in PARTS
+        ]
+    )
+
+
+def test_tiles_cover_every_part():
+    polygon = _city()
+    tiles = tiled_download.make_tiles(polygon, 300)
+    assert len(tiles) > len(PARTS)
+    # Tiles are projected back to lon/lat, up to rounding
+    union = shapely.union_all(tiles)
+    assert union.symmetric_difference(polygon).area < 1e-4 * polygon.area
+    for part in polygon.geoms:
+        assert any(tile.intersects(part) for tile in tiles)
+
+
+def test_tiled_graph_equals_graph_of_all_elements(overpass):
+    polygon = _city()
+    G = tiled_download.graph_from_polygon_tiled(polygon, "all", tile_size=800)
+    nodes, ways = overpass.elements
+    expected = graph_from_elements(
+        [{"elements": list(nodes.values()) + ways}], polygon, "all", retain_all=True
+    )
+    assert len(overpass.queries) > len(PARTS)
+    assert sorted(G.nodes) == sorted(expected.nodes)
+    assert sorted(G.edges(keys=True)) == sorted(expected.edges(keys=True))
+    # Both parts of the city are in the graph
+    assert {node // 1000 for node in G.nodes} == {1, 2}
+
+
+def test_shared_elements_are_kept_once(overpass):
+    polygon = _city()
+    tiles = tiled_download.make_tiles(polygon, 300)
+    responses = [
+        response
+        for tile in tiles
+        for response in tiled_download._download_overpass_network(tile, "all", None)
+    ]
+    keys = [(el["type"], el["id"]) for response in responses for el in response["elements"]]
+    # Ways crossing tiles and their nodes are returned by each of them
+    assert len(keys) > len(set(keys))
+    merged = tiled_download.merge_responses(responses)
+    merged_keys = [(el["type"], el["id"]) for el in merged[0]["elements"]]
+    assert sorted(merged_keys) == sorted(set(keys))
+
+
+@pytest.mark.parametrize("status", [429, 504])
+def test_busy_server_is_retried_with_backoff(overpass, monkeypatch, status):
+    monkeypatch.setattr(tiled_download, "BACKOFF", 0.5)
+    overpass.failures[:] = [status] * 3
+    G = tiled_download.graph_from_polygon_tiled(
+        _city(), "all", tile_size=100000, max_workers=1
+    )
+    assert len(G.nodes) > 0
+    assert [sleep for sleep in overpass.sleeps if sleep] == [0.5, 1, 2]
+    assert overpass.failures == []
+
+
+def test_failing_server_raises_after_retries(overpass, monkeypatch):
+    monkeypatch.setattr(tiled_download, "MAX_RETRIES", 2)
+    overpass.failures[:] = [429] * 3
+    with pytest.raises(tiled_download.ResponseStatusCodeError):
+        tiled_download.graph_from_polygon_tiled(_city().geoms[0], "all", tile_size=100000)
+    assert len(overpass.queries) == 3
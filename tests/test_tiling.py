@@ -0,0 +1,55 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+import benchmark_stages
+import D_process_features
+import E_process_graph
+import G_merge_graph_features
+import tiling
+from config import FOLDERPATH_CITIES
+from graph_io import load_table
+
+
+def _run(cityname):
+    """Run D, E and G on a city and load their outputs."""
+    D_process_features.process_features(cityname)
+    E_process_graph.process_graph(cityname)
+    G_merge_graph_features.merge_graph_features(cityname)
+    outfolder = FOLDERPATH_CITIES + cityname + "/" + cityname
+    outputs = {
+        suffix: gpd.read_file(outfolder + "_features_" + suffix + ".gpkg")
+        for suffix in ["1_classified", "2_classified_wols", "3_dense"]
+    }
+    for suffix in ["nodes", "edges"]:
+        outputs[suffix] = load_table(outfolder + "_graph_2_dense_" + suffix + ".parquet")
+    for layer, gdf in G_merge_graph_features.load_merged(outfolder + "_all.gpkg").items():
+        outputs[layer] = gdf
+    return outputs
+
+
+@pytest.mark.parametrize("tile_size", [300, 1000])
+def test_tiled_equals_untiled(workdir, monkeypatch, tile_size):
+    monkeypatch.setattr(G_merge_graph_features, "SUFFIX_GRAPH", "2_dense")
+    cityname = benchmark_stages.make_city(1000)
+    untiled = _run(cityname)
+    monkeypatch.setattr(tiling, "TILED_CITIES", [cityname])
+    monkeypatch.setattr(tiling, "TILE_SIZE", tile_size)
+    monkeypatch.setattr(tiling, "N_WORKERS", 2)
+    tiles = tiling.get_tiles(
+        cityname,
+        FOLDERPATH_CITIES + cityname + "/" + cityname + "_graph_0_raw_edges.parquet",
+        0,
+    )
+    assert len(tiles) > 1
+    functions = []
+    run_tiles = tiling.run_tiles
+
+    def run_tiles_recorded(function, *args, **kwargs):
+        functions.append(function.__name__)
+        return run_tiles(function, *args, **kwargs)
+
+    monkeypatch.setattr(tiling, "run_tiles", run_tiles_recorded)
+    tiled = _run(cityname)
+    assert functions == ["find_duplicates_tile", "add_proximity_tile", "find_node_features_tile"]
+    for name, gdf in untiled.items():
+        pd.testing.assert_frame_equal(tiled[name], gdf, obj=name)
@@ -0,0 +1,311 @@
+import os
+from xml.sax.saxutils import quoteattr
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+import BC_get_raw_from_pbf
+import D_process_features
+import E_process_graph
+import update_from_osc
+from B_get_graph_raw import get_change_files, save_elements_raw
+from config import AMENITIES_DICT, FOLDERPATH_CHANGES, FOLDERPATH_CITIES, FOLDERPATH_POLY
+from graph_io import load_graph_tables
+from osm_elements import buffer_polygon, match_tags
+
+ORIGIN = (24.1, 56.95)  # Lon/lat of the south-west corner of the grid of streets
+SPACING = (0.002, 0.001)  # Spacing in degree of the grid along lon and lat
+N_GRID = (24, 18)  # Number of nodes of the grid along lon and lat
+POLYGON = (0.006, 0.002, 0.032, 0.013)  # Bounds of the city from the origin
+ROW_HIGHWAYS = ["residential", "primary", "footway", "cycleway"]  # Highway of rows by j
+
+
+def _node_id(i, j):
+    return 1 + N_GRID[1] * i + j
+
+
+def _node(node_id, lon, lat, **tags):
+    # Rounded as in OSM files
+    element = {
+        "type": "node",
+        "id": node_id,
+        "lat": round(ORIGIN[1] + lat, 7),
+        "lon": round(ORIGIN[0] + lon, 7),
+    }
+    if tags:
+        element["tags"] = tags
+    return element
+
+
+def _way(way_id, nodes, **tags):
+    return {"type": "way", "id": way_id, "nodes": nodes, "tags": tags}
+
+
+def _grid_node(i, j, **tags):
+    return _node(_node_id(i, j), i * SPACING[0], j * SPACING[1], **tags)
+
+
+def _make_elements():
+    """Make a grid of streets, only every other column being a street, and amenities."""
+    elements = [_grid_node(i, j) for i in range(N_GRID[0]) for j in range(N_GRID[1])]
+    elements += [
+        _grid_node(7, 5, highway="traffic_signals"),
+        _grid_node(12, 4, highway="traffic_signals"),
+        _grid_node(9, 7, highway="crossing", crossing="zebra"),
+        # Tags OSMnx does not keep on the nodes of the streets
+        _grid_node(11, 5, barrier="bollard", note="x"),
+        # Tags of a node out of the bounds of the city
+        _grid_node(23, 3, highway="crossing"),
+    ]
+    for j in range(N_GRID[1]):
+        tags = {"highway": ROW_HIGHWAYS[j % len(ROW_HIGHWAYS)]}
+        if j % len(ROW_HIGHWAYS) == 1:
+            tags["maxspeed"] = "50"
+        elements.append(_way(1000 + j, [_node_id(i, j) for i in range(N_GRID[0])], **tags))
+    for i in range(0, N_GRID[0], 2):
+        tags = {"highway": "secondary", "maxspeed": "30"} if i % 4 else {"highway": "residential"}
+        elements.append(_way(2000 + i, [_node_id(i, j) for j in range(N_GRID[1])], **tags))
+    # Amenities: points, a linestring duplicating a point, a polygon and a multipolygon
+    elements += [
+        _node(9001, 0.0151, 0.0055, shop="bakery"),
+        _node(9002, 0.0171, 0.0065, highway="bus_stop"),
+        _node(9003, 0.0191, 0.0075, amenity="bicycle_parking"),
+        _node(5001, 0.0190, 0.0075),
+        _node(5002, 0.0192, 0.0075),
+        _way(9101, [5001, 5002], amenity="bicycle_parking"),
+    ]
+    corners = [(0.0205, 0.0085), (0.0215, 0.0085), (0.0215, 0.0095), (0.0205, 0.0095)]
+    elements += [_node(5010 + k, lon, lat) for k, (lon, lat) in enumerate(corners)]
+    elements.append(_way(9102, [5010, 5011, 5012, 5013, 5010], amenity="parking"))
+    corners = [(0.0131, 0.0085), (0.0141, 0.0085), (0.0141, 0.0095), (0.0131, 0.0095)]
+    elements += [_node(5020 + k, lon, lat) for k, (lon, lat) in enumerate(corners)]
+    elements += [
+        _way(9103, [5020, 5021, 5022, 5023, 5020]),
+        _node(5030, 0.0136, 0.0090, name="park"),
+        {
+            "type": "relation",
+            "id": 9201,
+            "members": [
+                {"type": "way", "ref": 9103, "role": "outer"},
+                {"type": "node", "ref": 5030, "role": "label"},
+            ],
+            "tags": {"type": "multipolygon", "leisure": "park"},
+        },
+    ]
+    return {(element["type"], element["id"]): element for element in elements}
+
+
+def _make_changes():
+    """Make changes of streets and amenities, as (action, element) pairs."""
+    return [
+        # A street becoming primary, a node moved and a node getting a crossing
+        ("modify", _way(1006, [_node_id(i, 6) for i in range(N_GRID[0])], highway="primary")),
+        ("modify", _node(_node_id(12, 8), 12 * SPACING[0] + 0.0002, 8 * SPACING[1] + 0.0003)),
+        ("modify", _grid_node(13, 6, highway="crossing")),
+        # A new street through the interstitial nodes of rows, and a street deleted
+        ("create", _node(5100, 0.0170, 0.0065)),
+        (
+            "create",
+            _way(3000, [_node_id(7, 5), 5100, _node_id(9, 7)], highway="residential"),
+        ),
+        ("delete", _way(2010, [_node_id(10, j) for j in range(N_GRID[1])])),
+        # A node out of the bounds of the city moved
+        ("modify", _node(_node_id(23, 0), 23 * SPACING[0], 0.0002)),
+        # A shop added, a bus stop deleted, a parking becoming a park
+        ("create", _node(9004, 0.0161, 0.0061, shop="books")),
+        ("delete", _node(9002, 0.0171, 0.0065)),
+        ("modify", _way(9102, [5010, 5011, 5012, 5013, 5010], leisure="park")),
+        # The point duplicated by a linestring moved away from it
+        ("modify", _node(9003, 0.0175, 0.0090, amenity="bicycle_parking")),
+    ]
+
+
+def _to_xml(element, action=None):
+    """Write an element in OSM XML."""
+    attrs = f'id="{element["id"]}" version="1"'
+    if action == "delete":
+        attrs = f'id="{element["id"]}" version="2" visible="false"'
+    if element["type"] == "node":
+        attrs += f' lat="{element["lat"]:.7f}" lon="{element["lon"]:.7f}"'
+    children = []
+    if element["type"] == "way":
+        children += [f'<nd ref="{ref}"/>' for ref in element["nodes"]]
+    if element["type"] == "relation":
+        children += [
+            f'<member type="{m["type"]}" ref="{m["ref"]}" role="{m["role"]}"/>'
+            for m in element["members"]
+        ]
+    children += [
+        f"<tag k={quoteattr(k)} v={quoteattr(v)}/>" for k, v in element.get("tags", {}).items()
+    ]
+    return f'<{element["type"]} {attrs}>' + "".join(children) + f'</{element["type"]}>'
+
+
+def _write_extract(filepath, elements):
+    """Write elements as an OSM XML extract, sorted by type then id."""
+    ranks = {"node": 0, "way": 1, "relation": 2}
+    keys = sorted(elements, key=lambda key: (ranks[key[0]], key[1]))
+    with open(filepath, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        f.writelines(_to_xml(elements[key]) + "\n" for key in keys)
+        f.write("</osm>\n")
+
+
+def _write_changes(filepath, changes):
+    """Write changes as an OSM change file."""
+    with open(filepath, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n')
+        for action, element in changes:
+            f.write(f"<{action}>{_to_xml(element, action)}</{action}>\n")
+        f.write("</osmChange>\n")
+
+
+def _get_polygon():
+    return shapely.box(
+        ORIGIN[0] + POLYGON[0],
+        ORIGIN[1] + POLYGON[1],
+        ORIGIN[0] + POLYGON[2],
+        ORIGIN[1] + POLYGON[3],
+    )
+
+
+def _get_overpass_response(elements, polygon, kind):
+    """Get the elements Overpass returns for the graph or the features within a polygon.
+
+    Overpass returns all the tags of the nodes, and the members of the relations.
+    """
+
+    def covers(way):
+        nodes = [elements[("node", ref)] for ref in way["nodes"]]
+        return any(polygon.covers(shapely.Point(n["lon"], n["lat"])) for n in nodes)
+
+    def is_feature(key, element):
+        if not match_tags(element.get("tags", {}), AMENITIES_DICT):
+            return False
+        if key[0] == "node":
+            return covers({"nodes": [key[1]]})
+        if key[0] == "way":
+            return covers(element)
+        return any(
+            m["type"] == "way" and covers(elements[("way", m["ref"])])
+            for m in element["members"]
+        )
+
+    if kind == "graph":
+        polygon = buffer_polygon(polygon)
+        selected = {
+            key: element
+            for key, element in elements.items()
+            if key[0] == "way" and "highway" in element["tags"] and covers(element)
+        }
+    else:
+        selected = {
+            key: element for key, element in elements.items() if is_feature(key, element)
+        }
+        for element in list(selected.values()):
+            for m in element.get("members", []):
+                selected[(m["type"], m["ref"])] = elements[(m["type"], m["ref"])]
+    for element in list(selected.values()):
+        for ref in element.get("nodes", []):
+            selected[("node", ref)] = elements[("node", ref)]
+    return [{"elements": list(selected.values())}]
+
+
+def _make_city(cityname, elements):
+    """Make the raw data of a city from an extract of the elements, then D and E."""
+    polygon = _get_polygon()
+    os.makedirs(FOLDERPATH_POLY, exist_ok=True)
+    gpd.GeoDataFrame(geometry=[polygon], crs="EPSG:4326").to_file(
+        FOLDERPATH_POLY + cityname + ".gpkg"
+    )
+    filepath = cityname + ".osm"
+    _write_extract(filepath, elements)
+    BC_get_raw_from_pbf.get_raw_from_pbf(filepath, [cityname], save_elements=True)
+    D_process_features.process_features(cityname)
+    E_process_graph.process_graph(cityname)
+
+
+def _normalize(gdf):
+    """Sort the rows and columns of a table, for tables made differently to be compared."""
+    keys = [col for col in ["element", "id", "osmid"] if col in gdf.columns]
+    gdf = gdf.sort_values(keys) if keys else gdf.sort_index()
+    return gdf[sorted(gdf.columns)].reset_index(drop=not keys)
+
+
+def _load_outputs(cityname):
+    """Load the raw graph and features of a city, and the outputs of D and E."""
+    filepath = FOLDERPATH_CITIES + cityname + "/" + cityname
+    outputs = {}
+    for suffix in ["_graph_0_raw", "_graph_2_dense"]:
+        nodes, edges = load_graph_tables(filepath + suffix)
+        outputs[suffix + "_nodes"] = nodes.sort_index()[sorted(nodes.columns)]
+        outputs[suffix + "_edges"] = edges.sort_index()[sorted(edges.columns)]
+    for suffix in [
+        "_features_0_raw",
+        "_features_1_classified",
+        "_features_2_classified_wols",
+        "_features_3_dense",
+    ]:
+        outputs[suffix] = _normalize(gpd.read_file(filepath + suffix + ".gpkg"))
+    return outputs
+
+
+@pytest.fixture
+def updated(workdir):
+    """Make a city, apply changes to it, and make the city of the changed elements."""
+    elements = _make_elements()
+    _make_city("osc_updated", elements)
+    changes = _make_changes()
+    os.makedirs(FOLDERPATH_CHANGES)
+    _write_changes(FOLDERPATH_CHANGES + "000.osc", changes)
+    for action, element in changes:
+        key = (element["type"], element["id"])
+        if action == "delete":
+            elements.pop(key)
+        else:
+            elements[key] = element
+    _make_city("osc_rebuilt", elements)
+    assert update_from_osc.get_pending_changes("osc_updated") == get_change_files()
+    update_from_osc.update_city("osc_updated", get_change_files())
+    return "osc_updated", "osc_rebuilt"
+
+
+def test_update_equals_rebuild(updated):
+    cityname, cityname_rebuilt = updated
+    outputs = _load_outputs(cityname)
+    expected = _load_outputs(cityname_rebuilt)
+    for name in expected:
+        pd.testing.assert_frame_equal(outputs[name], expected[name], obj=name)
+    assert update_from_osc.get_pending_changes(cityname) == []
+
+
+def test_elements_equal_rebuild(updated):
+    cityname, cityname_rebuilt = updated
+    for kind in ["graph", "features"]:
+        elements = update_from_osc.load_city_elements(cityname, kind)
+        expected = update_from_osc.load_city_elements(cityname_rebuilt, kind)
+        assert list(elements) == list(expected)
+        assert elements == expected
+
+
+def test_overpass_elements_saved_as_extract(workdir):
+    elements = _make_elements()
+    _make_city("osc_extract", elements)
+    saved = {}
+    for kind in ["graph", "features"]:
+        save_elements_raw(
+            _get_overpass_response(elements, _get_polygon(), kind),
+            "osc_overpass",
+            kind,
+            _get_polygon(),
+        )
+        saved[kind] = update_from_osc.load_city_elements("osc_overpass", kind)
+        expected = update_from_osc.load_city_elements("osc_extract", kind)
+        # Extracts also have the features out of the city, within its buffered bounds
+        assert set(saved[kind]) <= set(expected)
+        assert saved[kind] == {key: expected[key] for key in saved[kind]}
+    assert set(saved["graph"]) == set(update_from_osc.load_city_elements("osc_extract", "graph"))
+    # Tags OSMnx does not keep and tags out of the bounds, nodes only members of a relation
+    assert "tags" not in saved["graph"][("node", _node_id(11, 5))]
+    assert "tags" not in saved["graph"][("node", _node_id(23, 3))]
+    assert ("node", 5030) not in saved["features"]